@@ -0,0 +1,285 @@
+"""
+Micro-benchmark of the training data pipeline on synthetic data.
+
+Writes BEDLAM-shaped labels (scene npz and -hands.npz) and PNG frames to a
+local folder, registers them as the dataset 'bench-synthetic' and then
+
+- times every stage of __getitem__ (decode, augmentation, crop, keypoints,
+  normalization, rest) in the main process for DatasetHMR (dataset.py),
+  DatasetHMR of CLIFF-X (datasetx.py) and DatasetHand (dataset_hand.py,
+  needs the MANO model),
+- measures the batch times and throughput of a DataLoader for every worker
+  count of --workers.
+
+Runs on the CPU, no real dataset is needed. The report is written as json,
+--compare prints the relative change of every timing to an older report, e.g.
+
+    python benchmark_data_pipeline.py --out bench_new.json --compare bench_old.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import cv2
+import torch
+from loguru import logger
+from torch.utils.data import DataLoader
+
+from train.core import config
+from train.core.config import get_hparams_defaults
+from train.utils.augmentations import OpTimer
+
+sys.path.append('.')
+
+DATASET_NAME = 'bench-synthetic'
+DATASETS = ['hmr', 'hmrx', 'hand']
+
+
+def make_synthetic_data(data_dir, num_frames=32, people_per_frame=4, img_size=(1280, 720), seed=0):
+    """PNG frames and labels with the fields and shapes of the BEDLAM scene npz files."""
+    rng = np.random.RandomState(seed)
+    npz_file = os.path.join(data_dir, 'labels', f'{DATASET_NAME}.npz')
+    if os.path.exists(npz_file):
+        logger.info(f'Using the synthetic data in {data_dir}')
+        return npz_file
+
+    img_w, img_h = img_size
+    os.makedirs(os.path.join(data_dir, 'png', 'seq_000000'), exist_ok=True)
+    os.makedirs(os.path.dirname(npz_file), exist_ok=True)
+    imgname = []
+    for frame in range(num_frames):
+        # Smooth content with noise, compresses like a rendered frame rather than like pure noise
+        img = cv2.resize(rng.randint(0, 255, (img_h // 16, img_w // 16, 3), dtype=np.uint8), (img_w, img_h))
+        img = cv2.add(img, rng.randint(0, 16, img.shape, dtype=np.uint8))
+        fn = os.path.join('seq_000000', f'seq_000000_{frame:04d}.png')
+        cv2.imwrite(os.path.join(data_dir, 'png', fn), img)
+        imgname += [fn] * people_per_frame
+
+    n = len(imgname)
+    scale = rng.uniform(1.5, 4., n).astype(np.float32)
+    center = np.stack([rng.uniform(200, img_w - 200, n), rng.uniform(200, img_h - 200, n)], 1).astype(np.float32)
+    cam_int = np.tile(np.array([[1500., 0., img_w / 2.], [0., 1500., img_h / 2.], [0., 0., 1.]]), (n, 1, 1))
+    cam_ext = np.tile(np.eye(4), (n, 1, 1))
+    gtkps = np.concatenate([center[:, None] + rng.uniform(-100, 100, (n, 127, 2)), np.ones((n, 127, 1))], -1)
+    labels = {
+        'imgname': np.array(imgname),
+        'center': center,
+        'scale': scale,
+        'pose_cam': rng.normal(0, 0.2, (n, 165)).astype(np.float32),
+        'shape': rng.normal(0, 1, (n, 11)).astype(np.float32),
+        'cam_int': cam_int.astype(np.float32),
+        'cam_ext': cam_ext.astype(np.float32),
+        'trans_cam': rng.normal(0, 1, (n, 3)).astype(np.float32),
+        'gtkps': gtkps.astype(np.float32),
+        'proj_verts': np.concatenate([center[:, None] + rng.uniform(-100, 100, (n, 437, 2)),
+                                      np.ones((n, 437, 1))], -1).astype(np.float32),
+        'gender': np.array(['neutral'] * n),
+    }
+    np.savez(npz_file, **labels)
+
+    # Hands labels, read by datasetx.py and dataset_hand.py
+    hands = dict(labels)
+    hands.update({
+        'left_hand': np.ones(n, dtype=bool),
+        'right_hand': np.ones(n, dtype=bool),
+        'center_hand': (center[:, None] + rng.uniform(-50, 50, (n, 2, 2))).astype(np.float32),
+        'scale_hand': rng.uniform(0.3, 0.8, (n, 2)).astype(np.float32),
+        'right_hand_abs_pose': rng.normal(0, 0.2, (n, 48)).astype(np.float32),
+    })
+    np.savez(npz_file.replace('.npz', '-hands.npz'), **hands)
+    logger.info(f'Wrote {num_frames} synthetic frames with {n} people to {data_dir}')
+    return npz_file
+
+
+def register_dataset(data_dir, npz_file):
+    config.DATASET_FOLDERS[DATASET_NAME] = os.path.join(data_dir, 'png')
+    config.DATASET_FILES[1][DATASET_NAME] = npz_file
+
+
+def build_dataset(name, options):
+    if name == 'hmr':
+        from train.dataset.dataset import DatasetHMR
+        return DatasetHMR(options, DATASET_NAME, is_train=True)
+    elif name == 'hmrx':
+        from train.dataset.datasetx import DatasetHMR
+        return DatasetHMR(options, DATASET_NAME, is_train=True)
+    from train.dataset.dataset_hand import DatasetHand
+    return DatasetHand(options, DATASET_NAME, is_train=True)
+
+
+def time_stages(name, ds, num_samples):
+    """
+    Per-sample time of every stage of __getitem__, in the main process. The stage
+    functions are wrapped with OpTimer, 'rest' is the time not spent in any of them.
+    """
+    module = sys.modules[type(ds).__module__]
+    stages = {'decode': ('module', 'read_img'), 'crop': ('ds', 'crop_fn'), 'keypoints': ('ds', 'j2d_processing'),
+              'normalize': ('ds', 'normalize_img')}
+    if getattr(ds, 'augmentation', None) is not None:
+        stages['augmentation'] = ('ds', 'augmentation')
+
+    originals, timers = {}, {}
+    for stage, (owner, attr) in stages.items():
+        obj = module if owner == 'module' else ds
+        originals[stage] = (obj, attr, getattr(obj, attr))
+        timers[stage] = OpTimer(getattr(obj, attr))
+        setattr(obj, attr, timers[stage])
+
+    total = OpTimer(ds.__getitem__)
+    try:
+        # The first sample includes lazy initialisation
+        ds[0]
+        for t in timers.values():
+            t.calls, t.seconds = 0, 0.
+        for i in range(num_samples):
+            total(i % len(ds))
+    finally:
+        for obj, attr, fn in originals.values():
+            # Instance attributes are removed again, module functions restored
+            if obj is ds and attr in type(ds).__dict__:
+                delattr(ds, attr)
+            else:
+                setattr(obj, attr, fn)
+
+    report = {stage: {'calls': t.calls, 'ms_per_sample': 1000. * t.seconds / num_samples}
+              for stage, t in timers.items()}
+    total_ms = 1000. * total.seconds / num_samples
+    report['rest'] = {'calls': num_samples, 'ms_per_sample': total_ms - sum(r['ms_per_sample'] for r in report.values())}
+    report['total'] = {'calls': num_samples, 'ms_per_sample': total_ms}
+    logger.info(f'{name}: ' + ', '.join(f'{k} {v["ms_per_sample"]:.2f}ms' for k, v in report.items()))
+    return report
+
+
+def time_loader(name, ds, batch_size, num_workers, num_batches):
+    """Batch times of a DataLoader, the first batch (worker start up) is reported separately."""
+    loader = DataLoader(ds, batch_size=batch_size, shuffle=True, num_workers=num_workers, drop_last=True)
+    batch_ms = []
+    start = time.perf_counter()
+    first_batch_ms = None
+    for i, _ in enumerate(loader):
+        now = time.perf_counter()
+        if first_batch_ms is None:
+            first_batch_ms = 1000. * (now - start)
+        else:
+            batch_ms.append(1000. * (now - start))
+        start = now
+        if i + 1 >= num_batches:
+            break
+    batch_ms = np.array(batch_ms) if len(batch_ms) > 0 else np.array([first_batch_ms])
+    report = {
+        'first_batch_ms': first_batch_ms,
+        'batch_ms_mean': float(batch_ms.mean()),
+        'batch_ms_p50': float(np.percentile(batch_ms, 50)),
+        'batch_ms_p95': float(np.percentile(batch_ms, 95)),
+        'samples_per_s': float(1000. * batch_size / batch_ms.mean()),
+    }
+    logger.info(f'{name} with {num_workers} workers: {report["samples_per_s"]:.1f} samples/s, '
+                f'{report["batch_ms_mean"]:.1f}ms per batch')
+    return report
+
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'opencv': cv2.__version__,
+        'cpu_count': os.cpu_count(),
+        'platform': platform.platform(),
+    }
+
+
+def compare(report, old_report):
+    """Relative change of every timing, positive is slower."""
+    for name, ds_report in report['datasets'].items():
+        old = old_report['datasets'].get(name)
+        if old is None or 'error' in ds_report or 'error' in old:
+            continue
+        for stage, r in ds_report['stages'].items():
+            if stage in old['stages'] and old['stages'][stage]['ms_per_sample'] > 0:
+                change = r['ms_per_sample'] / old['stages'][stage]['ms_per_sample'] - 1
+                logger.info(f'{name} {stage}: {old["stages"][stage]["ms_per_sample"]:.2f}ms -> '
+                            f'{r["ms_per_sample"]:.2f}ms ({100 * change:+.1f}%)')
+        for workers, r in ds_report['loader'].items():
+            if workers in old['loader']:
+                change = r['samples_per_s'] / old['loader'][workers]['samples_per_s'] - 1
+                logger.info(f'{name} {workers} workers: {old["loader"][workers]["samples_per_s"]:.1f} -> '
+                            f'{r["samples_per_s"]:.1f} samples/s ({100 * change:+.1f}%)')
+
+
+def main(args):
+    torch.set_num_threads(1)
+    np.random.seed(args.seed)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bedlam_bench_')
+    npz_file = make_synthetic_data(data_dir, args.num_frames, args.people_per_frame, tuple(args.img_size), args.seed)
+    register_dataset(data_dir, npz_file)
+
+    hparams = get_hparams_defaults()
+    if args.cfg:
+        hparams.merge_from_file(args.cfg)
+    options = hparams.DATASET
+    options.ALB = args.alb
+    options.CROP_ENGINE = args.crop_engine
+    options.CROP_PERCENT = 1.0
+    # The synthetic frames are decoded and cropped every time
+    options.CROP_SHARDS = ''
+    options.LABEL_STORE = ''
+    options.GPU_CROP = False
+    options.IMAGE_CACHE_GB = 0.
+
+    report = {
+        'environment': get_environment(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ['out', 'compare']},
+        'datasets': {},
+    }
+    for name in args.datasets:
+        try:
+            ds = build_dataset(name, options)
+        except Exception as E:
+            # e.g. the MANO model of DatasetHand is not available
+            logger.warning(f'Skipping {name}: {E}')
+            report['datasets'][name] = {'error': f'{type(E).__name__}: {E}'}
+            continue
+        report['datasets'][name] = {
+            'stages': time_stages(name, ds, args.num_samples),
+            'loader': {str(w): time_loader(name, ds, args.batch_size, w, args.num_batches) for w in args.workers},
+        }
+
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f'Saved the benchmark report to {args.out}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', type=str, default='data_pipeline_benchmark.json', help='json report')
+    parser.add_argument('--compare', type=str, default=None, help='older report to compare against')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='folder of the synthetic data, reused if it exists. A temporary folder by default')
+    parser.add_argument('--cfg', type=str, default=None, help='optional config for the DATASET options')
+    parser.add_argument('--datasets', type=str, nargs='+', default=DATASETS, choices=DATASETS)
+    parser.add_argument('--num_frames', type=int, default=32)
+    parser.add_argument('--people_per_frame', type=int, default=4)
+    parser.add_argument('--img_size', type=int, nargs=2, default=[1280, 720], help='width height')
+    parser.add_argument('--num_samples', type=int, default=64, help='samples timed per stage')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_batches', type=int, default=10, help='batches timed per worker count')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--alb', action='store_true', help='enable the albumentations pipeline')
+    parser.add_argument('--crop_engine', type=str, default='skimage')
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -2,15 +2,20 @@ import argparse
 import sys
 import logging
 import os
+import zipfile
+import multiprocessing as mp
+from collections import Counter, defaultdict
 
 from glob import glob
 import numpy as np
 import pickle
-import zipfile
 
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Keys of the compact single-file format, an .npz with one row per predicted person
+COMPACT_KEYS = ['imgname', 'personId', 'verts', 'allSmplJoints3d', 'joints']
+
 
 def assert_type(var, gt_type, key):
     if not isinstance(var, gt_type):
@@ -22,9 +27,9 @@ def assert_shape(var, gt_shape, key):
         raise ValueError('{} should be of shape {} but you are providing {}'.format(key, gt_shape, var.shape))
 
 
-def check_smplx(pred_file):
-    pred_param = pickle.load(open(pred_file, 'rb'), encoding='latin1')
-        
+def check_smplx_param(pred_param):
+    """Checks one prediction dictionary, returns the list of warnings."""
+    warnings = []
     if 'allSmplJoints3d' in pred_param.keys() and 'verts' in pred_param.keys():
         joints3d = pred_param['allSmplJoints3d'].squeeze()
         verts3d = pred_param['verts'].squeeze()
@@ -36,19 +41,153 @@ def check_smplx(pred_file):
         if len(joints3d.shape) != 2 or joints3d.shape[1] != 3 or joints3d.shape[0] < 127:
             raise ValueError('joints should be of shape (127,3) but you ar providing {}'.format(joints3d.shape))
         if joints3d.shape[0] > 127:
-            logging.warning(' Only first 127 3d joints will be used for body, hands and face evaluation but you are providing {} joints'.format(joints3d.shape[0]))
+            warnings.append(' Only first 127 3d joints will be used for body, hands and face evaluation but you are providing {} joints'.format(joints3d.shape[0]))
 
     else:
         raise KeyError('allSMPLJoints3d and verts needs to be provided in key. Please check the ReadMe for details and run the evaluation code on github')
 
-    assert 'joints' in pred_param.keys()
+    if 'joints' not in pred_param.keys():
+        raise KeyError('joints needs to be provided in key')
     joints = pred_param['joints']
     assert_type(pred_param['joints'], np.ndarray, 'joints')
     # Only first 24 joints will be used for matching
     if len(joints.shape) != 2 or joints.shape[1] < 2 or joints.shape[0] < 24:
         raise ValueError('joints should be of shape (24,2) but you are providing {}'.format(joints.shape))
     if joints.shape[0] > 24:
-        logging.warning(' Only first 24 projected joints in joints key will be used in matching but you are providing {} joints'.format(joints.shape[0]))
+        warnings.append(' Only first 24 projected joints in joints key will be used in matching but you are providing {} joints'.format(joints.shape[0]))
+    return warnings
+
+
+def check_smplx(pred_file):
+    pred_param = pickle.load(open(pred_file, 'rb'), encoding='latin1')
+    for warning in check_smplx_param(pred_param):
+        logging.warning(warning)
+
+
+# Zip opened once by every worker process
+_zip_file = None
+
+
+def _open_zip(path_to_zip_file):
+    global _zip_file
+    _zip_file = zipfile.ZipFile(path_to_zip_file, 'r')
+
+
+def _check_member(name):
+    """Returns (name, error type, message, warnings), error type is None if the file is valid."""
+    try:
+        pred_param = pickle.loads(_zip_file.read(name), encoding='latin1')
+        return name, None, None, check_smplx_param(pred_param)
+    except Exception as E:
+        return name, type(E).__name__, str(E), []
+
+
+def get_pred_members(zip_ref):
+    # Files directly in the top level predictions/ folder, like the extracted zip check
+    return [info.filename for info in zip_ref.infolist()
+            if not info.is_dir() and os.path.dirname(info.filename) == 'predictions']
+
+
+def check_zip(path_to_zip_file, num_workers=None, chunksize=64):
+    """
+    Checks the pickle files of predictions/ directly from the zip, in parallel worker processes.
+    Returns {error type: [(file name, message)]}.
+    """
+    with zipfile.ZipFile(path_to_zip_file, 'r') as zip_ref:
+        members = get_pred_members(zip_ref)
+    if len(members) == 0:
+        raise EOFError('No files are present inside zip')
+
+    failures = defaultdict(list)
+    warnings = Counter()
+    num_workers = num_workers or os.cpu_count()
+    with mp.Pool(num_workers, initializer=_open_zip, initargs=(path_to_zip_file,)) as pool:
+        for i, (name, error, message, file_warnings) in enumerate(
+                pool.imap_unordered(_check_member, members, chunksize=chunksize)):
+            if error is not None:
+                failures[error].append((name, message))
+            warnings.update(file_warnings)
+            if (i + 1) % 10000 == 0:
+                logging.info('Checked {}/{} files'.format(i + 1, len(members)))
+
+    for warning, count in warnings.items():
+        logging.warning('{} ({} files)'.format(warning, count))
+    logging.info('Checked {} files from {}'.format(len(members), path_to_zip_file))
+    return failures
+
+
+def read_npz_shapes(pred_file):
+    """Shapes and dtypes of the arrays of an .npz, read from the headers without loading the data."""
+    shapes = {}
+    with zipfile.ZipFile(pred_file, 'r') as npz:
+        for name in npz.namelist():
+            with npz.open(name) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+            shapes[name[:-len('.npy')]] = (shape, dtype)
+    return shapes
+
+
+def check_compact(pred_files):
+    """
+    Checks predictions in the compact format: .npz files with the arrays
+    imgname (N,), personId (N,), verts (N, 10475, 3), allSmplJoints3d (N, >=127, 3) and joints (N, >=24, 2).
+    Returns {error type: [(file name, message)]}.
+    """
+    failures = defaultdict(list)
+    seen = set()
+    num_predictions = 0
+    for pred_file in pred_files:
+        shapes = read_npz_shapes(pred_file)
+        missing = [k for k in COMPACT_KEYS if k not in shapes]
+        if missing:
+            failures['KeyError'].append((pred_file, '{} needs to be provided'.format(missing)))
+            continue
+        if len(shapes['imgname'][0]) != 1:
+            failures['ValueError'].append((pred_file, 'imgname should be 1D, not {}'.format(shapes['imgname'][0])))
+            continue
+        n = shapes['imgname'][0][0]
+        expected = {
+            'personId': lambda s: s == (n,),
+            'verts': lambda s: s == (n, 10475, 3),
+            'allSmplJoints3d': lambda s: len(s) == 3 and s[0] == n and s[1] >= 127 and s[2] == 3,
+            'joints': lambda s: len(s) == 3 and s[0] == n and s[1] >= 24 and s[2] >= 2,
+        }
+        for key, valid in expected.items():
+            shape, dtype = shapes[key]
+            if not valid(shape):
+                failures['ValueError'].append((pred_file, '{} has shape {} for {} predictions'.format(key, shape, n)))
+            elif key != 'personId' and dtype.kind != 'f':
+                failures['TypeError'].append((pred_file, '{} should be floating point, not {}'.format(key, dtype)))
+
+        # Only the small index arrays are loaded
+        with np.load(pred_file) as data:
+            ids = list(zip(data['imgname'].astype(str).tolist(), data['personId'].tolist()))
+        counts = Counter(ids)
+        duplicates = seen.intersection(counts)
+        duplicates.update(k for k, count in counts.items() if count > 1)
+        if len(duplicates) > 0:
+            failures['DuplicateError'].append((pred_file, 'duplicate image/person ids, e.g. {}'.format(
+                min(duplicates))))
+        seen.update(ids)
+        num_predictions += n
+
+    if num_predictions == 0 and not failures:
+        raise EOFError('No predictions are present in {}'.format(pred_files))
+    logging.info('Checked {} predictions from {} files'.format(num_predictions, len(pred_files)))
+    return failures
+
+
+def log_failures(failures, max_examples=5):
+    if not failures:
+        return
+    for error, files in sorted(failures.items(), key=lambda x: -len(x[1])):
+        logging.error('{}: {} files'.format(error, len(files)))
+        for name, message in files[:max_examples]:
+            logging.error('    {}: {}'.format(name, message))
 
 
 def check_pred_file(*args):
@@ -58,23 +197,35 @@ def check_pred_file(*args):
     parser = argparse.ArgumentParser()
     parser.add_argument('--predZip', type=str,
                         default='')
+    parser.add_argument('--predFile', type=str, nargs='+', default=[],
+                        help='prediction files in the compact .npz format, instead of --predZip')
     parser.add_argument('--extractZipFolder', type=str,
-                        default='')
+                        default='', help='extract the zip here and check the files one by one (old behaviour)')
+    parser.add_argument('--numWorkers', type=int, default=None)
 
     args = parser.parse_args(*args)
-    path_to_zip_file = args.predZip
-    with zipfile.ZipFile(path_to_zip_file, 'r') as zip_ref:
-        zip_ref.extractall(args.extractZipFolder)
-
-    all_files = glob(os.path.join(args.extractZipFolder, 'predictions', '*'))
-    if len(all_files) == 0:
-        raise EOFError('No files are present inside zip')
+    if len(args.predFile) > 0:
+        failures = check_compact(args.predFile)
+    elif args.extractZipFolder:
+        with zipfile.ZipFile(args.predZip, 'r') as zip_ref:
+            zip_ref.extractall(args.extractZipFolder)
+
+        all_files = glob(os.path.join(args.extractZipFolder, 'predictions', '*'))
+        if len(all_files) == 0:
+            raise EOFError('No files are present inside zip')
+
+        for pred_file in all_files:
+            logging.info('Reading file {}'.format(pred_file))
+            check_smplx(pred_file)
+        failures = {}
+    else:
+        failures = check_zip(args.predZip, args.numWorkers)
 
-    for pred_file in all_files:
-        logging.info('Reading file {}'.format(pred_file))
-        check_smplx(pred_file)
+    log_failures(failures)
+    return failures
 
 
 if __name__ == '__main__':
-    check_pred_file(sys.argv[1:])
-    logging.info('If you reach here then your zip folder is ready to submit')
\ No newline at end of file
+    if check_pred_file(sys.argv[1:]):
+        sys.exit(1)
+    logging.info('If you reach here then your zip folder is ready to submit')
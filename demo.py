@@ -23,7 +23,9 @@ def main(args):
     logger.info(f'Demo options: \n {args}')
 
     tester = Tester(args)
-    if args.eval_dataset == 'hbw':
+    if args.video is not None:
+        tester.run_on_video(args.video, output_path, args.display)
+    elif args.eval_dataset == 'hbw':
         all_image_folder = glob(os.path.join(input_image_folder, 'images', args.data_split + '_small_resolution', '*', '*'))
         all_bbox_folder = glob(os.path.join('data/test_images/hbw_test_images_bbox', '*', '*','labels'))
         tester.load_yolov5_bboxes(all_bbox_folder)
@@ -54,12 +56,30 @@ if __name__ == '__main__':
     parser.add_argument('--image_folder', type=str, default='demo_images',
                         help='input image folder')
 
+    parser.add_argument('--video', type=str, default=None,
+                        help='input video file, stream url or camera index, instead of --image_folder')
+
     parser.add_argument('--output_folder', type=str, default='demo_images/results',
                         help='output folder to write results')
 
     parser.add_argument('--tracker_batch_size', type=int, default=1,
                         help='batch size of object detector used for bbox tracking')
                         
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='number of person crops per forward, crops of consecutive images are batched together')
+
+    parser.add_argument('--num_readers', type=int, default=4,
+                        help='threads decoding the images ahead of the model')
+
+    parser.add_argument('--num_crop_workers', type=int, default=2,
+                        help='threads cropping the detections ahead of the model')
+
+    parser.add_argument('--num_writers', type=int, default=2,
+                        help='threads rendering and writing the results')
+
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='number of images buffered between the stages of the inference pipeline')
+
     parser.add_argument('--display', action='store_true',
                         help='visualize the 3d body projection on image')
 
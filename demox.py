@@ -4,6 +4,7 @@ import argparse
 from loguru import logger
 from glob import glob
 from train.core.testerx import Tester
+from train.utils.pred_writer import export_legacy_zip
 
 os.environ['PYOPENGL_PLATFORM'] = 'egl'
 sys.path.append('')
@@ -22,19 +23,29 @@ def main(args):
     logger.info(f'Demo options: \n {args}')
 
     tester = Tester(args)
-    if args.eval_dataset == 'bedlam':
+    if args.video is not None:
+        tester.run_on_video(args.video, output_path, args.display)
+    elif args.eval_dataset == 'bedlam':
         all_image_folder = glob(os.path.join(input_image_folder, '*', 'png', '*'))
         detections = tester.run_detector(all_image_folder)
-        tester.run_on_image_folder(all_image_folder, detections, output_path, args.display, args.save_result, args.eval_dataset)
+        tester.run_on_image_folder(all_image_folder, detections, output_path, args.display, args.save_result, args.eval_dataset,
+                                   args.save_format)
     elif args.eval_dataset == 'agora':
         all_image_folder = [input_image_folder]
         detections = tester.run_detector(all_image_folder)
-        tester.run_on_image_folder(all_image_folder, detections, output_path, args.display, args.save_result, args.eval_dataset)
+        tester.run_on_image_folder(all_image_folder, detections, output_path, args.display, args.save_result, args.eval_dataset,
+                                   args.save_format)
     else:
         all_image_folder = [input_image_folder]
         detections = tester.run_detector(all_image_folder)
         tester.run_on_image_folder(all_image_folder, detections, output_path, args.display, args.save_result)
 
+    if args.submission_zip is not None:
+        if not args.save_result or args.save_format != 'compact':
+            logger.error('--submission_zip needs --save_result --save_format compact')
+        else:
+            export_legacy_zip(os.path.join(output_path, 'predictions'), args.submission_zip)
+
     del tester.model
 
     logger.info('================= END =================')
@@ -52,12 +63,30 @@ if __name__ == '__main__':
     parser.add_argument('--image_folder', type=str, default='demo_images',
                         help='input image folder')
 
+    parser.add_argument('--video', type=str, default=None,
+                        help='input video file, stream url or camera index, instead of --image_folder')
+
     parser.add_argument('--output_folder', type=str, default='demo_images/results',
                         help='output folder to write results')
 
     parser.add_argument('--tracker_batch_size', type=int, default=1,
                         help='batch size of object detector used for bbox tracking')
                         
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='number of person crops per forward, crops of consecutive images are batched together')
+
+    parser.add_argument('--num_readers', type=int, default=4,
+                        help='threads decoding the images ahead of the model')
+
+    parser.add_argument('--num_crop_workers', type=int, default=2,
+                        help='threads cropping the detections ahead of the model')
+
+    parser.add_argument('--num_writers', type=int, default=2,
+                        help='threads rendering and writing the results')
+
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='number of images buffered between the stages of the inference pipeline')
+
     parser.add_argument('--display', action='store_true',
                         help='visualize the 3d body projection on image')
 
@@ -70,6 +99,13 @@ if __name__ == '__main__':
     parser.add_argument('--dataframe_path', type=str, default=None)
     parser.add_argument('--data_split', type=str, default='test')
     parser.add_argument('--save_result', action='store_true', help='Save verts, joints, joints2d in pkl file to evaluate')
+    parser.add_argument('--save_format', type=str, default='pickle', choices=['pickle', 'compact'],
+                        help='one pkl file per person or chunked npz files in output_folder/predictions')
+    parser.add_argument('--save_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='dtype of the vertices and joints in the compact format, float16 rounds them to a '
+                             '4-8 mm grid at the 4-16 m camera distances of AGORA')
+    parser.add_argument('--submission_zip', type=str, default=None,
+                        help='export the compact predictions to this zip with one pkl file per person')
 
     args = parser.parse_args()
     main(args)
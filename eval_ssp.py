@@ -1,45 +1,76 @@
-import numpy as np
-import pickle
 import os
-import torch
 import sys
+import time
+import pickle
+import argparse
+import numpy as np
+import torch
+from loguru import logger
 from smplx import SMPL
 
 # Evaluation code from https://github.com/akashsengupta1997/SSP-3D
 SMPL_MODEL_DIR = '/ps/project/alignment/models/smpl'
-def compute_pve_neutral_pose_scale_corrected(predicted_smpl_shape, target_smpl_shape, gender):
-    """
-    Given predicted and target SMPL shape parameters, computes neutral-pose per-vertex error
-    after scale-correction (to account for scale vs camera depth ambiguity).
-    :param predicted_smpl_parameters: predicted SMPL shape parameters tensor with shape (1, 10)
-    :param target_smpl_parameters: target SMPL shape parameters tensor with shape (1, 10)
-    :param gender: gender of target
-    """
-    smpl_male = SMPL(SMPL_MODEL_DIR, batch_size=1, gender='male')
-    smpl_female = SMPL(SMPL_MODEL_DIR, batch_size=1, gender='female')
 
-    # Get neutral pose vertices
-    if gender == 'm':
-        pred_smpl_neutral_pose_output = smpl_male(betas=predicted_smpl_shape)
-        target_smpl_neutral_pose_output = smpl_male(betas=target_smpl_shape)
-    elif gender == 'f':
-        pred_smpl_neutral_pose_output = smpl_female(betas=predicted_smpl_shape)
-        target_smpl_neutral_pose_output = smpl_female(betas=target_smpl_shape)
 
-    pred_smpl_neutral_pose_vertices = pred_smpl_neutral_pose_output.vertices
-    target_smpl_neutral_pose_vertices = target_smpl_neutral_pose_output.vertices
+class SSPEvaluator:
+    """
+    Batched PVE-T-SC evaluation. The male and female SMPL models are loaded once,
+    the neutral pose meshes of all samples of a gender are computed in batches.
+    """
+    def __init__(self, model_dir=SMPL_MODEL_DIR, batch_size=512, device='cpu'):
+        self.batch_size = batch_size
+        self.device = device
+        self.smpl = {
+            'm': SMPL(model_dir, gender='male').to(device),
+            'f': SMPL(model_dir, gender='female').to(device),
+        }
 
-    # Rescale such that RMSD of predicted vertex mesh is the same as RMSD of target mesh.
-    # This is done to combat scale vs camera depth ambiguity.
-    pred_smpl_neutral_pose_vertices_rescale = scale_and_translation_transform_batch(pred_smpl_neutral_pose_vertices,
-                                                                                    target_smpl_neutral_pose_vertices)
+    @torch.no_grad()
+    def neutral_pose_vertices(self, betas, gender):
+        """
+        :param betas: (N, 10) SMPL shape parameters
+        :param gender: 'm' or 'f'
+        :return: (N, 6890, 3) vertices in the zero pose
+        """
+        smpl = self.smpl[gender]
+        vertices = []
+        for start in range(0, len(betas), self.batch_size):
+            b = betas[start:start + self.batch_size].to(self.device)
+            # Explicit zero poses of the batch size, the model defaults have a batch size of 1
+            out = smpl(betas=b, global_orient=b.new_zeros(len(b), 3), body_pose=b.new_zeros(len(b), 69))
+            vertices.append(out.vertices)
+        return torch.cat(vertices)
 
-    # Compute PVE-T-SC
-    pve_neutral_pose_scale_corrected = np.linalg.norm(pred_smpl_neutral_pose_vertices_rescale
-                                                      - target_smpl_neutral_pose_vertices.detach().cpu().numpy(),
-                                                      axis=-1)  # (1, 6890)
+    @torch.no_grad()
+    def compute_pve_neutral_pose_scale_corrected(self, predicted_smpl_shape, target_smpl_shape, gender):
+        """
+        Given predicted and target SMPL shape parameters, computes neutral-pose per-vertex error
+        after scale-correction (to account for scale vs camera depth ambiguity).
+        :param predicted_smpl_shape: predicted SMPL shape parameters, shape (N, 10)
+        :param target_smpl_shape: target SMPL shape parameters, shape (N, 10)
+        :param gender: (N,) gender of the targets, 'm' or 'f'
+        :return: (N, 6890) per-vertex errors
+        """
+        predicted_smpl_shape = torch.as_tensor(predicted_smpl_shape, dtype=torch.float32)
+        target_smpl_shape = torch.as_tensor(target_smpl_shape, dtype=torch.float32)
+        gender = np.asarray(gender).astype(str)
+        unknown = ~np.isin(gender, ['m', 'f'])
+        if unknown.any():
+            # The per-sample evaluation had no model for them either, a zero row would lower the mean
+            raise ValueError(f'{unknown.sum()} samples have an unknown gender: {sorted(set(gender[unknown].tolist()))}')
 
-    return pve_neutral_pose_scale_corrected
+        pve = torch.zeros(len(gender), 6890)
+        for g in ['m', 'f']:
+            idx = np.flatnonzero(gender == g)
+            if len(idx) == 0:
+                continue
+            pred_vertices = self.neutral_pose_vertices(predicted_smpl_shape[idx], g)
+            target_vertices = self.neutral_pose_vertices(target_smpl_shape[idx], g)
+            # Rescale such that RMSD of predicted vertex mesh is the same as RMSD of target mesh.
+            # This is done to combat scale vs camera depth ambiguity.
+            pred_vertices = scale_and_translation_transform_batch(pred_vertices, target_vertices)
+            pve[idx] = torch.norm(pred_vertices - target_vertices, dim=-1).cpu()
+        return pve.numpy()
 
 
 def scale_and_translation_transform_batch(P, T):
@@ -51,27 +82,58 @@ def scale_and_translation_transform_batch(P, T):
     :param T: (batch_size, N, 3) batch of N reference 3D meshes.
     :return: P transformed
     """
-    P = P.detach().cpu().numpy()
-    T = T.detach().cpu().numpy()
-    P_mean = np.mean(P, axis=1, keepdims=True)
+    P_mean = P.mean(dim=1, keepdim=True)
     P_trans = P - P_mean
-    P_scale = np.sqrt(np.sum(P_trans ** 2, axis=(1, 2), keepdims=True) / P.shape[1])
+    P_scale = torch.sqrt((P_trans ** 2).sum(dim=(1, 2), keepdim=True) / P.shape[1])
     P_normalised = P_trans / P_scale
 
-    T_mean = np.mean(T, axis=1, keepdims=True)
-    T_scale = np.sqrt(np.sum((T - T_mean) ** 2, axis=(1, 2), keepdims=True) / T.shape[1])
+    T_mean = T.mean(dim=1, keepdim=True)
+    T_scale = torch.sqrt(((T - T_mean) ** 2).sum(dim=(1, 2), keepdim=True) / T.shape[1])
+
+    return P_normalised * T_scale + T_mean
+
+
+def load_predictions(inp_path, num_samples):
+    """
+    Predicted betas (N, 10) of all samples, either from a folder of <index>.pkl files
+    or from a packed .npz file with a 'betas' array.
+    """
+    if os.path.isfile(inp_path):
+        betas = np.load(inp_path)['betas']
+        assert len(betas) == num_samples, f'{inp_path} has {len(betas)} predictions, expected {num_samples}'
+        return betas.reshape(num_samples, 10).astype(np.float32)
 
-    P_transformed = P_normalised * T_scale + T_mean
+    betas = np.zeros((num_samples, 10), dtype=np.float32)
+    for i in range(num_samples):
+        with open(os.path.join(inp_path, str(i) + '.pkl'), 'rb') as f:
+            pred = pickle.load(f)
+        b = pred['betas']
+        if torch.is_tensor(b):
+            b = b.detach().cpu().numpy()
+        betas[i] = np.asarray(b).reshape(-1)[:10]
+    return betas
 
-    return P_transformed
 
 if __name__ == '__main__':
-    df = np.load('data/ssp_3d_test.npz')
-    inp_path = sys.argv[1]
-    total_err=[]
-
-    for i in range(len(df['image'])):
-        pred = pickle.load(open(os.path.join(inp_path, str(i)+'.pkl'),'rb'))
-        err = compute_pve_neutral_pose_scale_corrected(pred['betas'].detach().cpu(),torch.tensor(df['shape'][i].reshape(-1,10)),df['gender'][i])
-        total_err.append(err.mean())
-    print('SSP-3D PVE-T-SC error:', np.array(total_err).mean()*1000)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inp_path', type=str, help='folder with <index>.pkl predictions or a packed .npz file')
+    parser.add_argument('--dataframe_path', type=str, default='data/ssp_3d_test.npz')
+    parser.add_argument('--model_dir', type=str, default=SMPL_MODEL_DIR, help='folder of the SMPL models')
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--pack', type=str, default=None,
+                        help='also save the predictions to this .npz file, to be used as inp_path later')
+    args = parser.parse_args(sys.argv[1:])
+
+    df = np.load(args.dataframe_path)
+    num_samples = len(df['image'])
+    start = time.time()
+    betas = load_predictions(args.inp_path, num_samples)
+    if args.pack is not None:
+        np.savez(args.pack, betas=betas)
+        logger.info(f'Saved packed predictions to {args.pack}')
+
+    evaluator = SSPEvaluator(args.model_dir, batch_size=args.batch_size, device=args.device)
+    err = evaluator.compute_pve_neutral_pose_scale_corrected(betas, df['shape'].reshape(-1, 10), df['gender'])
+    logger.info(f'Evaluated {num_samples} samples in {time.time() - start:.1f}s')
+    print('SSP-3D PVE-T-SC error:', err.mean(axis=-1).mean() * 1000)
@@ -0,0 +1,135 @@
+"""
+Evaluates a checkpoint on one of the DATASET_FILES test sets and saves the
+errors of every sample, e.g.
+
+    python evaluate.py --cfg configs/bedlam_cliff.yaml --ckpt data/ckpt/bedlam_cliff.ckpt --dataset 3dpw-test-cam \
+        --output results/3dpw.npz
+
+The output .npz has one column per metric (in mm, the same metrics as the
+validation of the trainer) and the columns imgname, dataset, seq (folder of the
+image), scale (bbox scale), gender and sub when the labels have it. Unlike the
+validation of the trainers no sample is dropped, the last batch is padded.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from loguru import logger
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from pytorch_lightning.utilities import move_data_to_device
+
+from train.core.config import DATASET_FILES
+from train.utils.train_utils import update_hparams, load_pretrained_model
+
+sys.path.append('.')
+
+MODELS = ['cliff', 'cliff_x', 'cliff_smpl']
+
+
+def get_trainer_class(model):
+    # Imported on demand, the trainers pull in different dependencies
+    if model == 'cliff':
+        from train.core.hmr_trainer import HMRTrainer
+        return HMRTrainer
+    elif model == 'cliff_x':
+        from train.core.smplx_trainer import SMPLXTrainer
+        return SMPLXTrainer
+    from train.core.hmr_trainer_smpl import HMRTrainer
+    return HMRTrainer
+
+
+def pad_collate(batch_size):
+    """The body models of the trainers have a fixed batch size, the last batch is padded with its last sample."""
+    def collate_fn(batch):
+        return default_collate(batch + [batch[-1]] * (batch_size - len(batch)))
+    return collate_fn
+
+
+def get_columns(ds):
+    """Per-sample labels saved next to the errors."""
+    num_samples = len(ds)
+    imgname = np.asarray(ds.imgname[:num_samples]).astype(str)
+    columns = {
+        'imgname': imgname,
+        'dataset': np.full(num_samples, ds.dataset),
+        'seq': np.array([os.path.dirname(fn) for fn in imgname]),
+        'scale': np.asarray(ds.scale[:num_samples], dtype=np.float32),
+        'gender': np.asarray(ds.gender[:num_samples]),
+    }
+    if 'sub' in ds.data:
+        sub = np.asarray(ds.data['sub'])
+        # The CLIFF-X datasets only keep the rows with detected hands
+        if hasattr(ds, 'hand_detect'):
+            sub = sub[ds.hand_detect]
+        columns['sub'] = sub[:num_samples].astype(str)
+    return columns
+
+
+@torch.no_grad()
+def evaluate(hparams, model_type, ckpt, dataset):
+    hparams.RUN_TEST = True
+    hparams.DATASET.VAL_DS = dataset
+    device = torch.device('cuda')
+
+    model = get_trainer_class(model_type)(hparams=hparams).to(device)
+    logger.info(f'Loading checkpoint {ckpt}')
+    load_pretrained_model(model, torch.load(ckpt, map_location='cpu')['state_dict'], overwrite_shape_mismatch=True)
+    model.eval()
+
+    ds = model.val_ds[0]
+    batch_size = hparams.DATASET.BATCH_SIZE
+    loader = DataLoader(
+        dataset=ds,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=hparams.DATASET.NUM_WORKERS,
+        pin_memory=True,
+        collate_fn=pad_collate(batch_size),
+    )
+
+    model.on_validation_epoch_start()
+    model.val_metrics.keep_samples = True
+    start = time.time()
+    for batch_idx, batch in enumerate(loader):
+        batch = move_data_to_device(batch, device)
+        model.validation_step(batch, batch_idx)
+        if (batch_idx + 1) % 50 == 0:
+            logger.info(f'{batch_idx + 1}/{len(loader)} batches')
+    logger.info(f'Evaluated {len(ds)} samples of {dataset} in {time.time() - start:.1f}s')
+
+    # The padding is at the end
+    errors = model.val_metrics.get_samples(dataset)
+    columns = get_columns(ds)
+    for metric, values in errors.items():
+        columns[metric] = 1000 * values[:len(ds)].numpy().astype(np.float32)
+    return columns
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, required=True, help='cfg file path')
+    parser.add_argument('--ckpt', type=str, required=True, help='checkpoint path')
+    parser.add_argument('--model', type=str, default='cliff', choices=MODELS,
+                        help='trainer of the checkpoint: cliff (train.py), cliff_x (trainx.py), cliff_smpl (train_smpl.py)')
+    parser.add_argument('--dataset', type=str, required=True, choices=list(DATASET_FILES[0].keys()))
+    parser.add_argument('--output', type=str, required=True, help='.npz file for the per-sample errors')
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--num_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    hparams = update_hparams(args.cfg)
+    if args.batch_size is not None:
+        hparams.DATASET.BATCH_SIZE = args.batch_size
+    if args.num_workers is not None:
+        hparams.DATASET.NUM_WORKERS = args.num_workers
+
+    columns = evaluate(hparams, args.model, args.ckpt, args.dataset)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    np.savez(args.output, **columns)
+    metrics = [k for k in columns if k not in ['imgname', 'dataset', 'seq', 'scale', 'gender', 'sub']]
+    for metric in metrics:
+        logger.info(f'{args.dataset} {metric}: {columns[metric].mean():.2f} mm')
+    logger.info(f'Saved per-sample errors to {args.output}')
@@ -0,0 +1,39 @@
+import sys
+import argparse
+from loguru import logger
+
+from train.core.config import DATASET_FILES, DATASET_FOLDERS
+from train.utils.crop_shards import write_crop_shard
+
+sys.path.append('.')
+
+
+def main(args):
+    datasets = args.datasets if args.datasets else list(DATASET_FILES[1].keys())
+    for dataset in datasets:
+        if dataset not in DATASET_FILES[1]:
+            logger.warning(f'{dataset} is not a training dataset, skipping')
+            continue
+        write_crop_shard(
+            label_file=DATASET_FILES[1][dataset],
+            img_dir=DATASET_FOLDERS[dataset],
+            out_dir=args.out_dir,
+            dataset=dataset,
+            margin=args.margin,
+            img_res=args.img_res,
+            # Same rotation as DatasetHMR applies to closeup training images
+            rotate='closeup' in dataset,
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--out_dir', type=str, default='data/crop_shards', help='output folder for the shards')
+    parser.add_argument('--datasets', type=str, nargs='*', help='datasets to convert, all training datasets by default')
+    parser.add_argument('--margin', type=float, default=1.5,
+                        help='context around the bbox, should cover 1 + SCALE_FACTOR')
+    parser.add_argument('--img_res', type=int, default=224, help='training image resolution')
+
+    args = parser.parse_args()
+    main(args)
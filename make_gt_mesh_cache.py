@@ -0,0 +1,33 @@
+import sys
+import argparse
+from loguru import logger
+
+from train.core.config import DATASET_FILES
+from train.utils.gt_mesh_cache import CONSUMERS, has_gt_mesh, write_gt_mesh_cache
+
+sys.path.append('.')
+
+
+def main(args):
+    datasets = args.datasets if args.datasets else list(DATASET_FILES[0].keys())
+    for dataset in datasets:
+        if dataset not in DATASET_FILES[0] or not has_gt_mesh(dataset):
+            logger.warning(f'{dataset} is not an evaluation dataset with GT meshes, skipping')
+            continue
+        for consumer in args.consumers:
+            write_gt_mesh_cache(args.out_dir, dataset, consumer, batch_size=args.batch_size, device=args.device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--out_dir', type=str, default='data/gt_mesh_cache', help='output folder for the cache')
+    parser.add_argument('--datasets', type=str, nargs='*', help='datasets to precompute, 3dpw and rich ones by default')
+    parser.add_argument('--consumers', type=str, nargs='*', default=CONSUMERS, choices=CONSUMERS,
+                        help='evaluation datasets to write the cache for, dataset (HMR, CLIFF-X) '
+                             'and dataset_smpl (CLIFF with SMPL) by default')
+    parser.add_argument('--batch_size', type=int, default=512, help='body model batch size')
+    parser.add_argument('--device', type=str, default='cpu', help='device to run the body models on')
+
+    args = parser.parse_args()
+    main(args)
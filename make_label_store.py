@@ -0,0 +1,33 @@
+import sys
+import argparse
+from loguru import logger
+
+from train.core.config import DATASET_FILES
+from train.utils.label_store import convert_npz_to_label_store, get_label_store_dir
+
+sys.path.append('.')
+
+
+def main(args):
+    for is_train in [0, 1]:
+        datasets = args.datasets if args.datasets else list(DATASET_FILES[is_train].keys())
+        for dataset in datasets:
+            if dataset not in DATASET_FILES[is_train]:
+                continue
+            try:
+                convert_npz_to_label_store(
+                    DATASET_FILES[is_train][dataset],
+                    get_label_store_dir(args.out_dir, dataset, is_train),
+                )
+            except FileNotFoundError as E:
+                logger.warning(f'Skipping {dataset}: {E}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--out_dir', type=str, default='data/label_store', help='output folder for the label stores')
+    parser.add_argument('--datasets', type=str, nargs='*', help='datasets to convert, all datasets by default')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,47 @@
+"""Duplicate ids of the compact format and the zip members which are checked."""
+import zipfile
+
+import numpy as np
+
+from check_pred_file_format import check_compact, get_pred_members
+
+
+def save_compact(path, imgnames, person_ids):
+    n = len(imgnames)
+    np.savez(path, imgname=np.array(imgnames), personId=np.array(person_ids, dtype=np.int32),
+             verts=np.zeros((n, 10475, 3), dtype=np.float32), allSmplJoints3d=np.zeros((n, 127, 3), dtype=np.float32),
+             joints=np.zeros((n, 24, 2), dtype=np.float32))
+    return str(path)
+
+
+def test_valid_files(tmp_path):
+    files = [save_compact(tmp_path / 'a.npz', ['a.png', 'a.png'], [0, 1]),
+             save_compact(tmp_path / 'b.npz', ['b.png'], [0])]
+    assert not check_compact(files)
+
+
+def test_duplicate_in_one_file(tmp_path):
+    # The first id is unique, the message has to name the repeated one
+    files = [save_compact(tmp_path / 'a.npz', ['a.png', 'b.png', 'c.png', 'b.png'], [0, 0, 0, 0])]
+    failures = check_compact(files)
+    assert list(failures) == ['DuplicateError']
+    assert failures['DuplicateError'][0][1].endswith("('b.png', 0)")
+
+
+def test_duplicate_across_files(tmp_path):
+    files = [save_compact(tmp_path / 'a.npz', ['a.png', 'b.png'], [0, 0]),
+             save_compact(tmp_path / 'b.npz', ['c.png', 'b.png'], [0, 0])]
+    failures = check_compact(files)
+    assert [name for name, _ in failures['DuplicateError']] == [files[1]]
+    assert failures['DuplicateError'][0][1].endswith("('b.png', 0)")
+
+
+def test_only_top_level_predictions(tmp_path):
+    zip_path = tmp_path / 'pred.zip'
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for name in ['predictions/a.pkl', 'predictions/b.pkl', 'backup/predictions/a.pkl',
+                     'predictions/old/c.pkl', 'readme.txt']:
+            zf.writestr(name, b'')
+        zf.writestr(zipfile.ZipInfo('predictions/sub/'), b'')
+    with zipfile.ZipFile(zip_path) as zf:
+        assert get_pred_members(zf) == ['predictions/a.pkl', 'predictions/b.pkl']
@@ -0,0 +1,56 @@
+"""CropBatcher batches across images and returns the images in the order they were added."""
+import torch
+
+from train.utils.crop_batcher import CropBatcher
+
+# Crops per image, images without detections as well
+NUM_CROPS = {'a': 0, 'b': 3, 'c': 0, 'd': 2, 'e': 2}
+
+
+def crops_of(key):
+    # The scale identifies the crop: image number * 10 + crop index
+    n = NUM_CROPS[key]
+    scale = 10. * 'abcde'.index(key) + torch.arange(n, dtype=torch.float32)
+    return torch.zeros(n, 3, 4, 4), torch.zeros(n, 2), scale, 640, 480
+
+
+def test_batches_and_completion_order():
+    batches = []
+
+    def forward(batch):
+        batches.append(batch)
+        # Outputs without a crop dimension are dropped
+        return {'scale': batch['bbox_scale'] * 2, 'loss': batch['bbox_scale'].sum()}
+
+    batcher = CropBatcher(forward, batch_size=4, device='cpu')
+    completed = {key: batcher.add(key, *crops_of(key), data=key.upper()) for key in NUM_CROPS}
+    completed['flush'] = batcher.flush()
+    order = {step: [key for key, _, _ in images] for step, images in completed.items()}
+    # a has no crops and is done at once, c waits for b, flush() returns d and e
+    assert order == {'a': ['a'], 'b': [], 'c': [], 'd': ['b', 'c'], 'e': [], 'flush': ['d', 'e']}
+
+    # The first batch holds the crops of b and the first one of d
+    assert len(batches) == 2
+    assert batches[0]['image_index'].tolist() == [0, 0, 0, 1]
+    assert batches[0]['images'] == ['B', 'D']
+    assert batches[0]['bbox_scale'].tolist() == [10., 11., 12., 30.]
+    assert batches[1]['image_index'].tolist() == [0, 1, 1]
+    assert batches[1]['images'] == ['D', 'E']
+    assert batches[0]['img_w'].tolist() == [640.] * 4
+
+    outputs = {key: (data, out) for images in completed.values() for key, data, out in images}
+    assert outputs['a'] == ('A', {})
+    assert outputs['c'] == ('C', {})
+    assert outputs['b'][0] == 'B'
+    assert list(outputs['b'][1]) == ['scale']
+    assert outputs['b'][1]['scale'].tolist() == [20., 22., 24.]
+    # d was split over both batches
+    assert outputs['d'][1]['scale'].tolist() == [60., 62.]
+    assert outputs['e'][1]['scale'].tolist() == [80., 82.]
+
+
+def test_flush_without_crops():
+    batcher = CropBatcher(lambda batch: {}, batch_size=4, device='cpu')
+    assert batcher.flush() == []
+    assert [key for key, _, _ in batcher.add('a', *crops_of('a'))] == ['a']
+    assert batcher.flush() == []
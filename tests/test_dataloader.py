@@ -0,0 +1,101 @@
+"""Mid-epoch resume of the training samplers, with the epoch counting of Lightning."""
+import pytest
+import torch
+
+from train.utils import dataloader
+from train.utils.dataloader import CheckpointDataLoader, MixingSampler, get_distributed_sampler
+
+
+def batches(loader):
+    return [batch.tolist() for batch in loader]
+
+
+def save_and_load(state, tmp_path):
+    path = tmp_path / 'loader.pt'
+    torch.save({'train_loader': state}, path)
+    return torch.load(path)['train_loader']
+
+
+def make_loader(checkpoint=None, shuffle=True):
+    return CheckpointDataLoader(list(range(42)), checkpoint=checkpoint, batch_size=4, shuffle=shuffle, seed=3,
+                                num_replicas=1, rank=0)
+
+
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_resume_mid_epoch(shuffle, tmp_path):
+    loader = make_loader(shuffle=shuffle)
+    loader.sampler.set_epoch(0)
+    epoch0 = batches(loader)
+    loader.sampler.set_epoch(1)
+    epoch1 = batches(loader)
+
+    loader = make_loader(shuffle=shuffle)
+    loader.sampler.set_epoch(0)
+    assert batches(loader)[:3] == epoch0[:3]
+    # Lightning saves current_epoch + 1 after 3 trained batches and restarts with set_epoch(1)
+    checkpoint = save_and_load(loader.state_dict(3, trainer_epoch=1), tmp_path)
+    resumed = make_loader(checkpoint, shuffle=shuffle)
+    resumed.sampler.set_epoch(1)
+    assert batches(resumed) == epoch0[3:]
+    # The next epoch of Lightning is the next permutation
+    resumed.sampler.set_epoch(2)
+    assert batches(resumed) == epoch1
+
+
+def test_resume_twice(tmp_path):
+    loader = make_loader()
+    loader.sampler.set_epoch(0)
+    epoch0 = batches(loader)
+
+    checkpoint = save_and_load(loader.state_dict(2, trainer_epoch=1), tmp_path)
+    resumed = make_loader(checkpoint)
+    resumed.sampler.set_epoch(1)
+    # Stopped again 3 batches after the first resume
+    checkpoint = save_and_load(resumed.state_dict(3, trainer_epoch=2), tmp_path)
+    assert checkpoint['batch_idx'] == 5
+    resumed = make_loader(checkpoint)
+    resumed.sampler.set_epoch(2)
+    assert batches(resumed) == epoch0[5:]
+
+
+def test_resume_end_of_epoch(tmp_path):
+    loader = make_loader()
+    loader.sampler.set_epoch(0)
+    loader.sampler.set_epoch(1)
+    epoch1 = batches(loader)
+
+    loader = make_loader()
+    loader.sampler.set_epoch(0)
+    num_batches = len(batches(loader))
+    checkpoint = save_and_load(loader.state_dict(num_batches, trainer_epoch=1), tmp_path)
+    assert checkpoint['dataset_perm'] is None
+    resumed = make_loader(checkpoint)
+    resumed.sampler.set_epoch(1)
+    assert batches(resumed) == epoch1
+
+
+def test_mixing_sampler_resume_mid_epoch(tmp_path):
+    sampler = MixingSampler([10, 30], [0.3, 0.7], num_samples=20, seed=3, num_replicas=1, rank=0)
+    sampler.set_epoch(0)
+    epoch0 = list(sampler)
+    sampler.set_epoch(1)
+    epoch1 = list(sampler)
+
+    sampler = MixingSampler([10, 30], [0.3, 0.7], num_samples=20, seed=3, num_replicas=1, rank=0)
+    sampler.set_epoch(0)
+    # 2 batches of 4 trained, Lightning saves current_epoch + 1 and restarts with set_epoch(1)
+    state = save_and_load(sampler.state_dict(8, batch_size=4, trainer_epoch=1), tmp_path)
+    resumed = MixingSampler([10, 30], [0.3, 0.7], num_samples=20, seed=0, num_replicas=1, rank=0)
+    resumed.load_state_dict(state)
+    resumed.set_epoch(1)
+    assert list(resumed) == epoch0[8:]
+    resumed.set_epoch(2)
+    assert list(resumed) == epoch1
+
+
+def test_distributed_sampler_shards_eval_loaders(monkeypatch):
+    assert get_distributed_sampler(list(range(10))) is None
+    monkeypatch.setattr(dataloader, 'get_dist_info', lambda: (2, 1))
+    sampler = get_distributed_sampler(list(range(10)))
+    # Every rank evaluates its own half, in order
+    assert list(sampler) == [1, 3, 5, 7, 9]
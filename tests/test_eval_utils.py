@@ -0,0 +1,154 @@
+"""Parity of the vectorized evaluation functions with the numpy and cv2 versions they replace."""
+import cv2
+import numpy as np
+import pytest
+import torch
+from scipy.spatial.transform import Rotation
+
+from train.core.constants import NUM_JOINTS_SMPLX
+from train.utils.eval_utils import (
+    SMPL_OR_JOINTS,
+    compute_similarity_transform_batch,
+    compute_similarity_transform_torch,
+    geodesic_angle,
+    geodesic_angle_torch,
+    joint_angle_error,
+    joint_angle_error_per_joint,
+    reconstruction_error,
+    reconstruction_error_torch,
+)
+
+
+def similar(S, rng):
+    """Random rotation, scale and translation of the (B, N, 3) points S."""
+    R = Rotation.random(len(S), random_state=rng.integers(1 << 31)).as_matrix()
+    scale = rng.uniform(0.5, 2., size=(len(S), 1, 1))
+    t = rng.normal(size=(len(S), 1, 3))
+    return scale * S @ R.transpose(0, 2, 1) + t
+
+
+def degenerate_batch(rng):
+    """S1, S2 of random, reflected, identical, planar and collinear pairs."""
+    S1 = rng.normal(size=(6, 24, 3))
+    S2 = rng.normal(size=(6, 24, 3))
+    # Mirror image, the unconstrained optimum is a reflection and Z has to flip it
+    S2[1] = similar(S1[1:2] * np.array([-1., 1., 1.]), rng)[0]
+    # Exact similarity transform and identical points, zero error
+    S2[2] = similar(S1[2:3], rng)[0]
+    S2[3] = S1[3]
+    # Planar and collinear S1, rank deficient K
+    S1[4, :, 2] = 0.
+    S1[5] = np.linspace(-1., 1., 24)[:, None] * np.array([1., 2., 3.])
+    return S1, S2
+
+
+@pytest.mark.parametrize('reduction', ['mean', 'sum', None])
+def test_reconstruction_error_torch_matches_numpy(reduction):
+    rng = np.random.default_rng(0)
+    S1 = rng.normal(size=(16, 24, 3))
+    S2 = similar(S1, rng) + 0.1 * rng.normal(size=S1.shape)
+    re, re_per_joint = reconstruction_error(S1, S2, reduction=reduction)
+    re_t, re_per_joint_t = reconstruction_error_torch(torch.from_numpy(S1), torch.from_numpy(S2), reduction=reduction)
+    np.testing.assert_allclose(re_t.numpy(), re, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(re_per_joint_t.numpy(), re_per_joint, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('dtype, atol', [(np.float64, 1e-10), (np.float32, 1e-5)])
+def test_similarity_transform_torch_degenerate(dtype, atol):
+    S1, S2 = degenerate_batch(np.random.default_rng(1))
+    S1, S2 = S1.astype(dtype), S2.astype(dtype)
+    S1_hat = compute_similarity_transform_batch(S1, S2)
+    S1_hat_t = compute_similarity_transform_torch(torch.from_numpy(S1), torch.from_numpy(S2))
+    assert S1_hat_t.dtype == torch.from_numpy(S1).dtype
+    np.testing.assert_allclose(S1_hat_t.numpy(), S1_hat, atol=atol)
+
+    _, re_per_joint = reconstruction_error(S1, S2, reduction=None)
+    _, re_per_joint_t = reconstruction_error_torch(torch.from_numpy(S1), torch.from_numpy(S2), reduction=None)
+    np.testing.assert_allclose(re_per_joint_t.numpy(), re_per_joint, atol=atol)
+    # The reflected pair is not aligned exactly, the similarity transforms are
+    assert re_per_joint[1].mean() > 0.1
+    np.testing.assert_allclose(re_per_joint_t.numpy()[2:4], 0., atol=10 * atol)
+
+
+def test_similarity_transform_torch_is_proper_rotation():
+    S1, S2 = degenerate_batch(np.random.default_rng(2))
+    S1_hat = compute_similarity_transform_torch(torch.from_numpy(S1), torch.from_numpy(S2)).numpy()
+    # Recover sR from the aligned points, det(sR) > 0 also for the mirrored pair
+    X1 = S1[:4] - S1[:4].mean(axis=1, keepdims=True)
+    X1_hat = S1_hat[:4] - S1_hat[:4].mean(axis=1, keepdims=True)
+    for i in range(4):
+        sR = np.linalg.lstsq(X1[i], X1_hat[i], rcond=None)[0]
+        assert np.linalg.det(sR) > 0
+
+
+def test_similarity_transform_torch_collapsed_points():
+    # A single point has no scale, both versions return nan instead of a made up alignment
+    rng = np.random.default_rng(3)
+    S1 = np.zeros((1, 24, 3))
+    S2 = rng.normal(size=(1, 24, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        _, re_per_joint = reconstruction_error(S1, S2, reduction=None)
+    _, re_per_joint_t = reconstruction_error_torch(torch.from_numpy(S1), torch.from_numpy(S2), reduction=None)
+    assert np.isnan(re_per_joint).all()
+    assert torch.isnan(re_per_joint_t).all()
+
+
+def random_rotations(shape, rng):
+    return Rotation.random(int(np.prod(shape)), random_state=rng.integers(1 << 31)).as_matrix().reshape(*shape, 3, 3)
+
+
+def rodrigues_angles(r1, r2):
+    """The former per matrix cv2.Rodrigues loop of joint_angle_error."""
+    r = np.matmul(r1.reshape(-1, 3, 3), r2.reshape(-1, 3, 3).transpose(0, 2, 1))
+    return np.array([np.linalg.norm(cv2.Rodrigues(m)[0]) for m in r]).reshape(r1.shape[:-2])
+
+
+def test_geodesic_angle_matches_rodrigues():
+    rng = np.random.default_rng(4)
+    r1 = random_rotations((8, 24), rng)
+    r2 = random_rotations((8, 24), rng)
+    # Small angles as well, these are the typical errors of a good model
+    r2[:4] = Rotation.from_rotvec(rng.normal(scale=0.05, size=(4 * 24, 3))).as_matrix().reshape(4, 24, 3, 3) @ r1[:4]
+    expected = rodrigues_angles(r1, r2)
+    np.testing.assert_allclose(geodesic_angle(r1, r2), expected, atol=1e-6)
+    np.testing.assert_allclose(geodesic_angle_torch(torch.from_numpy(r1), torch.from_numpy(r2)).numpy(), expected,
+                               atol=1e-6)
+    np.testing.assert_allclose(joint_angle_error(r1, r2), expected[:, SMPL_OR_JOINTS].mean(), atol=1e-6)
+
+
+@pytest.mark.parametrize('dtype, delta', [(np.float64, 1e-12), (np.float32, 1e-6)])
+def test_geodesic_angle_clamped(dtype, delta):
+    # Rounding pushes the trace argument just past 1 at the identity and just past -1 at a half turn
+    identity = np.eye(3)[None]
+    half_turn = np.diag([1., -1., -1.])[None]
+    r1 = (np.concatenate([identity, half_turn]) * (1. + delta)).astype(dtype)
+    r2 = np.concatenate([identity, identity]).astype(dtype)
+    expected = np.array([0., np.pi])
+
+    angles = geodesic_angle(r1, r2)
+    assert not np.isnan(angles).any()
+    np.testing.assert_allclose(angles, expected, atol=1e-6)
+
+    angles_t = geodesic_angle_torch(torch.from_numpy(r1), torch.from_numpy(r2))
+    assert not torch.isnan(angles_t).any()
+    np.testing.assert_allclose(angles_t.numpy(), expected, atol=1e-6)
+
+    # eps keeps the gradient finite at both ends
+    r1_t = torch.from_numpy(r1).requires_grad_()
+    geodesic_angle_torch(r1_t, torch.from_numpy(r2), eps=1e-6).sum().backward()
+    assert torch.isfinite(r1_t.grad).all()
+
+
+def test_joint_angle_error_per_joint_shape():
+    rng = np.random.default_rng(5)
+    pred = random_rotations((3, 55), rng)
+    gt = random_rotations((3, 55), rng)
+    errors = joint_angle_error_per_joint(pred, gt)
+    assert errors.shape == (3, NUM_JOINTS_SMPLX)
+    assert joint_angle_error_per_joint(pred, gt, joints=SMPL_OR_JOINTS).shape == (3, len(SMPL_OR_JOINTS))
+    assert joint_angle_error_per_joint(pred, gt, joints=None).shape == (3, 55)
+    np.testing.assert_allclose(errors, rodrigues_angles(pred, gt)[:, :NUM_JOINTS_SMPLX], atol=1e-6)
+
+    errors_t = joint_angle_error_per_joint(torch.from_numpy(pred), torch.from_numpy(gt))
+    assert errors_t.shape == (3, NUM_JOINTS_SMPLX)
+    np.testing.assert_allclose(errors_t.numpy(), errors, atol=1e-10)
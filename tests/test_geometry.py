@@ -0,0 +1,51 @@
+"""Batched camera translation estimation against the per-sample numpy version."""
+import numpy as np
+import pytest
+import torch
+
+from train.utils.geometry import estimate_translation_batch, estimate_translation_np
+
+
+def random_batch(B, J=24, seed=0):
+    rng = np.random.default_rng(seed)
+    S = rng.normal(size=(B, J, 3)) * 0.3 + np.array([0., 0., 6.])
+    joints_2d = rng.uniform(0, 224, size=(B, J, 2))
+    joints_conf = rng.uniform(0.2, 1., size=(B, J))
+    return S, joints_2d, joints_conf
+
+
+def expected(S, joints_2d, joints_conf, focal_length, img_size):
+    return np.stack([estimate_translation_np(S[i], joints_2d[i], joints_conf[i], focal_length[i], img_size[i])
+                     for i in range(len(S))])
+
+
+def test_scalar_matches_np():
+    S, joints_2d, joints_conf = random_batch(4)
+    trans = estimate_translation_batch(torch.from_numpy(S), torch.from_numpy(joints_2d), torch.from_numpy(joints_conf),
+                                       5000., 224.)
+    np.testing.assert_allclose(trans.numpy(), expected(S, joints_2d, joints_conf, [5000.] * 4, [224.] * 4),
+                               rtol=1e-6)
+
+
+def test_per_sample_matches_np():
+    S, joints_2d, joints_conf = random_batch(2)
+    focal_length, img_size = np.array([1000., 3000.]), np.array([224., 448.])
+    trans = estimate_translation_batch(torch.from_numpy(S), torch.from_numpy(joints_2d), torch.from_numpy(joints_conf),
+                                       torch.from_numpy(np.repeat(focal_length[:, None], 2, axis=1)),
+                                       torch.from_numpy(img_size[:, None]))
+    np.testing.assert_allclose(trans.numpy(), expected(S, joints_2d, joints_conf, focal_length, img_size), rtol=1e-6)
+
+
+def test_pair_is_shared_by_the_batch():
+    # With B == 2 a (2,) vector is always the shared (fx, fy) pair, per sample values are (B, 1) or (B, 2)
+    S, joints_2d, joints_conf = [torch.from_numpy(x) for x in random_batch(2)]
+    pair = estimate_translation_batch(S, joints_2d, joints_conf, torch.tensor([1000., 3000.]), 224.)
+    per_sample = estimate_translation_batch(S, joints_2d, joints_conf, torch.tensor([[1000., 3000.]] * 2), 224.)
+    np.testing.assert_allclose(pair.numpy(), per_sample.numpy())
+
+
+def test_per_sample_vector_is_rejected():
+    S, joints_2d, joints_conf = random_batch(3)
+    with pytest.raises(ValueError):
+        estimate_translation_batch(torch.from_numpy(S), torch.from_numpy(joints_2d), torch.from_numpy(joints_conf),
+                                   torch.full((3,), 1000.), 224.)
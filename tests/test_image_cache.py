@@ -0,0 +1,87 @@
+"""SharedImageCache lookups, LRU eviction and the key to slot index."""
+import numpy as np
+import pytest
+
+from train.utils.image_cache import SharedImageCache, _key
+
+
+def image(value, shape=(4, 5, 3)):
+    return np.full(shape, value, dtype=np.uint8)
+
+
+@pytest.fixture
+def cache():
+    cache = SharedImageCache(budget_bytes=8 * 60, slot_bytes=60)
+    yield cache
+    cache.close()
+
+
+def test_put_get(cache):
+    assert cache.get('a.jpg') is None
+    cache.put('a.jpg', image(1))
+    cache.put('b.jpg', image(2, (2, 10, 3)))
+    np.testing.assert_array_equal(cache.get('a.jpg'), image(1))
+    np.testing.assert_array_equal(cache.get('b.jpg'), image(2, (2, 10, 3)))
+    # Too large for a slot
+    cache.put('c.jpg', image(3, (5, 5, 3)))
+    assert cache.get('c.jpg') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['inserts'], stats['used_bytes']) == (2, 2, 2, 120)
+
+
+def test_lru_eviction(cache):
+    for i in range(8):
+        cache.put(f'{i}.jpg', image(i))
+    cache.get('0.jpg')
+    cache.put('8.jpg', image(8))
+    # 1 was the least recently used
+    assert cache.get('1.jpg') is None
+    np.testing.assert_array_equal(cache.get('0.jpg'), image(0))
+    np.testing.assert_array_equal(cache.get('8.jpg'), image(8))
+    assert cache.stats()['evictions'] == 1
+
+
+def test_index_matches_slots():
+    # Few index positions so that the probe sequences collide and wrap around
+    cache = SharedImageCache(budget_bytes=5 * 60, slot_bytes=60)
+    rng = np.random.default_rng(0)
+    try:
+        for step in range(2000):
+            name = f'{rng.integers(40)}.jpg'
+            img = cache.get(name)
+            if img is None:
+                cache.put(name, image(int(name.split('.')[0])))
+            else:
+                np.testing.assert_array_equal(img, image(int(name.split('.')[0])))
+        cached = cache.keys[cache.keys != 0]
+        indexed = cache.index_keys[cache.index_keys != 0]
+        assert sorted(cached.tolist()) == sorted(indexed.tolist())
+        for key in cached:
+            assert cache.keys[cache.index_slots[cache._find(key)]] == key
+        # No slot is left marked as being written
+        assert (cache.versions % 2 == 0).all()
+    finally:
+        cache.close()
+
+
+class EvictedWhileCopying:
+    """Slot data whose slot is overwritten by another worker as soon as it is read."""
+    def __init__(self, cache, slot):
+        self.cache = cache
+        self.slot = slot
+        self.data = cache.data
+
+    def __getitem__(self, index):
+        self.cache.versions[self.slot] += 2
+        return self.data[index]
+
+
+def test_overwritten_while_copying(cache):
+    cache.put('a.jpg', image(1))
+    slot = cache.index_slots[cache._find(_key('a.jpg'))]
+    data = cache.data
+    cache.data = EvictedWhileCopying(cache, slot)
+    assert cache.get('a.jpg') is None
+    cache.data = data
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (0, 1)
@@ -0,0 +1,123 @@
+"""InferencePipeline output order, error propagation and writer cleanup, with a fake batcher on CPU."""
+import threading
+import time
+
+import pytest
+import torch
+
+from train.utils.inference_pipeline import InferencePipeline
+
+TIMEOUT = 30
+
+
+class FakeBatcher:
+    """Holds the images until batch_size of them are queued, like CropBatcher with one crop per image."""
+    def __init__(self, batch_size=3):
+        self.batch_size = batch_size
+        self.pending = []
+
+    def add(self, key, crops, bbox_center, bbox_scale, img_w, img_h, data=None):
+        self.pending.append((key, data, {'sum': crops.sum((1, 2, 3))}))
+        if len(self.pending) < self.batch_size:
+            return []
+        return self.flush()
+
+    def flush(self):
+        completed, self.pending = self.pending, []
+        return completed
+
+
+def read(item):
+    # Later items are decoded faster, the readers finish out of order
+    time.sleep(0.001 * (item % 4))
+    return item
+
+
+def crop(item, data):
+    return torch.full((1, 3, 2, 2), float(data)), torch.zeros(1, 2), torch.ones(1), 10, 10
+
+
+def write(key, data, outputs):
+    time.sleep(0.001 * (3 - key % 4))
+    return key, data, float(outputs['sum'][0])
+
+
+def run(pipeline, items, read=read, crop=crop, write=write):
+    """pipeline.run in a thread, fails the test instead of hanging."""
+    out = {}
+
+    def target():
+        try:
+            out['results'] = pipeline.run(items, read, crop, write)
+        except Exception as E:
+            out['error'] = E
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), 'pipeline did not stop'
+    if 'error' in out:
+        raise out['error']
+    return out['results']
+
+
+def make_pipeline(**kwargs):
+    kwargs = {'num_readers': 4, 'num_crop_workers': 3, 'num_writers': 3, 'queue_size': 4, **kwargs}
+    return InferencePipeline(FakeBatcher(), **kwargs)
+
+
+@pytest.mark.parametrize('as_generator', [False, True])
+def test_outputs_in_input_order(as_generator):
+    items = [(i, i) for i in range(50)]
+    if as_generator:
+        items = iter(items)
+    results = run(make_pipeline(), items)
+    assert results == [(i, i, 12. * i) for i in range(50)]
+
+
+def failing(fn, fail_on=7):
+    def wrapped(*args):
+        if args[0] == fail_on:
+            raise ValueError(f'failed on {fail_on}')
+        return fn(*args)
+    return wrapped
+
+
+@pytest.mark.parametrize('stage', ['read', 'crop', 'write'])
+def test_stage_error_is_raised(stage):
+    stages = {'read': read, 'crop': crop, 'write': write}
+    # read and crop get the item, write the key, they are the same here
+    stages[stage] = failing(stages[stage])
+    with pytest.raises(ValueError, match='failed on 7'):
+        run(make_pipeline(), [(i, i) for i in range(200)], **stages)
+
+
+def test_generator_error_is_raised():
+    def items():
+        for i in range(5):
+            yield i, i
+        raise ValueError('no more frames')
+
+    with pytest.raises(ValueError, match='no more frames'):
+        run(make_pipeline(), items())
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_writer_cleanup_once_per_thread(fail):
+    lock = threading.Lock()
+    cleaned = []
+
+    def cleanup():
+        with lock:
+            cleaned.append(threading.current_thread().name)
+
+    pipeline = make_pipeline(writer_cleanup=cleanup)
+    items = [(i, i) for i in range(20)]
+    if fail:
+        with pytest.raises(ValueError):
+            run(pipeline, items, write=failing(write))
+    else:
+        run(pipeline, items)
+    assert len(cleaned) == 3
+    assert len(set(cleaned)) == 3
+    assert all(name.startswith('pipeline-write') for name in cleaned)
@@ -0,0 +1,37 @@
+"""MetricAccumulator, also with ranks that saw no validation samples."""
+import math
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from train.utils.metrics import MetricAccumulator
+
+
+def test_compute_means_per_dataset():
+    acc = MetricAccumulator(['3dpw', 'rich', 'agora'], ['mpjpe', 'pve'])
+    acc.update(torch.tensor([0, 0, 1]), mpjpe=torch.tensor([1., 3., 5.]), pve=torch.tensor([2., 4., 6.]))
+    results = acc.compute()
+    assert results['3dpw'] == {'mpjpe': 2., 'pve': 3.}
+    assert results['rich'] == {'mpjpe': 5., 'pve': 6.}
+    assert all(math.isnan(v) for v in results['agora'].values())
+
+
+def _compute_on_rank(rank, port, results):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=2)
+    acc = MetricAccumulator(['3dpw'], ['mpjpe'])
+    if rank == 0:
+        acc.update(torch.tensor([0, 0]), mpjpe=torch.tensor([1., 3.]))
+    # Rank 1 has no samples and still has to join the all-reduce of rank 0
+    results[rank] = acc.compute()['3dpw']['mpjpe']
+    dist.destroy_process_group()
+
+
+def test_compute_rank_without_samples():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    results = mp.Manager().dict()
+    mp.spawn(_compute_on_rank, args=(port, results), nprocs=2, join=True)
+    assert dict(results) == {0: 2., 1: 2.}
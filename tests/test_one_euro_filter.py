@@ -0,0 +1,67 @@
+"""MultiOneEuroFilter against one OneEuroFilter per track."""
+import numpy as np
+import pytest
+
+from train.utils.one_euro_filter import MultiOneEuroFilter, OneEuroFilter
+
+MIN_CUTOFF, BETA = 0.004, 1.5
+
+
+def random_sequence(T=40, num_tracks=3, shape=(4, 3, 3), seed=0):
+    rng = np.random.default_rng(seed)
+    # Irregular frame times, e.g. dropped frames of a video
+    t = np.cumsum(rng.uniform(0.5, 1.5, size=T))
+    x = np.cumsum(rng.normal(scale=0.1, size=(T, num_tracks, *shape)), axis=0)
+    return t, x
+
+
+def reference(t, x, valid):
+    """One OneEuroFilter per track, fed with the valid frames of the track only."""
+    x_hat = x.copy()
+    for k in range(x.shape[1]):
+        filt = None
+        for i in range(len(x)):
+            if not valid[i, k]:
+                continue
+            if filt is None:
+                filt = OneEuroFilter(t[i], x[i, k], min_cutoff=MIN_CUTOFF, beta=BETA)
+            else:
+                x_hat[i, k] = filt(t[i], x[i, k])
+    return x_hat
+
+
+def multi_filter(x):
+    return MultiOneEuroFilter(x.shape[1], x.shape[2:], min_cutoff=MIN_CUTOFF, beta=BETA, dtype=np.float64)
+
+
+def missing_frames(T, num_tracks):
+    valid = np.ones((T, num_tracks), dtype=bool)
+    # Track 1 is lost twice, track 2 starts late, track 0 is always present
+    valid[5:9, 1] = False
+    valid[30, 1] = False
+    valid[:12, 2] = False
+    return valid
+
+
+@pytest.mark.parametrize('with_missing', [False, True])
+def test_matches_per_track_filter(with_missing):
+    t, x = random_sequence()
+    valid = missing_frames(*x.shape[:2]) if with_missing else np.ones(x.shape[:2], dtype=bool)
+    expected = reference(t, x, valid)
+    x_hat = multi_filter(x)(t, x, valid if with_missing else None)
+    np.testing.assert_array_equal(x_hat, expected)
+    if with_missing:
+        # Missing frames and the first frame of the late track are returned unchanged
+        np.testing.assert_array_equal(x_hat[5:9, 1], x[5:9, 1])
+        np.testing.assert_array_equal(x_hat[:13, 2], x[:13, 2])
+        assert not np.allclose(x_hat[13:, 2], x[13:, 2])
+
+
+@pytest.mark.parametrize('chunks', [[1] * 40, [7, 13, 20], [12, 28]])
+def test_chunks_match_whole_sequence(chunks):
+    t, x = random_sequence()
+    valid = missing_frames(*x.shape[:2])
+    filt = multi_filter(x)
+    bounds = np.cumsum([0] + chunks)
+    x_hat = np.concatenate([filt(t[s:e], x[s:e], valid[s:e]) for s, e in zip(bounds[:-1], bounds[1:])])
+    np.testing.assert_array_equal(x_hat, reference(t, x, valid))
@@ -0,0 +1,58 @@
+"""PredictionWriter chunks through check_pred_file_format and the legacy zip export."""
+import os
+import pickle
+import zipfile
+
+import numpy as np
+import pytest
+
+from check_pred_file_format import check_compact, check_zip
+from train.utils.pred_writer import PredictionWriter, export_legacy_zip, get_chunk_files
+
+# People per image, 0 for an image without detections
+NUM_PEOPLE = [2, 3, 0, 1, 4]
+
+
+def predictions(rng):
+    for i, num_people in enumerate(NUM_PEOPLE):
+        # AGORA camera distances, float16 rounds these to a few mm
+        verts = rng.normal(scale=0.5, size=(num_people, 10475, 3)) + np.array([0., 0., 8.])
+        joints3d = rng.normal(scale=0.5, size=(num_people, 127, 3)) + np.array([0., 0., 8.])
+        joints2d = rng.uniform(0, 1280, size=(num_people, 24, 2))
+        yield f'img_{i}.png', verts, joints3d, joints2d
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16'])
+def test_round_trip(tmp_path, dtype):
+    pred_folder = str(tmp_path / 'predictions')
+    expected = {}
+    with PredictionWriter(pred_folder, chunk_size=4, dtype=dtype) as writer:
+        for imgname, verts, joints3d, joints2d in predictions(np.random.default_rng(0)):
+            writer.add(imgname, verts, joints3d, joints2d)
+            for person_id in range(len(verts)):
+                expected[f'predictions/{imgname}_personId_{person_id}.pkl'] = {
+                    'verts': verts[person_id], 'allSmplJoints3d': joints3d[person_id], 'joints': joints2d[person_id]}
+
+    chunk_files = get_chunk_files(pred_folder)
+    assert len(chunk_files) == 3
+    assert not check_compact(chunk_files)
+    with np.load(os.path.join(pred_folder, 'index.npz')) as index:
+        assert index['imgname'].tolist() == [name.split('/')[1].split('_personId')[0] for name in expected]
+        assert index['chunk'].tolist() == [0, 0, 0, 0, 1, 1, 1, 1, 2, 2]
+
+    zip_path = str(tmp_path / 'predictions.zip')
+    assert export_legacy_zip(pred_folder, zip_path) == sum(NUM_PEOPLE)
+    assert not check_zip(zip_path, num_workers=2)
+    with zipfile.ZipFile(zip_path) as zf:
+        assert sorted(zf.namelist()) == sorted(expected)
+        for name, arrays in expected.items():
+            pred = pickle.loads(zf.read(name))
+            for key, value in arrays.items():
+                # float16 chunks are exported as float32 pickles, with the values rounded to float16
+                assert pred[key].dtype == np.float32
+                np.testing.assert_array_equal(pred[key], value.astype(dtype).astype(np.float32))
+
+
+def test_max_pending_is_positive(tmp_path):
+    with pytest.raises(AssertionError):
+        PredictionWriter(str(tmp_path), max_pending=0)
@@ -53,16 +53,23 @@ def train(hparams, fast_dev_run=False):
         save_top_k=5,
         mode='min',
     )
+    callbacks = [ckpt_callback, ProgressBar(refresh_rate=200)]
+    if hparams.TRAINING.SAVE_EVERY_N_STEPS > 0:
+        # Mid-epoch checkpoints, training resumes from the saved position in the epoch
+        callbacks.append(ModelCheckpoint(every_n_train_steps=hparams.TRAINING.SAVE_EVERY_N_STEPS))
+
     trainer = pl.Trainer(
         gpus=1,
         logger=experiment_loggers,
         max_epochs=hparams.TRAINING.MAX_EPOCHS,
-        callbacks=[ckpt_callback, ProgressBar(refresh_rate=200)],
+        callbacks=callbacks,
         default_root_dir=log_dir,
         check_val_every_n_epoch=hparams.TRAINING.CHECK_VAL_EVERY_N_EPOCH,
         num_sanity_val_steps=0,
         fast_dev_run=fast_dev_run,
         resume_from_checkpoint=hparams.TRAINING.RESUME,
+        # The loaders shard the data over the ranks themselves, see get_distributed_sampler
+        replace_sampler_ddp=False,
     )
 
     logger.info('*** Started training ***')
@@ -154,8 +154,21 @@ hparams.DATASET.DATASETS_AND_RATIOS = 'agora'
 hparams.DATASET.CROP_PERCENT = 1.0
 hparams.DATASET.ALB = False
 hparams.DATASET.ALB_PROB = 0.3
+hparams.DATASET.ALB_PRESET = 'default'
+hparams.DATASET.ALB_OPS = CN(new_allowed=True)
+hparams.DATASET.ALB_TIMING = False
 hparams.DATASET.proj_verts = False
 hparams.DATASET.FOCAL_LENGTH = 5000
+hparams.DATASET.CROP_SHARDS = ''
+hparams.DATASET.LABEL_STORE = ''
+hparams.DATASET.CROP_ENGINE = 'skimage'
+hparams.DATASET.GPU_CROP = False
+hparams.DATASET.FRAME_GROUPED = False
+hparams.DATASET.IMAGE_CACHE_GB = 0.
+hparams.DATASET.IMAGE_CACHE_SLOT_MB = 0.
+hparams.DATASET.IMAGE_CACHE_RES = [1280, 720]
+hparams.DATASET.MIXING_SAMPLER = False
+hparams.DATASET.GT_MESH_CACHE = ''
 
 # optimizer config
 hparams.OPTIMIZER = CN()
@@ -172,6 +185,7 @@ hparams.TRAINING.MAX_EPOCHS = 100
 hparams.TRAINING.LOG_SAVE_INTERVAL = 50
 hparams.TRAINING.LOG_FREQ_TB_IMAGES = 500
 hparams.TRAINING.CHECK_VAL_EVERY_N_EPOCH = 1
+hparams.TRAINING.SAVE_EVERY_N_STEPS = 0
 hparams.TRAINING.RELOAD_DATALOADERS_EVERY_EPOCH = True
 hparams.TRAINING.TEST_BEFORE_TRAINING = False
 hparams.TRAINING.SAVE_IMAGES = False
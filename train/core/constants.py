@@ -22,6 +22,12 @@ CROP_ASPECT_RATIO = CROP_IMG_HEIGHT / float(CROP_IMG_WIDTH)
 NUM_JOINTS_SMPLX = 22
 NUM_JOINTS_SMPL = 24
 NUM_JOINTS_HAND = 16
+# Body joints of the SMPL-X kinematic tree, in the order of the pose parameters
+SMPLX_BODY_JOINT_NAMES = [
+    'pelvis', 'left_hip', 'right_hip', 'spine1', 'left_knee', 'right_knee', 'spine2', 'left_ankle',
+    'right_ankle', 'spine3', 'left_foot', 'right_foot', 'neck', 'left_collar', 'right_collar', 'head',
+    'left_shoulder', 'right_shoulder', 'left_elbow', 'right_elbow', 'left_wrist', 'right_wrist',
+]
 BN_MOMENTUM = 0.1
 
 
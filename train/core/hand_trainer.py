@@ -8,7 +8,9 @@ from torch.utils.data import DataLoader, ConcatDataset
 from . import config
 from ..dataset.dataset_hand import DatasetHand
 from ..utils.train_utils import set_seed
-from ..utils.eval_utils import reconstruction_error
+from ..utils.dataloader import CheckpointDataLoader, get_distributed_sampler
+from ..utils.eval_utils import reconstruction_error_torch
+from ..utils.metrics import MetricAccumulator
 from ..utils.image_utils import denormalize_images
 from ..utils.renderer_cam import render_image_group
 from ..utils.renderer import Renderer
@@ -33,6 +35,10 @@ class HandTrainer(pl.LightningModule):
 
         self.loss_fn = HandLoss(hparams=self.hparams)
         self.val_ds = self.val_dataset()
+        # Position in the training epoch, restored with the checkpoint
+        self.train_loader = None
+        self.train_loader_state = None
+        self.train_batch_idx = 0
         self.save_itr = 0
         self.mano = MANO(model_path=config.MANO_MODEL_DIR, use_pca=False, is_rhand=True)
         self.renderer = Renderer(
@@ -57,11 +63,12 @@ class HandTrainer(pl.LightningModule):
         for k, v in loss_dict.items():
             self.log(k, v, logger=True, sync_dist=True)
 
+        # Counted here and not in on_train_batch_end, the step checkpoint callbacks run before it
+        self.train_batch_idx += 1
         return {'loss': loss}
 
     def validation_step(self, batch, batch_nb, dataloader_nb=0, vis=False, save=True, mesh_save_dir=None):
         images = batch['img']
-        dataset_index = batch['dataset_index'].detach().cpu().numpy()
         with torch.no_grad():
             pred = self(images)
         # self.visualize_mesh(batch, pred, batch_nb, dataloader_nb,x=0)
@@ -72,47 +79,47 @@ class HandTrainer(pl.LightningModule):
         gt_joints = batch['joints3d']
 
         # Absolute error (MPJPE)
-        error = torch.sqrt(((pred_joints - gt_joints) ** 2).sum(dim=-1)).cpu().numpy()
+        error = torch.sqrt(((pred_joints - gt_joints) ** 2).sum(dim=-1))
         # Reconstuction_error
 
-        r_error, _ = reconstruction_error(
-            gt_joints.cpu().numpy(),
-            pred_joints.cpu().numpy(),
+        r_error, _ = reconstruction_error_torch(
+            gt_joints,
+            pred_joints,
             reduction=None
         )
-        val_mpjpe = error.mean(-1)
-        val_pampjpe = r_error.mean(-1)
-        loss_dict = {}
-        val_dataset_names = self.hparams.DATASET.VAL_DS.split('_')
-
-        for ds_idx, ds in enumerate(self.val_ds):
-            ds_name = ds.dataset
-            ds_idx = val_dataset_names.index(ds.dataset)
+        self.val_metrics.update(
+            batch['dataset_index'],
+            mpjpe=error.mean(-1),
+            pampjpe=r_error.mean(-1),
+        )
 
-            idxs = np.where(dataset_index == ds_idx)
-            loss_dict[ds_name + '_mpjpe'] = list(val_mpjpe[idxs])
-            loss_dict[ds_name + '_pampjpe'] = list(val_pampjpe[idxs])
+    def on_validation_epoch_start(self):
+        self.val_metrics = MetricAccumulator(self.hparams.DATASET.VAL_DS.split('_'), ['mpjpe', 'pampjpe'],
+                                             device=self.device)
 
-        return loss_dict
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
 
     def validation_epoch_end(self, outputs):
         logger.info(f'***** Epoch {self.current_epoch} *****')
         val_log = {}
+        # Already reduced over the ranks
+        results = self.val_metrics.compute()
 
         for ds_idx, ds in enumerate(self.val_ds):
             ds_name = ds.dataset
-            mpjpe = 1000 * np.hstack(np.array([x[ds_name + '_mpjpe'] for x in outputs])).mean()
-            pampjpe = (1000 * np.hstack(np.array([x[ds_name + '_pampjpe'] for x in outputs]))).mean()
+            mpjpe = 1000 * results[ds_name]['mpjpe']
+            pampjpe = 1000 * results[ds_name]['pampjpe']
             if self.trainer.is_global_zero:
                 logger.info(ds_name + '_MPJPE: ' + str(mpjpe))
                 logger.info(ds_name + '_PA-MPJPE: ' + str(pampjpe))
 
-                val_log[ds_name + '_val_mpjpe'] = mpjpe
-                val_log[ds_name + '_val_pampjpe'] = pampjpe
-        self.log('val_loss', val_log[self.val_ds[0].dataset + '_val_pampjpe'], logger=True, sync_dist=True, rank_zero_only=True)
+            val_log[ds_name + '_val_mpjpe'] = mpjpe
+            val_log[ds_name + '_val_pampjpe'] = pampjpe
+        self.log('val_loss', val_log[self.val_ds[0].dataset + '_val_pampjpe'], logger=True)
 
         for k, v in val_log.items():
-            self.log(k, v, logger=True, sync_dist=True, rank_zero_only=True)
+            self.log(k, v, logger=True)
 
     def test_step(self, batch, batch_nb, dataloader_nb=0):
         return self.validation_step(batch, batch_nb, dataloader_nb)
@@ -120,6 +127,18 @@ class HandTrainer(pl.LightningModule):
     def test_epoch_end(self, outputs):
         return self.validation_epoch_end(outputs)
 
+    def on_train_epoch_start(self):
+        self.train_batch_idx = 0
+
+    def on_save_checkpoint(self, checkpoint):
+        if isinstance(self.train_loader, CheckpointDataLoader):
+            checkpoint['train_loader'] = self.train_loader.state_dict(
+                self.train_batch_idx, trainer_epoch=checkpoint.get('epoch'))
+
+    def on_load_checkpoint(self, checkpoint):
+        # Applied when the train dataloader is created
+        self.train_loader_state = checkpoint.get('train_loader')
+
     def configure_optimizers(self):
         return torch.optim.Adam(
             self.parameters(),
@@ -138,13 +157,18 @@ class HandTrainer(pl.LightningModule):
         set_seed(self.hparams.SEED_VALUE)
         self.train_ds = self.train_dataset()
 
-        return DataLoader(
+        self.train_loader = CheckpointDataLoader(
             dataset=self.train_ds,
+            checkpoint=self.train_loader_state,
             batch_size=self.hparams.DATASET.BATCH_SIZE,
             num_workers=self.hparams.DATASET.NUM_WORKERS,
             pin_memory=self.hparams.DATASET.PIN_MEMORY,
             shuffle=self.hparams.DATASET.SHUFFLE_TRAIN,
+            drop_last=False,
+            seed=self.hparams.SEED_VALUE,
         )
+        self.train_loader_state = None
+        return self.train_loader
 
     def val_dataset(self):
         datasets = self.hparams.DATASET.VAL_DS.split('_')
@@ -169,6 +193,7 @@ class HandTrainer(pl.LightningModule):
                     dataset=val_ds,
                     batch_size=self.hparams.DATASET.BATCH_SIZE,
                     shuffle=False,
+                    sampler=get_distributed_sampler(val_ds),
                     num_workers=self.hparams.DATASET.NUM_WORKERS,
                     drop_last=True
                 )
@@ -3,17 +3,24 @@ import cv2
 import torch
 import smplx
 import pickle
+import functools
 import numpy as np
 from loguru import logger
 import pytorch_lightning as pl
 from torch.utils.data import DataLoader, ConcatDataset
+from torch.utils.data.dataloader import default_collate
 from . import constants
 from . import config
 from .constants import NUM_JOINTS_SMPLX
 from ..dataset.dataset import DatasetHMR
-from ..utils.train_utils import set_seed
-from ..utils.eval_utils import reconstruction_error
+from ..dataset.frame_dataset import FrameGroupedDataset, FrameBatchSampler, collate_frames
+from ..utils.train_utils import set_seed, split_datasets_and_ratios
+from ..utils.dataloader import CheckpointDataLoader, get_distributed_sampler
+from ..utils.eval_utils import reconstruction_error_torch
+from ..utils.metrics import MetricAccumulator
 from ..utils.image_utils import denormalize_images
+from ..utils.image_cache import get_image_cache
+from ..utils.gpu_augment import GPUCropAugment, collate_full_frames, FRAME_KEY
 from ..utils.renderer_cam import render_image_group
 from ..utils.renderer import Renderer
 from ..models.hmr import HMR
@@ -38,11 +45,17 @@ class HMRTrainer(pl.LightningModule):
         self.add_module('smplx', self.smplx)
         self.smpl = smplx.SMPL(config.SMPL_MODEL_DIR, batch_size=self.hparams.DATASET.BATCH_SIZE, create_transl=False)
 
+        # Created before the datasets so that their workers share it
+        self.image_cache = get_image_cache(self.hparams.DATASET)
         # Initialize the training datasets only in training mode
         if not hparams.RUN_TEST:
             self.train_ds = self.train_dataset()
 
         self.val_ds = self.val_dataset()
+        # Position in the training epoch, restored with the checkpoint
+        self.train_loader = None
+        self.train_loader_state = None
+        self.train_batch_idx = 0
         self.save_itr = 0
         batch_size = self.hparams.DATASET.BATCH_SIZE
         self.smplx2smpl = pickle.load(open(config.SMPLX2SMPL, 'rb'))
@@ -69,6 +82,14 @@ class HMRTrainer(pl.LightningModule):
         self.training_fp_vis = self.hparams.TRAINING.FP_VIS
         self.training_mesh_vis = self.hparams.TRAINING.MESH_VIS
 
+        self.gpu_crop = GPUCropAugment(self.hparams.DATASET) if self.hparams.DATASET.GPU_CROP else None
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # Training batches only carry the decoded frames when DATASET.GPU_CROP is set
+        if self.gpu_crop is not None and FRAME_KEY in batch:
+            batch = self.gpu_crop(batch, is_train=self.trainer.training)
+        return batch
+
     def forward(self, x, bbox_center, bbox_scale, img_w, img_h, fl=None):
         return self.model(x, bbox_center=bbox_center, bbox_scale=bbox_scale, img_w=img_w, img_h=img_h, fl=fl) 
 
@@ -113,6 +134,8 @@ class HMRTrainer(pl.LightningModule):
         for k, v in loss_dict.items():
             self.log(k, v, logger=True, sync_dist=True)
 
+        # Counted here and not in on_train_batch_end, the step checkpoint callbacks run before it
+        self.train_batch_idx += 1
         return {'loss': loss}
 
     def validation_step(self, batch, batch_nb, dataloader_nb=0, vis=False, save=True, mesh_save_dir=None):
@@ -122,8 +145,6 @@ class HMRTrainer(pl.LightningModule):
         bbox_scale = batch['scale']
         bbox_center = batch['center']
         dataset_names = batch['dataset_name']
-        dataset_index = batch['dataset_index'].detach().cpu().numpy()
-        val_dataset_names = self.hparams.DATASET.VAL_DS.split('_')
         img_h = batch['orig_shape'][:, 0]
         img_w = batch['orig_shape'][:, 1]
         J_regressor_batch_smpl = self.J_regressor[None, :].expand(batch['img'].shape[0], -1, -1)
@@ -192,18 +213,21 @@ class HMRTrainer(pl.LightningModule):
             pred_cam_vertices = pred_cam_vertices - pred_pelvis
 
         # Absolute error (MPJPE)
-        error = torch.sqrt(((pred_keypoints_3d - gt_keypoints_3d) ** 2).sum(dim=-1)).cpu().numpy()
-        error_verts = torch.sqrt(((pred_cam_vertices - gt_cam_vertices) ** 2).sum(dim=-1)).cpu().numpy()
+        error = torch.sqrt(((pred_keypoints_3d - gt_keypoints_3d) ** 2).sum(dim=-1))
+        error_verts = torch.sqrt(((pred_cam_vertices - gt_cam_vertices) ** 2).sum(dim=-1))
 
         # Reconstuction_error (PA-MPJPE)
-        r_error, _ = reconstruction_error(
-            pred_keypoints_3d.cpu().numpy(),
-            gt_keypoints_3d.cpu().numpy(),
+        r_error, _ = reconstruction_error_torch(
+            pred_keypoints_3d,
+            gt_keypoints_3d,
             reduction=None
         )
-        val_mpjpe = error.mean(-1)
-        val_pampjpe = r_error.mean(-1)
-        val_pve = error_verts.mean(-1)
+        self.val_metrics.update(
+            batch['dataset_index'],
+            mpjpe=error.mean(-1),
+            pampjpe=r_error.mean(-1),
+            pve=error_verts.mean(-1),
+        )
 
         # Visualize results
         if self.testing_gt_vis:
@@ -215,56 +239,49 @@ class HMRTrainer(pl.LightningModule):
         if self.testing_fp_vis:
             self.perspective_projection(batch, pred, batch_nb)
 
-        loss_dict = {}
-
-        for ds_idx, ds in enumerate(self.val_ds):
-            ds_name = ds.dataset
-            ds_idx = val_dataset_names.index(ds.dataset)
-            idxs = np.where(dataset_index == ds_idx)
-            loss_dict[ds_name + '_mpjpe'] = list(val_mpjpe[idxs])
-            loss_dict[ds_name + '_pampjpe'] = list(val_pampjpe[idxs])
-            loss_dict[ds_name + '_pve'] = list(val_pve[idxs])
+    def on_validation_epoch_start(self):
+        self.val_metrics = MetricAccumulator(self.hparams.DATASET.VAL_DS.split('_'), ['mpjpe', 'pampjpe', 'pve'],
+                                             device=self.device)
 
-        return loss_dict
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
 
     def validation_epoch_end(self, outputs):
         logger.info(f'***** Epoch {self.current_epoch} *****')
         val_log = {}
+        # Already reduced over the ranks
+        results = self.val_metrics.compute()
 
-        if len(self.val_ds) > 1:
-            for ds_idx, ds in enumerate(self.val_ds):
-                ds_name = ds.dataset
-                mpjpe = 1000 * np.hstack(np.array([val[ds_name + '_mpjpe'] for x in outputs for val in x])).mean()
-                pampjpe = 1000 * np.hstack(np.array([val[ds_name + '_pampjpe'] for x in outputs for val in x])).mean()
-                pve = 1000 * np.hstack(np.array([val[ds_name + '_pve'] for x in outputs for val in x])).mean()
-
-                if self.trainer.is_global_zero:
-                    logger.info(ds_name + '_MPJPE: ' + str(mpjpe))
-                    logger.info(ds_name + '_PA-MPJPE: ' + str(pampjpe))
-                    logger.info(ds_name + '_PVE: ' + str(pve))
-                    val_log[ds_name + '_val_mpjpe'] = mpjpe
-                    val_log[ds_name + '_val_pampjpe'] = pampjpe
-                    val_log[ds_name + '_val_pve'] = pve
-        else:
-            for ds_idx, ds in enumerate(self.val_ds):
-                ds_name = ds.dataset
-                mpjpe = 1000 * np.hstack(np.array([x[ds_name + '_mpjpe'] for x in outputs])).mean()
-                pampjpe = 1000 * np.hstack(np.array([x[ds_name + '_pampjpe'] for x in outputs])).mean()
-                pve = 1000 * np.hstack(np.array([x[ds_name + '_pve'] for x in outputs])).mean()
-
-                if self.trainer.is_global_zero:
-                    logger.info(ds_name + '_MPJPE: ' + str(mpjpe))
-                    logger.info(ds_name + '_PA-MPJPE: ' + str(pampjpe))
-                    logger.info(ds_name + '_PVE: ' + str(pve))
-
-                    val_log[ds_name + '_val_mpjpe'] = mpjpe
-                    val_log[ds_name + '_val_pampjpe'] = pampjpe
-                    val_log[ds_name + '_val_pve'] = pve
-
-        self.log('val_loss', val_log[self.val_ds[0].dataset + '_val_pampjpe'], logger=True, sync_dist=True)
-        self.log('val_loss_mpjpe', val_log[self.val_ds[0].dataset + '_val_mpjpe'], logger=True, sync_dist=True)
+        for ds_idx, ds in enumerate(self.val_ds):
+            ds_name = ds.dataset
+            mpjpe = 1000 * results[ds_name]['mpjpe']
+            pampjpe = 1000 * results[ds_name]['pampjpe']
+            pve = 1000 * results[ds_name]['pve']
+
+            if self.trainer.is_global_zero:
+                logger.info(ds_name + '_MPJPE: ' + str(mpjpe))
+                logger.info(ds_name + '_PA-MPJPE: ' + str(pampjpe))
+                logger.info(ds_name + '_PVE: ' + str(pve))
+
+            val_log[ds_name + '_val_mpjpe'] = mpjpe
+            val_log[ds_name + '_val_pampjpe'] = pampjpe
+            val_log[ds_name + '_val_pve'] = pve
+
+        self.log('val_loss', val_log[self.val_ds[0].dataset + '_val_pampjpe'], logger=True)
+        self.log('val_loss_mpjpe', val_log[self.val_ds[0].dataset + '_val_mpjpe'], logger=True)
         for k, v in val_log.items():
-            self.log(k, v, logger=True, sync_dist=True)
+            self.log(k, v, logger=True)
+        self.log_image_cache()
+
+    def on_train_epoch_end(self, *args):
+        self.log_image_cache()
+
+    def log_image_cache(self):
+        if self.image_cache is None:
+            return
+        # Counters are per process, every rank has its own cache
+        for k, v in self.image_cache.stats().items():
+            self.log(f'image_cache/{k}', float(v), logger=True)
 
     def gt_projection(self, input_batch, output, batch_idx, max_save_img=1):
         save_dir = os.path.join(self.hparams.LOG_DIR, 'output_images_gt')
@@ -383,6 +400,18 @@ class HMRTrainer(pl.LightningModule):
     def test_epoch_end(self, outputs):
         return self.validation_epoch_end(outputs)
 
+    def on_train_epoch_start(self):
+        self.train_batch_idx = 0
+
+    def on_save_checkpoint(self, checkpoint):
+        if isinstance(self.train_loader, CheckpointDataLoader):
+            checkpoint['train_loader'] = self.train_loader.state_dict(
+                self.train_batch_idx, trainer_epoch=checkpoint.get('epoch'))
+
+    def on_load_checkpoint(self, checkpoint):
+        # Applied when the train dataloader is created
+        self.train_loader_state = checkpoint.get('train_loader')
+
     def configure_optimizers(self):
         if self.hparams.OPTIMIZER.TYPE == 'sgd':
             return torch.optim.SGD(self.parameters(), lr=self.hparams.OPTIMIZER.LR, momentum=0.9)
@@ -397,6 +426,9 @@ class HMRTrainer(pl.LightningModule):
 
     def train_dataset(self):
         options = self.hparams.DATASET
+        if options.FRAME_GROUPED:
+            dataset_names, _ = split_datasets_and_ratios(options.DATASETS_AND_RATIOS)
+            return FrameGroupedDataset([DatasetHMR(options, ds) for ds in dataset_names])
         dataset_names = options.DATASETS_AND_RATIOS.split('_')
         dataset_list = [DatasetHMR(options, ds) for ds in dataset_names]
         train_ds = ConcatDataset(dataset_list)
@@ -405,14 +437,37 @@ class HMRTrainer(pl.LightningModule):
 
     def train_dataloader(self):
         self.train_ds = self.train_dataset()
-        return DataLoader(
+        collate_fn = collate_full_frames if self.hparams.DATASET.GPU_CROP else None
+        if self.hparams.DATASET.FRAME_GROUPED:
+            # One decode per frame, people of a frame are spread over the batch
+            _, ratios = split_datasets_and_ratios(self.hparams.DATASET.DATASETS_AND_RATIOS)
+            batch_sampler = FrameBatchSampler(
+                frame_size=self.train_ds.frame_size,
+                frame_dataset=self.train_ds.frame_dataset,
+                batch_size=self.hparams.DATASET.BATCH_SIZE,
+                shuffle=self.hparams.DATASET.SHUFFLE_TRAIN,
+                ratios=ratios,
+            )
+            return DataLoader(
+                dataset=self.train_ds,
+                batch_sampler=batch_sampler,
+                num_workers=self.hparams.DATASET.NUM_WORKERS,
+                pin_memory=self.hparams.DATASET.PIN_MEMORY,
+                collate_fn=functools.partial(collate_frames, collate_fn=collate_fn or default_collate),
+            )
+        self.train_loader = CheckpointDataLoader(
             dataset=self.train_ds,
+            checkpoint=self.train_loader_state,
             batch_size=self.hparams.DATASET.BATCH_SIZE,
             num_workers=self.hparams.DATASET.NUM_WORKERS,
             pin_memory=self.hparams.DATASET.PIN_MEMORY,
             shuffle=self.hparams.DATASET.SHUFFLE_TRAIN,
-            drop_last=True
+            drop_last=True,
+            collate_fn=collate_fn,
+            seed=self.hparams.SEED_VALUE,
         )
+        self.train_loader_state = None
+        return self.train_loader
 
     def val_dataset(self):
         datasets = self.hparams.DATASET.VAL_DS.split('_')
@@ -436,6 +491,7 @@ class HMRTrainer(pl.LightningModule):
                     dataset=val_ds,
                     batch_size=self.hparams.DATASET.BATCH_SIZE,
                     shuffle=False,
+                    sampler=get_distributed_sampler(val_ds),
                     num_workers=self.hparams.DATASET.NUM_WORKERS,
                     drop_last=True
                 )
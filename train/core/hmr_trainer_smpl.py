@@ -13,8 +13,11 @@ from .constants import NUM_JOINTS_SMPL
 from ..dataset.dataset_smpl import DatasetHMR
 from ..dataset.mixed_dataset import MixedDataset
 from ..utils.train_utils import set_seed
-from ..utils.eval_utils import reconstruction_error
+from ..utils.dataloader import MixingSampler, get_distributed_sampler
+from ..utils.eval_utils import reconstruction_error_torch
+from ..utils.metrics import MetricAccumulator
 from ..utils.image_utils import denormalize_images
+from ..utils.image_cache import get_image_cache
 from ..utils.renderer_cam import render_image_group
 from ..utils.renderer import Renderer
 from ..utils.geometry import estimate_translation_fullimg
@@ -40,12 +43,18 @@ class HMRTrainer(pl.LightningModule):
         self.smplx = smplx.SMPLX(config.SMPLX_MODEL_DIR, batch_size=self.hparams.DATASET.BATCH_SIZE, create_transl=False, num_betas=11)
         self.smpl = smplx.SMPL(config.SMPL_MODEL_DIR, batch_size=self.hparams.DATASET.BATCH_SIZE, create_transl=False)
         self.smpl_49 = SMPL49(config.SMPL_MODEL_DIR, batch_size=self.hparams.DATASET.BATCH_SIZE, create_transl=False)
+        # Created before the datasets so that their workers share it
+        self.image_cache = get_image_cache(self.hparams.DATASET)
         # Initialize the training datasets only in training mode
         if not hparams.RUN_TEST:
             self.train_ds = self.train_dataset()
 
         self.val_ds = self.val_dataset()
         self.save_itr = 0
+        # Position in the training epoch, restored with the checkpoint
+        self.train_sampler = None
+        self.train_sampler_state = None
+        self.train_batch_idx = 0
 
         self.smplx2smpl = pickle.load(open(config.SMPLX2SMPL, 'rb'))
         self.smplx2smpl = torch.tensor(self.smplx2smpl['matrix'][None], dtype=torch.float32)
@@ -115,6 +124,8 @@ class HMRTrainer(pl.LightningModule):
         for k, v in loss_dict.items():
             self.log(k, v, logger=True, sync_dist=True)
 
+        # Counted here and not in on_train_batch_end, the step checkpoint callbacks run before it
+        self.train_batch_idx += 1
         return {'loss': loss}
 
     def validation_step(self, batch, batch_nb, dataloader_nb=0, vis=False, save=True, mesh_save_dir=None):
@@ -124,8 +135,6 @@ class HMRTrainer(pl.LightningModule):
         bbox_scale = batch['scale']
         bbox_center = batch['center']
         dataset_names = batch['dataset_name']
-        dataset_index = batch['dataset_index'].detach().cpu().numpy()
-        val_dataset_names = self.hparams.DATASET.VAL_DS.split('_')
         img_h = batch['orig_shape'][:, 0]
         img_w = batch['orig_shape'][:, 1]
         J_regressor_batch_smpl = self.J_regressor[None, :].expand(batch['img'].shape[0], -1, -1)
@@ -175,18 +184,21 @@ class HMRTrainer(pl.LightningModule):
             pred_cam_vertices = pred_cam_vertices - pred_pelvis
 
         # Absolute error (MPJPE)
-        error = torch.sqrt(((pred_keypoints_3d - gt_keypoints_3d) ** 2).sum(dim=-1)).cpu().numpy()
-        error_verts = torch.sqrt(((pred_cam_vertices - gt_cam_vertices) ** 2).sum(dim=-1)).cpu().numpy()
+        error = torch.sqrt(((pred_keypoints_3d - gt_keypoints_3d) ** 2).sum(dim=-1))
+        error_verts = torch.sqrt(((pred_cam_vertices - gt_cam_vertices) ** 2).sum(dim=-1))
 
         # Reconstuction_error (PA-MPJPE)
-        r_error, _ = reconstruction_error(
-            pred_keypoints_3d.cpu().numpy(),
-            gt_keypoints_3d.cpu().numpy(),
+        r_error, _ = reconstruction_error_torch(
+            pred_keypoints_3d,
+            gt_keypoints_3d,
             reduction=None
         )
-        val_mpjpe = error.mean(-1)
-        val_pampjpe = r_error.mean(-1)
-        val_pve = error_verts.mean(-1)
+        self.val_metrics.update(
+            batch['dataset_index'],
+            mpjpe=error.mean(-1),
+            pampjpe=r_error.mean(-1),
+            pve=error_verts.mean(-1),
+        )
 
         # Visualize results
         if self.testing_gt_vis:
@@ -198,57 +210,62 @@ class HMRTrainer(pl.LightningModule):
         if self.testing_fp_vis:
             self.perspective_projection(batch, pred, batch_nb)
 
-        loss_dict = {}
-
-        for ds_idx, ds in enumerate(self.val_ds):
-            ds_name = ds.dataset
-            ds_idx = val_dataset_names.index(ds.dataset)
-            idxs = np.where(dataset_index == ds_idx)
-            loss_dict[ds_name+'_mpjpe'] = list(val_mpjpe[idxs])
-            loss_dict[ds_name+'_pampjpe'] = list(val_pampjpe[idxs])
-            loss_dict[ds_name+'_pve'] = list(val_pve[idxs])
+    def on_validation_epoch_start(self):
+        self.val_metrics = MetricAccumulator(self.hparams.DATASET.VAL_DS.split('_'), ['mpjpe', 'pampjpe', 'pve'],
+                                             device=self.device)
 
-        return loss_dict
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
 
     def validation_epoch_end(self, outputs):
         logger.info(f'***** Epoch {self.current_epoch} *****')
         val_log = {}
+        # Already reduced over the ranks
+        results = self.val_metrics.compute()
 
-        if len(self.val_ds) > 1:
-            for ds_idx, ds in enumerate(self.val_ds):
-                ds_name = ds.dataset
-                mpjpe = 1000*np.hstack(np.array([val[ds_name+'_mpjpe'] for x in outputs for val in x])).mean()
-                pampjpe = 1000*np.hstack(np.array([val[ds_name+'_pampjpe'] for x in outputs for val in x])).mean()
-                pve = 1000*np.hstack(np.array([val[ds_name+'_pve'] for x in outputs for val in x])).mean()
-
-                if self.trainer.is_global_zero:
-                    logger.info(ds_name+'_MPJPE: ' + str(mpjpe))
-                    logger.info(ds_name+'_PA-MPJPE: ' + str(pampjpe))
-                    logger.info(ds_name+'_PVE: ' + str(pve))
-                    val_log[ds_name+'_val_mpjpe'] = mpjpe
-                    val_log[ds_name+'_val_pampjpe'] = pampjpe
-                    val_log[ds_name+'_val_pve'] = pve
-        else:
-            for ds_idx, ds in enumerate(self.val_ds):
-                ds_name = ds.dataset
-                mpjpe = 1000*np.hstack(np.array([x[ds_name+'_mpjpe'] for x in outputs])).mean()
-                pampjpe = (1000*np.hstack(np.array([x[ds_name+'_pampjpe'] for x in outputs]))).mean()
-                pve = (1000*np.hstack(np.array([x[ds_name+'_pve'] for x in outputs]))).mean()
-
-                if self.trainer.is_global_zero:
-                    logger.info(ds_name+'_MPJPE: ' + str(mpjpe))
-                    logger.info(ds_name+'_PA-MPJPE: ' + str(pampjpe))
-                    logger.info(ds_name+'_PVE: ' + str(pve))
+        for ds_idx, ds in enumerate(self.val_ds):
+            ds_name = ds.dataset
+            mpjpe = 1000 * results[ds_name]['mpjpe']
+            pampjpe = 1000 * results[ds_name]['pampjpe']
+            pve = 1000 * results[ds_name]['pve']
 
-                    val_log[ds_name+'_val_mpjpe'] = mpjpe
-                    val_log[ds_name+'_val_pampjpe'] = pampjpe
-                    val_log[ds_name+'_val_pve'] = pve
+            if self.trainer.is_global_zero:
+                logger.info(ds_name + '_MPJPE: ' + str(mpjpe))
+                logger.info(ds_name + '_PA-MPJPE: ' + str(pampjpe))
+                logger.info(ds_name + '_PVE: ' + str(pve))
 
-        self.log('val_loss', val_log[self.val_ds[0].dataset+'_val_pampjpe'], logger=True, sync_dist=True)#rank_zero_only=True)
-        self.log('val_loss_mpjpe', val_log[self.val_ds[0].dataset+'_val_mpjpe'], logger=True, sync_dist=True)# rank_zero_only=True)
+            val_log[ds_name + '_val_mpjpe'] = mpjpe
+            val_log[ds_name + '_val_pampjpe'] = pampjpe
+            val_log[ds_name + '_val_pve'] = pve
 
+        self.log('val_loss', val_log[self.val_ds[0].dataset + '_val_pampjpe'], logger=True)
+        self.log('val_loss_mpjpe', val_log[self.val_ds[0].dataset + '_val_mpjpe'], logger=True)
         for k, v in val_log.items():
-            self.log(k, v, logger=True, sync_dist=True)# rank_zero_only=True)
+            self.log(k, v, logger=True)
+        self.log_image_cache()
+
+    def on_train_epoch_start(self):
+        self.train_batch_idx = 0
+
+    def on_train_epoch_end(self, *args):
+        self.log_image_cache()
+
+    def on_save_checkpoint(self, checkpoint):
+        if self.train_sampler is not None:
+            consumed = self.train_batch_idx * self.hparams.DATASET.BATCH_SIZE
+            checkpoint['mixing_sampler'] = self.train_sampler.state_dict(
+                consumed, batch_size=self.hparams.DATASET.BATCH_SIZE, trainer_epoch=checkpoint.get('epoch'))
+
+    def on_load_checkpoint(self, checkpoint):
+        # Applied when the train dataloader is created
+        self.train_sampler_state = checkpoint.get('mixing_sampler')
+
+    def log_image_cache(self):
+        if self.image_cache is None:
+            return
+        # Counters are per process, every rank has its own cache
+        for k, v in self.image_cache.stats().items():
+            self.log(f'image_cache/{k}', float(v), logger=True)
 
     def gt_projection(self, input_batch, output, batch_idx, max_save_img=1):
         save_dir = os.path.join(self.hparams.LOG_DIR, 'output_images_gt')
@@ -397,12 +414,36 @@ class HMRTrainer(pl.LightningModule):
         set_seed(self.hparams.SEED_VALUE)
         self.train_ds = self.train_dataset()
 
+        if self.hparams.DATASET.MIXING_SAMPLER:
+            self.train_sampler = MixingSampler(
+                dataset_sizes=self.train_ds.dataset_sizes,
+                ratios=self.train_ds.dataset_ratios,
+                num_samples=len(self.train_ds),
+                seed=self.hparams.SEED_VALUE,
+            )
+            if self.train_sampler_state is not None:
+                self.train_sampler.load_state_dict(self.train_sampler_state)
+                self.train_sampler_state = None
+                logger.info(f'Resuming epoch {self.train_sampler.epoch} '
+                            f'from sample {self.train_sampler.start_offset}')
+            return DataLoader(
+                dataset=self.train_ds,
+                batch_size=self.hparams.DATASET.BATCH_SIZE,
+                num_workers=self.hparams.DATASET.NUM_WORKERS,
+                pin_memory=self.hparams.DATASET.PIN_MEMORY,
+                sampler=self.train_sampler,
+                drop_last=True,
+            )
+
+        sampler = get_distributed_sampler(self.train_ds, shuffle=self.hparams.DATASET.SHUFFLE_TRAIN,
+                                          seed=self.hparams.SEED_VALUE)
         return DataLoader(
             dataset=self.train_ds,
             batch_size=self.hparams.DATASET.BATCH_SIZE,
             num_workers=self.hparams.DATASET.NUM_WORKERS,
             pin_memory=self.hparams.DATASET.PIN_MEMORY,
-            shuffle=self.hparams.DATASET.SHUFFLE_TRAIN,
+            shuffle=self.hparams.DATASET.SHUFFLE_TRAIN and sampler is None,
+            sampler=sampler,
             drop_last=True
         )
 
@@ -428,6 +469,7 @@ class HMRTrainer(pl.LightningModule):
                     dataset=val_ds,
                     batch_size=self.hparams.DATASET.BATCH_SIZE,
                     shuffle=False,
+                    sampler=get_distributed_sampler(val_ds),
                     num_workers=self.hparams.DATASET.NUM_WORKERS,
                     drop_last=True
                 )
@@ -18,9 +18,11 @@ from ..models.head.smplx_head_cam_full import SMPLX
 from ..dataset.datasetx import DatasetHMR
 from ..utils.abs2rel import pose_abs2rel
 
-from ..utils.eval_utils import reconstruction_error
+from ..utils.eval_utils import reconstruction_error_torch
+from ..utils.metrics import MetricAccumulator
 from ..utils.image_utils import denormalize_images
 from ..utils.image_utils import read_img
+from ..utils.dataloader import CheckpointDataLoader, get_distributed_sampler
 from ..utils.renderer_cam import render_image_group
 from ..utils.renderer import Renderer
 from ..models.hmr import HMR
@@ -147,6 +149,10 @@ class SMPLXTrainer(pl.LightningModule):
         self.flip_vector = self.flip_vector.reshape(1, 3, 3).cuda()
 
         self.val_ds = self.val_dataset()
+        # Position in the training epoch, restored with the checkpoint
+        self.train_loader = None
+        self.train_loader_state = None
+        self.train_batch_idx = 0
         self.normalize_img = Normalize(mean=constants.IMG_NORM_MEAN, std=constants.IMG_NORM_STD)
 
     def forward(self, body_feat, lhand_feat, rhand_feat, body_pose, body_shape, body_cam, left_hand_pose, right_hand_pose, bbox_center, bbox_scale, img_w, img_h, fl=None):
@@ -201,6 +207,8 @@ class SMPLXTrainer(pl.LightningModule):
 
         for k, v in loss_dict.items():
             self.log(k, v, logger=True, sync_dist=True)
+        # Counted here and not in on_train_batch_end, the step checkpoint callbacks run before it
+        self.train_batch_idx += 1
         return {'loss': loss}
 
     def validation_step(self, batch, batch_nb, dataloader_nb=0, vis=False, save=True, mesh_save_dir=None):
@@ -208,10 +216,8 @@ class SMPLXTrainer(pl.LightningModule):
         images = batch['img']
         batch_size = images.shape[0]
         dataset_names = batch['dataset_name']
-        dataset_index = batch['dataset_index'].detach().cpu().numpy()
         bbox_scale = batch['scale']
         bbox_center = batch['center']
-        val_dataset_names = self.hparams.DATASET.VAL_DS.split('_')
         img_h = batch['orig_shape'][:, 0]
         img_w = batch['orig_shape'][:, 1]
 
@@ -267,90 +273,66 @@ class SMPLXTrainer(pl.LightningModule):
         pred_cam_vertices = full_body_pred['vertices']
         pred_joints = full_body_pred['joints3d']
         # Calculate v2v, hand joints, body joints error
-        error_verts = torch.sqrt(((pred_cam_vertices - gt_cam_vertices) ** 2).sum(dim=-1)).cpu().numpy()
-        error_body_joints = torch.sqrt(((pred_joints[:, :24] - gt_joints[:, :24]) ** 2).sum(dim=-1)).cpu().numpy()
-        r_error, _ = reconstruction_error(pred_joints[:, :24].cpu().numpy(),
-                                            gt_joints[:, :24].cpu().numpy(),
-                                            reduction=None)
+        error_verts = torch.sqrt(((pred_cam_vertices - gt_cam_vertices) ** 2).sum(dim=-1))
+        error_body_joints = torch.sqrt(((pred_joints[:, :24] - gt_joints[:, :24]) ** 2).sum(dim=-1))
+        r_error, _ = reconstruction_error_torch(pred_joints[:, :24],
+                                                gt_joints[:, :24],
+                                                reduction=None)
         pred_rhand_joints = pred_joints[:, [21, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54]] - pred_joints[:, [21]]
         gt_rhand_joints = gt_joints[:, [21, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54]] - gt_joints[:, [21]]
         pred_lhand_joints = pred_joints[:, [20, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39]] - pred_joints[:, [20]]
         gt_lhand_joints = gt_joints[:, [20, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39]] - gt_joints[:, [20]]
     
-        error_lhand_joints = torch.sqrt(((pred_lhand_joints - gt_lhand_joints) ** 2).sum(dim=-1)).cpu().numpy()
-        error_rhand_joints = torch.sqrt(((pred_rhand_joints - gt_rhand_joints) ** 2).sum(dim=-1)).cpu().numpy()
-
-        val_mpjpe = error_body_joints.mean(-1)
-        val_pampjpe = r_error.mean(-1)      
-        val_pve = error_verts.mean(-1)
+        error_lhand_joints = torch.sqrt(((pred_lhand_joints - gt_lhand_joints) ** 2).sum(dim=-1))
+        error_rhand_joints = torch.sqrt(((pred_rhand_joints - gt_rhand_joints) ** 2).sum(dim=-1))
+
+        self.val_metrics.update(
+            batch['dataset_index'],
+            mpjpe=error_body_joints.mean(-1),
+            pampjpe=r_error.mean(-1),
+            pve=error_verts.mean(-1),
+            lhand=error_lhand_joints.mean(-1),
+            rhand=error_rhand_joints.mean(-1),
+        )
+   
+    def on_validation_epoch_start(self):
+        self.val_metrics = MetricAccumulator(self.hparams.DATASET.VAL_DS.split('_'), ['mpjpe', 'pampjpe', 'pve', 'lhand', 'rhand'],
+                                             device=self.device)
 
-        val_lhand = error_lhand_joints.mean(-1)
-        val_rhand = error_rhand_joints.mean(-1)
-        loss_dict = {}
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
 
-        for ds_idx, ds in enumerate(self.val_ds):
-            ds_name = ds.dataset
-            ds_idx = val_dataset_names.index(ds.dataset)
-            idxs = np.where(dataset_index == ds_idx)
-            loss_dict[ds_name + '_mpjpe'] = list(val_mpjpe[idxs])
-            loss_dict[ds_name + '_pampjpe'] = list(val_pampjpe[idxs])
-            loss_dict[ds_name + '_lhand'] = list(val_lhand[idxs])
-            loss_dict[ds_name + '_rhand'] = list(val_rhand[idxs])
-            loss_dict[ds_name + '_pve'] = list(val_pve[idxs])
-
-        return loss_dict
-   
     def validation_epoch_end(self, outputs):
         logger.info(f'***** Epoch {self.current_epoch} *****')
         val_log = {}
+        # Already reduced over the ranks
+        results = self.val_metrics.compute()
         for ds_idx, ds in enumerate(self.val_ds):
             ds_name = ds.dataset
-
-            if len(self.val_ds) > 1:
-                mpjpe = 1000 * np.hstack(np.array([val[ds_name + '_mpjpe'] for x in outputs for val in x])).mean()
-                pampjpe = (1000 * np.hstack(np.array([val[ds_name + '_pampjpe'] for x in outputs for val in x]))).mean()
-                lhand = 1000 * np.hstack(np.array([val[ds_name + '_lhand'] for x in outputs for val in x])).mean()
-                rhand = (1000 * np.hstack(np.array([val[ds_name + '_rhand'] for x in outputs for val in x]))).mean()
-                pve = (1000 * np.hstack(np.array([val[ds_name + '_pve'] for x in outputs for val in x]))).mean()
-
-                if self.trainer.is_global_zero:
-                    logger.info(ds_name + '_MPJPE: ' + str(mpjpe))
-                    logger.info(ds_name + '_PA-MPJPE: ' + str(pampjpe))
-                    logger.info(ds_name + '_LHAND: ' + str(lhand))
-                    logger.info(ds_name + '_RHAND: ' + str(rhand))
-                    logger.info(ds_name + '_PVE: ' + str(pve))
-
-                    val_log[ds_name + '_val_mpjpe'] = mpjpe
-                    val_log[ds_name + '_val_pampjpe'] = pampjpe
-                    val_log[ds_name + '_val_lhand'] = lhand
-                    val_log[ds_name + '_val_rhand'] = rhand
-                    val_log[ds_name + '_val_pve'] = pve
-            else:
-                mpjpe = 1000 * np.hstack(np.array([x[ds_name + '_mpjpe'] for x in outputs])).mean()
-                pampjpe = (1000 * np.hstack(np.array([x[ds_name + '_pampjpe'] for x in outputs]))).mean()
-                lhand = 1000 * np.hstack(np.array([x[ds_name + '_lhand'] for x in outputs])).mean()
-                rhand = (1000 * np.hstack(np.array([x[ds_name + '_rhand'] for x in outputs]))).mean()
-                pve = (1000 * np.hstack(np.array([x[ds_name + '_pve'] for x in outputs]))).mean()
-
-                if self.trainer.is_global_zero:
-                    logger.info(ds_name + '_MPJPE: ' + str(mpjpe))
-                    logger.info(ds_name + '_PA-MPJPE: ' + str(pampjpe))
-                    logger.info(ds_name + '_LHAND: ' + str(lhand))
-                    logger.info(ds_name + '_RHAND: ' + str(rhand))
-                    logger.info(ds_name + '_PVE: ' + str(pve))
-
-                    val_log[ds_name + '_val_mpjpe'] = mpjpe
-                    val_log[ds_name + '_val_pampjpe'] = pampjpe
-                    val_log[ds_name + '_val_lhand'] = lhand
-                    val_log[ds_name + '_val_rhand'] = rhand
-                    val_log[ds_name + '_val_pve'] = pve
-
-
-        self.log('val_loss', val_log[self.val_ds[0].dataset + '_val_pampjpe'], logger=True, sync_dist=True, rank_zero_only=True)
-        self.log('val_loss_mpjpe', val_log[self.val_ds[0].dataset + '_val_mpjpe'], logger=True, sync_dist=True, rank_zero_only=True)
+            mpjpe = 1000 * results[ds_name]['mpjpe']
+            pampjpe = 1000 * results[ds_name]['pampjpe']
+            lhand = 1000 * results[ds_name]['lhand']
+            rhand = 1000 * results[ds_name]['rhand']
+            pve = 1000 * results[ds_name]['pve']
+
+            if self.trainer.is_global_zero:
+                logger.info(ds_name + '_MPJPE: ' + str(mpjpe))
+                logger.info(ds_name + '_PA-MPJPE: ' + str(pampjpe))
+                logger.info(ds_name + '_LHAND: ' + str(lhand))
+                logger.info(ds_name + '_RHAND: ' + str(rhand))
+                logger.info(ds_name + '_PVE: ' + str(pve))
+
+            val_log[ds_name + '_val_mpjpe'] = mpjpe
+            val_log[ds_name + '_val_pampjpe'] = pampjpe
+            val_log[ds_name + '_val_lhand'] = lhand
+            val_log[ds_name + '_val_rhand'] = rhand
+            val_log[ds_name + '_val_pve'] = pve
+
+        self.log('val_loss', val_log[self.val_ds[0].dataset + '_val_pampjpe'], logger=True)
+        self.log('val_loss_mpjpe', val_log[self.val_ds[0].dataset + '_val_mpjpe'], logger=True)
 
         for k, v in val_log.items():
-            self.log(k, v, logger=True, sync_dist=True, rank_zero_only=True)
+            self.log(k, v, logger=True)
 
     def gt_projection(self, input_batch, output, batch_idx, max_save_img=1):
         save_dir = os.path.join(self.hparams.LOG_DIR, 'output_images_gt')
@@ -515,6 +497,18 @@ class SMPLXTrainer(pl.LightningModule):
     def test_epoch_end(self, outputs):
         return self.validation_epoch_end(outputs)
 
+    def on_train_epoch_start(self):
+        self.train_batch_idx = 0
+
+    def on_save_checkpoint(self, checkpoint):
+        if isinstance(self.train_loader, CheckpointDataLoader):
+            checkpoint['train_loader'] = self.train_loader.state_dict(
+                self.train_batch_idx, trainer_epoch=checkpoint.get('epoch'))
+
+    def on_load_checkpoint(self, checkpoint):
+        # Applied when the train dataloader is created
+        self.train_loader_state = checkpoint.get('train_loader')
+
     def configure_optimizers(self):
         if self.hparams.OPTIMIZER.TYPE == 'sgd':
             return torch.optim.SGD(self.parameters(), lr=self.hparams.OPTIMIZER.LR, momentum=0.9)
@@ -538,14 +532,18 @@ class SMPLXTrainer(pl.LightningModule):
     def train_dataloader(self):
         self.train_ds = self.train_dataset()
 
-        return DataLoader(
+        self.train_loader = CheckpointDataLoader(
             dataset=self.train_ds,
+            checkpoint=self.train_loader_state,
             batch_size=self.hparams.DATASET.BATCH_SIZE,
             num_workers=self.hparams.DATASET.NUM_WORKERS,
             pin_memory=self.hparams.DATASET.PIN_MEMORY,
             shuffle=self.hparams.DATASET.SHUFFLE_TRAIN,
-            drop_last=True
+            drop_last=True,
+            seed=self.hparams.SEED_VALUE,
         )
+        self.train_loader_state = None
+        return self.train_loader
 
     def val_dataset(self):
         datasets = self.hparams.DATASET.VAL_DS.split('_')
@@ -569,6 +567,7 @@ class SMPLXTrainer(pl.LightningModule):
                     dataset=val_ds,
                     batch_size=self.hparams.DATASET.BATCH_SIZE,
                     shuffle=False,
+                    sampler=get_distributed_sampler(val_ds),
                     num_workers=self.hparams.DATASET.NUM_WORKERS,
                     drop_last=True
                 )
@@ -2,7 +2,6 @@
 import os
 import cv2
 import torch
-import tqdm
 from loguru import logger
 import numpy as np
 from . import constants
@@ -16,14 +15,22 @@ from .config import update_hparams
 from ..models.hmr import HMR
 from ..models.head.smplx_cam_head import SMPLXCamHead
 from ..utils.renderer_cam import render_image_group
-from ..utils.renderer_pyrd import Renderer
-from ..utils.image_utils import crop
+from ..utils.renderer_pyrd import get_renderer, delete_renderers
+from ..utils.image_utils import get_crop_fn
+from ..utils.crop_batcher import CropBatcher
+from ..utils.inference_pipeline import InferencePipeline
+from ..utils.video_io import VideoReader, VideoResults, OrderedVideoWriter, detect_frames
+
+
+def read_image(img_fname):
+    return cv2.cvtColor(cv2.imread(img_fname), cv2.COLOR_BGR2RGB)
 
 
 class Tester:
     def __init__(self, args):
         self.args = args
         self.model_cfg = update_hparams(args.cfg)
+        self.crop_fn = get_crop_fn(self.model_cfg.DATASET.CROP_ENGINE)
         self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
         self.normalize_img = Normalize(mean=constants.IMG_NORM_MEAN, std=constants.IMG_NORM_STD)
         self.bboxes_dict = {}
@@ -50,9 +57,8 @@ class Tester:
         load_pretrained_model(self.model, ckpt, overwrite_shape_mismatch=True, remove_lightning=True)
         logger.info(f'Loaded pretrained weights from \"{self.args.ckpt}\"')
 
-    def run_detector(self, all_image_folder):
-        # run multi object tracker
-        mot = MPT(
+    def build_tracker(self):
+        return MPT(
             device=self.device,
             batch_size=self.args.tracker_batch_size,
             display=False,
@@ -60,6 +66,10 @@ class Tester:
             output_format='dict',
             yolo_img_size=self.args.yolo_img_size,
         )
+
+    def run_detector(self, all_image_folder):
+        # run multi object tracker
+        mot = self.build_tracker()
         bboxes = []
         for fold_id, image_folder in enumerate(all_image_folder):
             bboxes.append(mot.detect(image_folder))
@@ -74,8 +84,61 @@ class Tester:
                 fname = os.path.join('/'.join(bbox_folder.split('/')[-3:-1]),bbox_file.replace('.txt','.png'))
                 self.bboxes_dict[fname] = bbox
 
+    def crop_detections(self, img, dets):
+        """Normalized crops of the detections of an image, their bbox centers and scales."""
+        img_res = self.model_cfg.DATASET.IMG_RES
+        crops = torch.zeros(len(dets), 3, img_res, img_res, dtype=torch.float)
+        bbox_scale = []
+        bbox_center = []
+        for det_idx, det in enumerate(dets):
+            bbox = det
+            bbox_scale.append(bbox[2] / 200.)
+            bbox_center.append([bbox[0], bbox[1]])
+            rgb_img = self.crop_fn(img, bbox_center[-1], bbox_scale[-1], [img_res, img_res])
+            rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
+            rgb_img = torch.from_numpy(rgb_img)
+            crops[det_idx] = self.normalize_img(rgb_img)
+        return crops, bbox_center, bbox_scale
+
+    def forward_crops(self, batch):
+        # Crops of several images, see utils/crop_batcher.py
+        return self.model(batch['img'], bbox_center=batch['bbox_center'], bbox_scale=batch['bbox_scale'],
+                          img_w=batch['img_w'], img_h=batch['img_h'])
+
+    def make_pipeline(self):
+        # The crops of consecutive images are batched together up to args.batch_size
+        batcher = CropBatcher(self.forward_crops, batch_size=getattr(self.args, 'batch_size', 32), device=self.device)
+        return InferencePipeline(batcher,
+                                 num_readers=getattr(self.args, 'num_readers', 4),
+                                 num_crop_workers=getattr(self.args, 'num_crop_workers', 2),
+                                 num_writers=getattr(self.args, 'num_writers', 2),
+                                 queue_size=getattr(self.args, 'queue_size', 16),
+                                 writer_cleanup=delete_renderers)
+
+    def render_overlay(self, img, hmr_output):
+        orig_height, orig_width = img.shape[:2]
+        focal_length = (orig_width * orig_width + orig_height * orig_height) ** 0.5
+        pred_vertices_array = (hmr_output['vertices'] + hmr_output['pred_cam_t'].unsqueeze(1)).detach().cpu().numpy()
+        renderer = get_renderer(focal_length=focal_length, img_w=orig_width, img_h=orig_height,
+                                faces=self.smplx_cam_head.smplx.faces)
+        return renderer.render_front_view(pred_vertices_array,
+                                          bg_img_rgb=img.copy())
+
+    def render_image(self, basename, img, hmr_output, output_folder):
+        front_view = self.render_overlay(img, hmr_output)
+
+        # save rendering results
+        filename = basename + "pred_%s.jpg" % 'bedlam'
+        filename_orig = basename + "orig_%s.jpg" % 'bedlam'
+        front_view_path = os.path.join(output_folder, filename)
+        orig_path = os.path.join(output_folder, filename_orig)
+        logger.info(f'Writing output files to {output_folder}')
+        cv2.imwrite(front_view_path, front_view[:, :, ::-1])
+        cv2.imwrite(orig_path, img[:, :, ::-1])
+
     @torch.no_grad()
     def run_on_image_folder(self, all_image_folder, detections, output_folder, visualize_proj=True):
+        items = []
         for fold_idx, image_folder in enumerate(all_image_folder):
             image_file_names = [
                 os.path.join(image_folder, x)
@@ -83,62 +146,24 @@ class Tester:
                 if x.endswith('.png') or x.endswith('.jpg') or x.endswith('.jpeg')
             ]
             image_file_names = (sorted(image_file_names))
-            for img_idx, img_fname in tqdm.tqdm(enumerate(image_file_names)):
-                
+            for img_idx, img_fname in enumerate(image_file_names):
                 dets = detections[fold_idx][img_idx]
                 if len(dets) < 1:
                     continue
+                items.append((img_fname, (img_fname, dets)))
 
-                img = cv2.cvtColor(cv2.imread(img_fname), cv2.COLOR_BGR2RGB)
-                orig_height, orig_width = img.shape[:2]
-                inp_images = torch.zeros(len(dets), 3, self.model_cfg.DATASET.IMG_RES,
-                                         self.model_cfg.DATASET.IMG_RES, device=self.device, dtype=torch.float)
-
-                batch_size = inp_images.shape[0]
-                bbox_scale = []
-                bbox_center = []
-
-                for det_idx, det in enumerate(dets):
-                    bbox = det
-                    bbox_scale.append(bbox[2] / 200.)
-                    bbox_center.append([bbox[0], bbox[1]])
-                    rgb_img = crop(img, bbox_center[-1], bbox_scale[-1],[self.model_cfg.DATASET.IMG_RES, self.model_cfg.DATASET.IMG_RES])
-                    rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
-                    rgb_img = torch.from_numpy(rgb_img)
-                    norm_img = self.normalize_img(rgb_img)
-                    inp_images[det_idx] = norm_img.float().to(self.device)
-
-                bbox_center = torch.tensor(bbox_center).cuda().float()
-                bbox_scale = torch.tensor(bbox_scale).cuda().float()
-                img_h = torch.tensor(orig_height).repeat(batch_size).cuda().float()
-                img_w = torch.tensor(orig_width).repeat(batch_size).cuda().float()
-                focal_length = ((img_w * img_w + img_h * img_h) ** 0.5).cuda().float()
-                hmr_output = self.model(inp_images, bbox_center=bbox_center, bbox_scale=bbox_scale, img_w=img_w, img_h=img_h)
-
-                focal_length = (img_w * img_w + img_h * img_h) ** 0.5
-                pred_vertices_array = (hmr_output['vertices'] + hmr_output['pred_cam_t'].unsqueeze(1)).detach().cpu().numpy()
-                renderer = Renderer(focal_length=focal_length[0], img_w=img_w[0], img_h=img_h[0],
-                                    faces=self.smplx_cam_head.smplx.faces,
-                                    same_mesh_color=False)
-                front_view = renderer.render_front_view(pred_vertices_array,
-                                                        bg_img_rgb=img.copy())
-
-                # save rendering results
-                basename = img_fname.split('/')[-1]
-                filename = basename + "pred_%s.jpg" % 'bedlam'
-                filename_orig = basename + "orig_%s.jpg" % 'bedlam'
-                front_view_path = os.path.join(output_folder, filename)
-                orig_path = os.path.join(output_folder, filename_orig)
-                logger.info(f'Writing output files to {output_folder}')
-                cv2.imwrite(front_view_path, front_view[:, :, ::-1])
-                cv2.imwrite(orig_path, img[:, :, ::-1])
-                renderer.delete()
+        def crop(item, img):
+            orig_height, orig_width = img.shape[:2]
+            return (*self.crop_detections(img, item[1]), orig_width, orig_height)
+
+        def write(img_fname, img, hmr_output):
+            self.render_image(img_fname.split('/')[-1], img, hmr_output, output_folder)
+
+        self.make_pipeline().run(items, lambda item: read_image(item[0]), crop, write)
 
     @torch.no_grad()
     def run_on_hbw_folder(self, all_image_folder, detections, output_folder, data_split='test', visualize_proj=True):
-        img_names = []
-        verts = []
-        image_file_names = []
+        items = []
         for fold_idx, image_folder in enumerate(all_image_folder):
             image_file_names = [
                 os.path.join(image_folder, x)
@@ -148,120 +173,113 @@ class Tester:
             image_file_names = (sorted(image_file_names))
             print(image_folder, len(image_file_names))
 
-            for img_idx, img_fname in tqdm.tqdm(enumerate(image_file_names)):
+            for img_idx, img_fname in enumerate(image_file_names):
+                # Images without detection are not read and get the template vertices
+                dets = None
                 if detections:
-                    dets = detections[fold_idx][img_idx]
-                    if len(dets) < 1:
-                        img_names.append('/'.join(img_fname.split('/')[-4:]).replace(data_split + '_small_resolution', data_split))
-                        template_verts = self.smplx_cam_head.smplx().vertices[0].detach().cpu().numpy()
-                        verts.append(template_verts)
-                        continue
+                    if len(detections[fold_idx][img_idx]) >= 1:
+                        dets = detections[fold_idx][img_idx]
                 else:
                     match_fname = '/'.join(img_fname.split('/')[-3:])
-                    if match_fname not in self.bboxes_dict.keys():
-                        img_names.append('/'.join(img_fname.split('/')[-4:]).replace(data_split + '_small_resolution', data_split))
-                        template_verts = self.smplx_cam_head.smplx().vertices[0].detach().cpu().numpy()
-                        verts.append(template_verts)
-                        continue
-                    dets = self.bboxes_dict[match_fname]
-                img = cv2.cvtColor(cv2.imread(img_fname), cv2.COLOR_BGR2RGB)
-                orig_height, orig_width = img.shape[:2]
-                inp_images = torch.zeros(1, 3, self.model_cfg.DATASET.IMG_RES,
-                                         self.model_cfg.DATASET.IMG_RES, device=self.device, dtype=torch.float)
-                batch_size = inp_images.shape[0]
-                bbox_scale = []
-                bbox_center = []
-                if len(dets.shape)==1:
+                    if match_fname in self.bboxes_dict.keys():
+                        dets = self.bboxes_dict[match_fname]
+                if dets is not None and len(dets.shape) == 1:
                     dets = np.expand_dims(dets, 0)
-                for det_idx, det in enumerate(dets):
-                    if det_idx>=1:
-                        break
-                    bbox = det
-                    bbox_scale.append(bbox[2] / 200.)
-                    bbox_center.append([bbox[0], bbox[1]])
-                    rgb_img = crop(img, bbox_center[-1], bbox_scale[-1],[self.model_cfg.DATASET.IMG_RES, self.model_cfg.DATASET.IMG_RES])
-                    rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
-                    rgb_img = torch.from_numpy(rgb_img)
-                    norm_img = self.normalize_img(rgb_img)
-                    inp_images[det_idx] = norm_img.float().to(self.device)
-
-                bbox_center = torch.tensor(bbox_center).cuda().float()
-                bbox_scale = torch.tensor(bbox_scale).cuda().float()
-                img_h = torch.tensor(orig_height).repeat(batch_size).cuda().float()
-                img_w = torch.tensor(orig_width).repeat(batch_size).cuda().float()
-                focal_length = ((img_w * img_w + img_h * img_h) ** 0.5).cuda().float()
-
-                hmr_output = self.model(inp_images, bbox_center=bbox_center, bbox_scale=bbox_scale, img_w=img_w, img_h=img_h)
-                img_names.append('/'.join(img_fname.split('/')[-4:]).replace(data_split + '_small_resolution', data_split))
-                template_verts = self.smplx_cam_head.smplx(betas=hmr_output['pred_shape'], pose2rot=False).vertices[0].detach().cpu().numpy()
-                verts.append(template_verts)
-                if visualize_proj:
-                    focal_length = (img_w * img_w + img_h * img_h) ** 0.5
-
-                    pred_vertices_array = (hmr_output['vertices'][0] + hmr_output['pred_cam_t']).unsqueeze(0).detach().cpu().numpy()
-                    renderer = Renderer(focal_length=focal_length, img_w=img_w, img_h=img_h,
-                                        faces=self.smplx_cam_head.smplx.faces,
-                                        same_mesh_color=False)
-                    front_view = renderer.render_front_view(pred_vertices_array,
-                                                            bg_img_rgb=img.copy())
-
-                    # save rendering results
-                    basename = img_fname.split('/')[-3]+'_'+img_fname.split('/')[-2]+'_'+img_fname.split('/')[-1]
-                    filename = basename + "pred_%s.jpg" % 'bedlam'
-                    filename_orig = basename + "orig_%s.jpg" % 'bedlam'
-                    front_view_path = os.path.join(output_folder, filename)
-                    orig_path = os.path.join(output_folder, filename_orig)
-                    logger.info(f'Writing output files to {output_folder}')
-                    cv2.imwrite(front_view_path, front_view[:, :, ::-1])
-                    cv2.imwrite(orig_path, img[:, :, ::-1])
-                    renderer.delete()
+                items.append((img_fname, (img_fname, dets)))
+
+        def read(item):
+            if item[1] is None:
+                return None
+            return read_image(item[0])
+
+        def crop(item, img):
+            if item[1] is None:
+                return torch.zeros(0, 3, self.model_cfg.DATASET.IMG_RES, self.model_cfg.DATASET.IMG_RES), [], [], 0, 0
+            orig_height, orig_width = img.shape[:2]
+            # Only the first detection is used
+            return (*self.crop_detections(img, item[1][:1]), orig_width, orig_height)
+
+        def write(img_fname, img, hmr_output):
+            img_name = '/'.join(img_fname.split('/')[-4:]).replace(data_split + '_small_resolution', data_split)
+            if img is None:
+                return img_name, self.smplx_cam_head.smplx().vertices[0].detach().cpu().numpy()
+            template_verts = self.smplx_cam_head.smplx(betas=hmr_output['pred_shape'], pose2rot=False).vertices[0].detach().cpu().numpy()
+            if visualize_proj:
+                basename = img_fname.split('/')[-3]+'_'+img_fname.split('/')[-2]+'_'+img_fname.split('/')[-1]
+                self.render_image(basename, img, hmr_output, output_folder)
+            return img_name, template_verts
+
+        results = self.make_pipeline().run(items, read, crop, write)
+        img_names = [r[0] for r in results]
+        verts = [r[1] for r in results]
         np.savez(os.path.join(output_folder, data_split + '_hbw_prediction.npz'), image_name=img_names, v_shaped=verts)
-               
+
+    @torch.no_grad()
     def run_on_dataframe(self, dataframe_path, output_folder, visualize_proj=True):
         dataframe = np.load(dataframe_path)
         centers = dataframe['center']
         scales = dataframe['scale']
         image = dataframe['image']
-        for ind, center in tqdm.tqdm(enumerate(centers)):
-            center = centers[ind]
-            scale = scales[ind]
-            img = image[ind]
-            orig_height, orig_width = img.shape[:2]
-            rgb_img = crop(img, center, scale, [self.hparams.DATASET.IMG_RES, self.hparams.DATASET.IMG_RES])
-
-            rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
-            rgb_img = torch.from_numpy(rgb_img).float().cuda()
-            rgb_img = self.normalize_img(rgb_img)
+        items = [(ind, ind) for ind in range(len(centers))]
 
-            img_h = torch.tensor(orig_height).repeat(1).cuda().float()
-            img_w = torch.tensor(orig_width).repeat(1).cuda().float()
-            center = torch.tensor(center).cuda().float()
-            scale = torch.tensor(scale).cuda().float()
+        def crop(ind, img):
+            orig_height, orig_width = img.shape[:2]
+            return (*self.crop_detections(img, [[*centers[ind], scales[ind] * 200.]]), orig_width, orig_height)
 
-            hmr_output = self.model(rgb_img.unsqueeze(0), bbox_center=center.unsqueeze(0), bbox_scale=scale.unsqueeze(0), img_w=img_w, img_h=img_h)
+        def write(ind, img, hmr_output):
             # Need to convert SMPL-X meshes to SMPL using conversion tool before calculating error
             import trimesh
             mesh = trimesh.Trimesh(vertices=hmr_output['vertices'][0].detach().cpu().numpy(),faces=self.smplx_cam_head.smplx.faces)
             output_mesh_path = os.path.join(output_folder, str(ind)+'.obj')
             mesh.export(output_mesh_path)
-
             if visualize_proj:
-                focal_length = (img_w * img_w + img_h * img_h) ** 0.5
-
-                pred_vertices_array = (hmr_output['vertices'][0] + hmr_output['pred_cam_t']).unsqueeze(0).detach().cpu().numpy()
-                renderer = Renderer(focal_length=focal_length, img_w=img_w, img_h=img_h,
-                                    faces=self.smplx_cam_head.smplx.faces,
-                                    same_mesh_color=False)
-                front_view = renderer.render_front_view(pred_vertices_array,
-                                                        bg_img_rgb=img.copy())
-
-                # save rendering results
-                basename = str(ind)
-                filename = basename + "pred_%s.jpg" % 'bedlam'
-                filename_orig = basename + "orig_%s.jpg" % 'bedlam'
-                front_view_path = os.path.join(output_folder, filename)
-                orig_path = os.path.join(output_folder, filename_orig)
-                logger.info(f'Writing output files to {output_folder}')
-                cv2.imwrite(front_view_path, front_view[:, :, ::-1])
-                cv2.imwrite(orig_path, img[:, :, ::-1])
-                renderer.delete()
\ No newline at end of file
+                self.render_image(str(ind), img, hmr_output, output_folder)
+
+        self.make_pipeline().run(items, lambda ind: image[ind], crop, write)
+
+    @torch.no_grad()
+    def run_on_video(self, video, output_folder, visualize_proj=True):
+        """
+        Runs on the frames of a video file, stream url or camera index without writing them to disk.
+        Saves <name>_results.npz and with visualize_proj the rendered <name>_result.mp4.
+        """
+        reader = VideoReader(video, queue_size=getattr(self.args, 'queue_size', 16))
+        results = VideoResults(os.path.join(output_folder, reader.name + '_results.npz'))
+        video_writer = None
+        if visualize_proj:
+            video_writer = OrderedVideoWriter(os.path.join(output_folder, reader.name + '_result.mp4'),
+                                              reader.fps, reader.width, reader.height)
+        mot = self.build_tracker()
+
+        def frames():
+            # The frames are detected in batches of args.tracker_batch_size
+            for batch in reader.batches(self.args.tracker_batch_size):
+                detections = detect_frames(mot, [frame for _, frame in batch])
+                for (frame_idx, frame), dets in zip(batch, detections):
+                    yield (frame_idx, dets), (frame, dets)
+
+        def crop(item, frame):
+            orig_height, orig_width = frame.shape[:2]
+            return (*self.crop_detections(frame, item[1]), orig_width, orig_height)
+
+        def write(key, frame, hmr_output):
+            frame_idx, dets = key
+            if len(dets) > 0:
+                results.add(frame_idx, {
+                    'bbox_center': dets[:, :2].astype(np.float32),
+                    'bbox_scale': (dets[:, 2] / 200.).astype(np.float32),
+                    'pred_pose': hmr_output['pred_pose'].cpu().numpy(),
+                    'pred_shape': hmr_output['pred_shape'].cpu().numpy(),
+                    'pred_cam_t': hmr_output['pred_cam_t'].cpu().numpy(),
+                    'joints2d': hmr_output['joints2d'][:, :24].cpu().numpy(),
+                })
+            if video_writer is not None:
+                video_writer.write(frame_idx, self.render_overlay(frame, hmr_output) if len(dets) > 0 else frame)
+
+        try:
+            self.make_pipeline().run(frames(), lambda item: item[0], crop, write)
+        finally:
+            reader.close()
+            if video_writer is not None:
+                video_writer.close()
+        results.save()
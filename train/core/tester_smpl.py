@@ -1,8 +1,8 @@
 
 import os
+import pickle
 import cv2
 import torch
-import tqdm
 from loguru import logger
 import numpy as np
 from . import constants
@@ -16,14 +16,21 @@ from .config import update_hparams
 from ..models.hmr import HMR
 from ..models.head.smpl_cam_head import SMPLCamHead
 from ..utils.renderer_cam import render_image_group
-from ..utils.renderer_pyrd import Renderer
-from ..utils.image_utils import crop
+from ..utils.renderer_pyrd import get_renderer, delete_renderers
+from ..utils.image_utils import get_crop_fn
+from ..utils.crop_batcher import CropBatcher
+from ..utils.inference_pipeline import InferencePipeline
+
+
+def read_image(img_fname):
+    return cv2.cvtColor(cv2.imread(img_fname), cv2.COLOR_BGR2RGB)
 
 
 class Tester:
     def __init__(self, args):
         self.args = args
         self.model_cfg = update_hparams(args.cfg)
+        self.crop_fn = get_crop_fn(self.model_cfg.DATASET.CROP_ENGINE)
         self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
         self.normalize_img = Normalize(mean=constants.IMG_NORM_MEAN, std=constants.IMG_NORM_STD)
         self.bboxes_dict = {}
@@ -66,9 +73,58 @@ class Tester:
 
         return bboxes
     
+    def crop_detections(self, img, dets):
+        """Normalized crops of the detections of an image, their bbox centers and scales."""
+        img_res = self.model_cfg.DATASET.IMG_RES
+        crops = torch.zeros(len(dets), 3, img_res, img_res, dtype=torch.float)
+        bbox_scale = []
+        bbox_center = []
+        for det_idx, det in enumerate(dets):
+            bbox = det
+            bbox_scale.append(bbox[2] / 200.)
+            bbox_center.append([bbox[0], bbox[1]])
+            rgb_img = self.crop_fn(img, bbox_center[-1], bbox_scale[-1], [img_res, img_res])
+            rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
+            rgb_img = torch.from_numpy(rgb_img)
+            crops[det_idx] = self.normalize_img(rgb_img)
+        return crops, bbox_center, bbox_scale
+
+    def forward_crops(self, batch):
+        # Crops of several images, see utils/crop_batcher.py
+        return self.model(batch['img'], bbox_center=batch['bbox_center'], bbox_scale=batch['bbox_scale'],
+                          img_w=batch['img_w'], img_h=batch['img_h'])
+
+    def make_pipeline(self):
+        # The crops of consecutive images are batched together up to args.batch_size
+        batcher = CropBatcher(self.forward_crops, batch_size=getattr(self.args, 'batch_size', 32), device=self.device)
+        return InferencePipeline(batcher,
+                                 num_readers=getattr(self.args, 'num_readers', 4),
+                                 num_crop_workers=getattr(self.args, 'num_crop_workers', 2),
+                                 num_writers=getattr(self.args, 'num_writers', 2),
+                                 queue_size=getattr(self.args, 'queue_size', 16),
+                                 writer_cleanup=delete_renderers)
+
+    def render_image(self, img_idx, img, hmr_output, output_folder):
+        orig_height, orig_width = img.shape[:2]
+        focal_length = (orig_width * orig_width + orig_height * orig_height) ** 0.5
+        pred_vertices_array = (hmr_output['vertices'] + hmr_output['pred_cam_t'].unsqueeze(1)).detach().cpu().numpy()
+        renderer = get_renderer(focal_length=focal_length, img_w=orig_width, img_h=orig_height,
+                                faces=self.smpl_cam_head.smpl.faces)
+        front_view = renderer.render_front_view(pred_vertices_array,
+                                                bg_img_rgb=img.copy())
+
+        # save rendering results
+        basename = str(img_idx)
+        filename = basename + "pred_%s.jpg" % 'bedlam'
+        filename_orig = basename + "orig_%s.jpg" % 'bedlam'
+        front_view_path = os.path.join(output_folder, filename)
+        orig_path = os.path.join(output_folder, filename_orig)
+        cv2.imwrite(front_view_path, front_view[:, :, ::-1])
+        cv2.imwrite(orig_path, img[:, :, ::-1])
+
     @torch.no_grad()
     def run_on_image_folder(self, all_image_folder, detections, output_folder, visualize_proj=True):
-
+        items = []
         for fold_idx, image_folder in enumerate(all_image_folder):
             image_file_names = [
                 os.path.join(image_folder, x)
@@ -76,62 +132,24 @@ class Tester:
                 if x.endswith('.png') or x.endswith('.jpg') or x.endswith('.jpeg')
             ]
             image_file_names = (sorted(image_file_names))
-            for img_idx, img_fname in tqdm.tqdm(enumerate(image_file_names)):
-                
+            for img_idx, img_fname in enumerate(image_file_names):
                 dets = detections[fold_idx][img_idx]
                 if len(dets) < 1:
                     continue
+                items.append((img_idx, (img_fname, dets)))
 
-                img = cv2.cvtColor(cv2.imread(img_fname), cv2.COLOR_BGR2RGB)
-                orig_height, orig_width = img.shape[:2]
-                inp_images = torch.zeros(len(dets), 3, self.model_cfg.DATASET.IMG_RES,
-                                         self.model_cfg.DATASET.IMG_RES, device=self.device, dtype=torch.float)
-
-                batch_size = inp_images.shape[0]
-                bbox_scale = []
-                bbox_center = []
-
-                for det_idx, det in enumerate(dets):
-                    bbox = det
-                    bbox_scale.append(bbox[2] / 200.)
-                    bbox_center.append([bbox[0], bbox[1]])
-                    rgb_img = crop(img, bbox_center[-1], bbox_scale[-1],[self.model_cfg.DATASET.IMG_RES, self.model_cfg.DATASET.IMG_RES])
-                    rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
-                    rgb_img = torch.from_numpy(rgb_img)
-                    norm_img = self.normalize_img(rgb_img)
-                    inp_images[det_idx] = norm_img.float().to(self.device)
-
-                bbox_center = torch.tensor(bbox_center).cuda().float()
-                bbox_scale = torch.tensor(bbox_scale).cuda().float()
-                img_h = torch.tensor(orig_height).repeat(batch_size).cuda().float()
-                img_w = torch.tensor(orig_width).repeat(batch_size).cuda().float()
-                focal_length = torch.tensor((img_w * img_w + img_h * img_h) ** 0.5).cuda().float()
-                hmr_output = self.model(inp_images, bbox_center=bbox_center, bbox_scale=bbox_scale, img_w=img_w, img_h=img_h)
+        def crop(item, img):
+            orig_height, orig_width = img.shape[:2]
+            return (*self.crop_detections(img, item[1]), orig_width, orig_height)
 
-                focal_length = (img_w * img_w + img_h * img_h) ** 0.5
-                pred_vertices_array = (hmr_output['vertices'] + hmr_output['pred_cam_t'].unsqueeze(1)).detach().cpu().numpy()
-                renderer = Renderer(focal_length=focal_length[0], img_w=img_w[0], img_h=img_h[0],
-                                    faces=self.smpl_cam_head.smpl.faces,
-                                    same_mesh_color=False)
-                front_view = renderer.render_front_view(pred_vertices_array,
-                                                        bg_img_rgb=img.copy())
+        def write(img_idx, img, hmr_output):
+            self.render_image(img_idx, img, hmr_output, output_folder)
 
-                # save rendering results
-                basename = str(img_idx)
-                filename = basename + "pred_%s.jpg" % 'bedlam'
-                filename_orig = basename + "orig_%s.jpg" % 'bedlam'
-                front_view_path = os.path.join(output_folder, filename)
-                orig_path = os.path.join(output_folder, filename_orig)
-                cv2.imwrite(front_view_path, front_view[:, :, ::-1])
-                cv2.imwrite(orig_path, img[:, :, ::-1])
-                renderer.delete()
+        self.make_pipeline().run(items, lambda item: read_image(item[0]), crop, write)
 
     @torch.no_grad()
     def run_on_hbw_folder(self, all_image_folder, detections, output_folder, data_split='test', visualize_proj=True):
-        img_names = []
-        verts = []
-        image_file_names = []
-
+        items = []
         for fold_idx, image_folder in enumerate(all_image_folder):
             image_file_names = [
                 os.path.join(image_folder, x)
@@ -141,121 +159,66 @@ class Tester:
             image_file_names = (sorted(image_file_names))
             print(image_folder, len(image_file_names))
 
-            for img_idx, img_fname in tqdm.tqdm(enumerate(image_file_names)):
+            for img_idx, img_fname in enumerate(image_file_names):
+                # Images without detection are not read and get the template vertices
+                dets = None
                 if detections:
-                    dets = detections[fold_idx][img_idx]
-                    if len(dets) < 1:
-                        print('No person detected')
-                        img_names.append('/'.join(img_fname.split('/')[-4:]).replace(data_split + '_small_resolution', data_split))
-                        template_verts = self.smpl_cam_head.smpl().vertices[0].detach().cpu().numpy()
-                        verts.append(template_verts)
-                        continue
-                else:
-                    if img_fname not in self.bboxes_dict.keys():
-                        print('No person detected')
-                        img_names.append('/'.join(img_fname.split('/')[-4:]).replace(data_split + '_small_resolution', data_split))
-                        template_verts = self.smpl_cam_head.smpl().vertices[0].detach().cpu().numpy()
-                        verts.append(template_verts)
-                        continue
+                    if len(detections[fold_idx][img_idx]) >= 1:
+                        dets = detections[fold_idx][img_idx]
+                elif img_fname in self.bboxes_dict.keys():
                     dets = self.bboxes_dict[img_fname]
-                img = cv2.cvtColor(cv2.imread(img_fname), cv2.COLOR_BGR2RGB)
-                orig_height, orig_width = img.shape[:2]
-                inp_images = torch.zeros(1, 3, self.model_cfg.DATASET.IMG_RES,
-                                         self.model_cfg.DATASET.IMG_RES, device=self.device, dtype=torch.float)
-
-                batch_size = inp_images.shape[0]
-                bbox_scale = []
-                bbox_center = []
-                if len(dets.shape)==1:
+                if dets is None:
+                    print('No person detected')
+                elif len(dets.shape) == 1:
                     dets = np.expand_dims(dets, 0)
-                for det_idx, det in enumerate(dets):
-                    if det_idx>=1:
-                        break
-                    bbox = det
-                    bbox_scale.append(bbox[2] / 200.)
-                    bbox_center.append([bbox[0], bbox[1]])
-                    rgb_img = crop(img, bbox_center[-1], bbox_scale[-1],[self.model_cfg.DATASET.IMG_RES, self.model_cfg.DATASET.IMG_RES])
-                    rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
-                    rgb_img = torch.from_numpy(rgb_img)
-                    norm_img = self.normalize_img(rgb_img)
-                    inp_images[det_idx] = norm_img.float().to(self.device)
+                items.append(((img_idx, img_fname), (img_fname, dets)))
 
-                bbox_center = torch.tensor(bbox_center).cuda().float()
-                bbox_scale = torch.tensor(bbox_scale).cuda().float()
-                img_h = torch.tensor(orig_height).repeat(batch_size).cuda().float()
-                img_w = torch.tensor(orig_width).repeat(batch_size).cuda().float()
-                focal_length = torch.tensor((img_w * img_w + img_h * img_h) ** 0.5).cuda().float()
+        def read(item):
+            if item[1] is None:
+                return None
+            return read_image(item[0])
 
-                hmr_output = self.model(inp_images, bbox_center=bbox_center, bbox_scale=bbox_scale, img_w=img_w, img_h=img_h)
-                img_names.append('/'.join(img_fname.split('/')[-4:]).replace(data_split + '_small_resolution', data_split))
-
-                template_verts = self.smpl_cam_head.smpl(betas=hmr_output['pred_shape']).vertices[0].detach().cpu().numpy()
-                verts.append(template_verts)
-                if visualize_proj:
-                    focal_length = (img_w * img_w + img_h * img_h) ** 0.5
-
-                    pred_vertices_array = (hmr_output['vertices'][0] + hmr_output['pred_cam_t']).unsqueeze(0).detach().cpu().numpy()
-                    renderer = Renderer(focal_length=focal_length, img_w=img_w, img_h=img_h,
-                                        faces=self.smpl_cam_head.smpl.faces,
-                                        same_mesh_color=False)
-                    front_view = renderer.render_front_view(pred_vertices_array,
-                                                            bg_img_rgb=img.copy())
+        def crop(item, img):
+            if item[1] is None:
+                return torch.zeros(0, 3, self.model_cfg.DATASET.IMG_RES, self.model_cfg.DATASET.IMG_RES), [], [], 0, 0
+            orig_height, orig_width = img.shape[:2]
+            # Only the first detection is used
+            return (*self.crop_detections(img, item[1][:1]), orig_width, orig_height)
+
+        def write(key, img, hmr_output):
+            img_idx, img_fname = key
+            img_name = '/'.join(img_fname.split('/')[-4:]).replace(data_split + '_small_resolution', data_split)
+            if img is None:
+                return img_name, self.smpl_cam_head.smpl().vertices[0].detach().cpu().numpy()
+            template_verts = self.smpl_cam_head.smpl(betas=hmr_output['pred_shape']).vertices[0].detach().cpu().numpy()
+            if visualize_proj:
+                self.render_image(img_idx, img, hmr_output, output_folder)
+            return img_name, template_verts
 
-                    # save rendering results
-                    basename = str(img_idx)
-                    filename = basename + "pred_%s.jpg" % 'bedlam'
-                    filename_orig = basename + "orig_%s.jpg" % 'bedlam'
-                    front_view_path = os.path.join(output_folder, filename)
-                    orig_path = os.path.join(output_folder, filename_orig)
-                    cv2.imwrite(front_view_path, front_view[:, :, ::-1])
-                    cv2.imwrite(orig_path, img[:, :, ::-1])
-                    renderer.delete()
+        results = self.make_pipeline().run(items, read, crop, write)
+        img_names = [r[0] for r in results]
+        verts = [r[1] for r in results]
         np.savez(os.path.join(output_folder, data_split + '_hbw_prediction.npz'), image_name=img_names, v_shaped=verts)
-               
+
+    @torch.no_grad()
     def run_on_dataframe(self, dataframe_path, output_folder, visualize_proj=True):
         dataframe = np.load(dataframe_path)
         centers = dataframe['center']
         scales = dataframe['scale']
         image = dataframe['image']
-        for ind, center in tqdm.tqdm(enumerate(centers)):
-            center = centers[ind]
-            scale = scales[ind]
-            img = image[ind]
-            orig_height, orig_width = img.shape[:2]
-            rgb_img = crop(img, center, scale, [self.hparams.DATASET.IMG_RES, self.hparams.DATASET.IMG_RES])
-
-            rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
-            rgb_img = torch.from_numpy(rgb_img).float().cuda()
-            rgb_img = self.normalize_img(rgb_img)
+        items = [(ind, ind) for ind in range(len(centers))]
 
-            img_h = torch.tensor(orig_height).repeat(1).cuda().float()
-            img_w = torch.tensor(orig_width).repeat(1).cuda().float()
-            center = torch.tensor(center).cuda().float()
-            scale = torch.tensor(scale).cuda().float()
+        def crop(ind, img):
+            orig_height, orig_width = img.shape[:2]
+            return (*self.crop_detections(img, [[*centers[ind], scales[ind] * 200.]]), orig_width, orig_height)
 
-            hmr_output = self.model(rgb_img.unsqueeze(0), bbox_center=center.unsqueeze(0), bbox_scale=scale.unsqueeze(0), img_w=img_w, img_h=img_h)
+        def write(ind, img, hmr_output):
             # Need to convert SMPL-X meshes to SMPL using conversion tool before calculating error
-            import pickle
             output_dict = {}
             output_dict['betas'] = hmr_output['pred_shape']
             output_path = os.path.join(output_folder, str(ind)+'.pkl')
-            pickle.dump(output_dict,open(output_path, 'wb'))     
+            pickle.dump(output_dict,open(output_path, 'wb'))
             if visualize_proj:
-                focal_length = (img_w * img_w + img_h * img_h) ** 0.5
-
-                pred_vertices_array = (hmr_output['vertices'][0] + hmr_output['pred_cam_t']).unsqueeze(0).detach().cpu().numpy()
-                renderer = Renderer(focal_length=focal_length, img_w=img_w, img_h=img_h,
-                                    faces=self.smpl_cam_head.smpl.faces,
-                                    same_mesh_color=False)
-                front_view = renderer.render_front_view(pred_vertices_array,
-                                                        bg_img_rgb=img.copy())
+                self.render_image(ind, img, hmr_output, output_folder)
 
-                # save rendering results
-                basename = str(ind)
-                filename = basename + "pred_%s.jpg" % 'bedlam'
-                filename_orig = basename + "orig_%s.jpg" % 'bedlam'
-                front_view_path = os.path.join(output_folder, filename)
-                orig_path = os.path.join(output_folder, filename_orig)
-                cv2.imwrite(front_view_path, front_view[:, :, ::-1])
-                cv2.imwrite(orig_path, img[:, :, ::-1])
-                renderer.delete()
\ No newline at end of file
+        self.make_pipeline().run(items, lambda ind: image[ind], crop, write)
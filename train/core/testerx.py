@@ -3,7 +3,6 @@ import os
 import cv2
 import torch
 import joblib
-import tqdm
 import numpy as np
 from loguru import logger
 from yolov3.yolo import YOLOv3
@@ -18,13 +17,15 @@ from train.utils.geometry import batch_euler2matrix
 from train.utils.train_utils import load_pretrained_model
 from train.utils.vibe_image_utils import get_single_image_crop_demo
 from collections import OrderedDict
-from ..utils.renderer_pyrd import Renderer
+from ..utils.renderer_pyrd import get_renderer, delete_renderers
+from ..utils.pred_writer import PredictionWriter
+from ..utils.crop_batcher import CropBatcher
+from ..utils.inference_pipeline import InferencePipeline
+from ..utils.video_io import VideoReader, VideoResults, OrderedVideoWriter, detect_frames
 from ..models.hmr import HMR
 from .config import update_hparams, SMPL_MEAN_PARAMS
 from ..utils.renderer_cam import render_image_group
-from ..utils.image_utils import transform, crop_ul_br
-
-from ..utils.image_utils import transform
+from ..utils.image_utils import transform_pts, crop_ul_br
 from ..models.head.smplx_head_cam_full import SMPLXHeadCamFull
 from ..models.hand import Hand
 from ..models.hmrx import HMRX
@@ -55,7 +56,12 @@ class SMPLXTrainer(pl.LightningModule):
                                    img_res=self.hparams.DATASET.IMG_RES,
                                    pretrained_ckpt=self.hparams.TRAINING.PRETRAINED_CKPT,
                                    hparams=self.hparams)
-                    
+
+
+def read_image(img_fname):
+    return cv2.cvtColor(cv2.imread(img_fname), cv2.COLOR_BGR2RGB)
+
+
 def get_bbox_valid(joints, img_height, img_width, rescale):
     #Get bbox using keypoints
 
@@ -137,10 +143,8 @@ def strip_prefix_if_present(state_dict, prefix):
 
 def j2d_processing(kp, center, scale, img_res):
     """Process gt 2D keypoints and apply all augmentation transforms."""
-    nparts = kp.shape[0]
-    for i in range(nparts):
-        kp[i,0:2] = transform(kp[i,0:2] + 1, center, scale,
-                                [img_res, img_res])
+    kp[:,0:2] = transform_pts(kp[:,0:2] + 1, center, scale,
+                              [img_res, img_res])
     # convert to normalized coordinates
     kp[:,:-1] = 2. * kp[:,:-1] / img_res - 1.
     # flip the x coordinates
@@ -179,9 +183,8 @@ class Tester:
         load_pretrained_model(self.model, ckpt, overwrite_shape_mismatch=True, remove_lightning=True)
         logger.info(f'Loaded pretrained weights from \"{self.args.ckpt}\"')
 
-    def run_detector(self, all_image_folder):
-        # run multi object tracker
-        mot = MPT(
+    def build_tracker(self):
+        return MPT(
             device=self.device,
             batch_size=self.args.tracker_batch_size,
             display=False,
@@ -189,6 +192,10 @@ class Tester:
             output_format='dict',
             yolo_img_size=self.args.yolo_img_size,
         )
+
+    def run_detector(self, all_image_folder):
+        # run multi object tracker
+        mot = self.build_tracker()
         bboxes = []
         for fold_id, image_folder in enumerate(all_image_folder):
             bboxes.append(mot.detect(image_folder))
@@ -211,9 +218,143 @@ class Tester:
 
         return bboxes
 
-    @torch.no_grad()
-    def run_on_image_folder(self, all_image_folder, detections, output_folder, visualize_proj=False, save_result=False, eval_dataset=''):
+    def crop_detections(self, img, dets):
+        """Normalized crops of the detections of an image, their bbox centers and scales."""
+        img_res = self.model_cfg.DATASET.IMG_RES
+        crops = torch.zeros(len(dets), 3, img_res, img_res, dtype=torch.float)
+        bbox_scale = []
+        bbox_center = []
+        for det_idx, det in enumerate(dets):
+            bbox = det
+            bbox_scale.append(bbox[2] / 200.)
+            bbox_center.append([bbox[0], bbox[1]])
+            rgb_img, ul, br = crop_ul_br(img, bbox_center[-1], bbox_scale[-1], [img_res, img_res])
+            rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
+            rgb_img = torch.from_numpy(rgb_img)
+            crops[det_idx] = self.normalize_img(rgb_img)
+        return crops, bbox_center, bbox_scale
+
+    def crop_hands(self, batch, center, scale):
+        # Hands are cropped from the full image of every crop, one crop_tensor call per source image
+        hand_crop = torch.zeros(len(center), 3, 224, 224, device=self.device)
+        for image_idx, img in enumerate(batch['images']):
+            rows = torch.nonzero(batch['image_index'] == image_idx)[:, 0]
+            rgb_img_full = torch.from_numpy(np.transpose(img.astype('float32'), (2, 0, 1)) / 255.0).to(self.device)
+            rgb_img_full = rgb_img_full.unsqueeze(0).expand(len(rows), -1, -1, -1)
+            hand_crop[rows], _ = crop_tensor(rgb_img_full, center[rows], scale[rows], 224)
+        return self.normalize_img(hand_crop)
+
+    def forward_crops(self, batch):
+        # Crops of several images, see utils/crop_batcher.py
+        inp_images = batch['img']
+        bbox_center = batch['bbox_center']
+        bbox_scale = batch['bbox_scale']
+        img_h = batch['img_h']
+        img_w = batch['img_w']
+        batch_size = inp_images.shape[0]
+        focal_length = ((img_w * img_w + img_h * img_h) ** 0.5).cuda().float()
+
+        body_pred = self.model.body_model(inp_images, bbox_center=bbox_center, bbox_scale=bbox_scale, img_w=img_w, img_h=img_h)
+
+        lhand_joints = body_pred['joints2d'][:, 25:40]
+        rhand_joints = body_pred['joints2d'][:, 40:55]
+
+        center_r, scale_r = get_bbox_valid(rhand_joints, img_h, img_w, SCALE_FACTOR_HAND_BBOX)
+        right_hand_crop = self.crop_hands(batch, center_r, scale_r)
+        right_hand_pred = self.model.hand_model(right_hand_crop)
+        #Flip left hand image before feedint to hand network
+        center_l, scale_l = get_bbox_valid(lhand_joints, img_h, img_w, SCALE_FACTOR_HAND_BBOX)
+        left_hand_crop = self.crop_hands(batch, center_l, scale_l)
+        left_hand_crop = torch.flip(left_hand_crop, [3])
+        left_hand_pred = self.model.hand_model(left_hand_crop)
+        #Flip predicted right hand pose to left hand 
+        left_hand_pred['pred_pose'] = left_hand_pred['pred_pose'] * self.flip_vector.unsqueeze(0)
+
+        full_body_pred = self.model.fullbody_model(body_pred['body_feat'], left_hand_pred['hand_feat'], right_hand_pred['hand_feat'], body_pred['pred_pose'], body_pred['pred_shape'], body_pred['pred_cam'],left_hand_pred['pred_pose'], right_hand_pred['pred_pose'],bbox_center, bbox_scale, img_w, img_h)
+
+        cam_intrinsics = torch.eye(3).repeat(batch_size, 1, 1).cuda().float()
+        cam_intrinsics[:, 0, 0]  = focal_length
+        cam_intrinsics[:, 1, 1]  = focal_length
+        cam_intrinsics[:, 0, 2] = img_w/2.
+        cam_intrinsics[:, 1, 2] = img_h/2.
+
+        output = self.smpl_cam_head(body_pose=full_body_pred['pred_pose'], lhand_pose = left_hand_pred['pred_pose'][:,1:], rhand_pose=right_hand_pred['pred_pose'][:,1:],
+                    shape=body_pred['pred_shape'], cam=body_pred['pred_cam'], cam_intrinsics=cam_intrinsics, 
+                    bbox_scale=bbox_scale,bbox_center=bbox_center, img_w=img_w, img_h=img_h, normalize_joints2d=False)
+        # Parameters of the bodies, saved by run_on_video
+        output['pred_pose'] = full_body_pred['pred_pose']
+        output['pred_lhand_pose'] = left_hand_pred['pred_pose'][:, 1:]
+        output['pred_rhand_pose'] = right_hand_pred['pred_pose'][:, 1:]
+        output['pred_shape'] = body_pred['pred_shape']
+        return output
+
+    def make_pipeline(self):
+        # The crops of consecutive images are batched together up to args.batch_size
+        batcher = CropBatcher(self.forward_crops, batch_size=getattr(self.args, 'batch_size', 32), device=self.device)
+        return InferencePipeline(batcher,
+                                 num_readers=getattr(self.args, 'num_readers', 4),
+                                 num_crop_workers=getattr(self.args, 'num_crop_workers', 2),
+                                 num_writers=getattr(self.args, 'num_writers', 2),
+                                 queue_size=getattr(self.args, 'queue_size', 16),
+                                 writer_cleanup=delete_renderers)
+
+    def render_overlay(self, img, output):
+        img_h, img_w, _ = img.shape
+        focal_length = (img_w * img_w + img_h * img_h) ** 0.5
+
+        vertices = output['vertices'].detach().cpu().numpy()
+        translation = output['pred_cam_t'].detach().cpu().numpy()
+
+        pred_vertices_array = vertices + np.expand_dims(translation, 1)
+        renderer = get_renderer(focal_length=focal_length, img_w=img_w, img_h=img_h,
+                                faces=self.smpl_cam_head.smplx.faces)
+        return renderer.render_front_view(pred_vertices_array,
+                                          bg_img_rgb=img.copy())
+
+    def save_output(self, img_fname, img, output, output_folder, visualize_proj, save_result, eval_dataset, pred_writer):
+        if save_result:
+            if eval_dataset == 'agora':
+                imgname = os.path.basename(img_fname).replace('.png', '')
+            elif eval_dataset == 'bedlam':
+                imgname = img_fname.split('/')[-4] + '_frameID_' + img_fname.split('/')[-1]
+                imgname = imgname.replace('.png','')
+            else:
+                raise Exception('eval dataset can be either agora or bedlam')
+            verts = output['vertices'].detach().cpu().numpy()
+            joints2d = output['joints2d'][:, :24].detach().cpu().numpy()
+            joints3d = output['joints3d'].detach().cpu().numpy()
+            if pred_writer is not None:
+                pred_writer.add(imgname, verts, joints3d, joints2d)
+            else:
+                for out_ind in range(len(verts)):
+                    out_dict = {}
+                    out_dict['verts'] = verts[out_ind]
+                    out_dict['joints'] = joints2d[out_ind]
+                    out_dict['allSmplJoints3d'] = joints3d[out_ind]
+                    pickle.dump(out_dict, open(os.path.join(output_folder, imgname + '_personId_' + str(out_ind) + '.pkl'), 'wb'))
+
+        if visualize_proj:
+            front_view = self.render_overlay(img, output)
+
+            # save rendering results
+            basename = img_fname.split('/')[-1]
+            filename = basename + "pred_%s.jpg" % 'bedlam'
+            filename_orig = basename + "orig_%s.jpg" % 'bedlam'
+            front_view_path = os.path.join(output_folder, filename)
+            orig_path = os.path.join(output_folder, filename_orig)
+            logger.info(f'Writing output files to {output_folder}')
+            cv2.imwrite(front_view_path, front_view[:, :, ::-1])
+            cv2.imwrite(orig_path, img[:, :, ::-1])
 
+    @torch.no_grad()
+    def run_on_image_folder(self, all_image_folder, detections, output_folder, visualize_proj=False, save_result=False, eval_dataset='',
+                            save_format='pickle'):
+        # With save_format compact the predictions are written in chunks instead of one pickle per person
+        pred_writer = None
+        if save_result and save_format == 'compact':
+            pred_writer = PredictionWriter(os.path.join(output_folder, 'predictions'),
+                                           dtype=getattr(self.args, 'save_dtype', 'float32'))
+        items = []
         for fold_idx, image_folder in enumerate(all_image_folder):
             image_file_names = [
                 os.path.join(image_folder, x)
@@ -222,7 +363,7 @@ class Tester:
             ]
             image_file_names = (sorted(image_file_names))
 
-            for img_idx, img_fname in tqdm.tqdm(enumerate(image_file_names)):
+            for img_idx, img_fname in enumerate(image_file_names):
                 dets = detections[fold_idx][img_idx]
                 if len(dets) < 1:
                     continue
@@ -233,109 +374,67 @@ class Tester:
 
                 if len(dets.shape)==1:
                     dets = np.expand_dims(dets, 0)
-                img = cv2.cvtColor(cv2.imread(img_fname), cv2.COLOR_BGR2RGB)
-                rgb_img_full = np.transpose(img.astype('float32'),(2,0,1))/255.0
-
-                orig_height, orig_width = img.shape[:2]
-
-                inp_images = torch.zeros(len(dets), 3, self.model_cfg.DATASET.IMG_RES,
-                                        self.model_cfg.DATASET.IMG_RES, device=self.device, dtype=torch.float)
-
-                batch_size = inp_images.shape[0]
-
-                bbox_scale = []
-                bbox_center = []
- 
-                for det_idx, det in enumerate(dets):
-                    bbox = det
-                    bbox_scale.append(bbox[2] / 200.)
-                    bbox_center.append([bbox[0], bbox[1]])
-                    rgb_img, ul, br = crop_ul_br(img, bbox_center[-1], bbox_scale[-1],[self.model_cfg.DATASET.IMG_RES, self.model_cfg.DATASET.IMG_RES])
-                    rgb_img = np.transpose(rgb_img.astype('float32'),(2,0,1))/255.0
-                    rgb_img = torch.from_numpy(rgb_img)
-                    norm_img = self.normalize_img(rgb_img)
-                    inp_images[det_idx] = norm_img.float().to(self.device)
-
-
-                bbox_center = torch.tensor(bbox_center).cuda().float()
-                bbox_scale = torch.tensor(bbox_scale).cuda().float()
-                img_h = torch.tensor(orig_height).repeat(batch_size).cuda().float()
-                img_w = torch.tensor(orig_width).repeat(batch_size).cuda().float()
-                focal_length = ((img_w * img_w + img_h * img_h) ** 0.5).cuda().float()
-
-                body_pred = self.model.body_model(inp_images, bbox_center=bbox_center, bbox_scale=bbox_scale, img_w=img_w, img_h=img_h)
-
-                lhand_joints = body_pred['joints2d'][:, 25:40]
-                rhand_joints = body_pred['joints2d'][:, 40:55]
-
-                center_r, scale_r = get_bbox_valid(rhand_joints, img_h, img_w, SCALE_FACTOR_HAND_BBOX)
-
-                rgb_img_full = torch.tensor(rgb_img_full).cuda().float()
-                rgb_img_full = rgb_img_full.unsqueeze(0).expand(inp_images.shape[0],-1,-1,-1)
-                right_hand_crop, _ = crop_tensor(rgb_img_full, center_r, scale_r, 224)
-                right_hand_crop = self.normalize_img(right_hand_crop)
-                right_hand_pred = self.model.hand_model(right_hand_crop)
-                #Flip left hand image before feedint to hand network
-                center_l, scale_l = get_bbox_valid(lhand_joints, img_h, img_w, SCALE_FACTOR_HAND_BBOX)
-                left_hand_crop, _ = crop_tensor(rgb_img_full, center_l, scale_l, 224)
-                left_hand_crop = self.normalize_img(left_hand_crop)
-                left_hand_crop = torch.flip(left_hand_crop, [3])
-                left_hand_pred = self.model.hand_model(left_hand_crop)
-                #Flip predicted right hand pose to left hand 
-                left_hand_pred['pred_pose'] = left_hand_pred['pred_pose'] * self.flip_vector.unsqueeze(0)
-
-                full_body_pred = self.model.fullbody_model(body_pred['body_feat'], left_hand_pred['hand_feat'], right_hand_pred['hand_feat'], body_pred['pred_pose'], body_pred['pred_shape'], body_pred['pred_cam'],left_hand_pred['pred_pose'], right_hand_pred['pred_pose'],bbox_center, bbox_scale, img_w, img_h)
-                
-                cam_intrinsics = torch.eye(3).repeat(batch_size, 1, 1).cuda().float()
-                cam_intrinsics[:, 0, 0]  = focal_length
-                cam_intrinsics[:, 1, 1]  = focal_length
-                cam_intrinsics[:, 0, 2] = img_w/2.
-                cam_intrinsics[:, 1, 2] = img_h/2.
-
-                output = self.smpl_cam_head(body_pose=full_body_pred['pred_pose'], lhand_pose = left_hand_pred['pred_pose'][:,1:], rhand_pose=right_hand_pred['pred_pose'][:,1:],
-                            shape=body_pred['pred_shape'], cam=body_pred['pred_cam'], cam_intrinsics=cam_intrinsics, 
-                            bbox_scale=bbox_scale,bbox_center=bbox_center, img_w=img_w, img_h=img_h, normalize_joints2d=False)
-
-                del inp_images
-
-                if save_result:
-                    for out_ind, vertices in enumerate(output['vertices']):
-                        out_dict = {}
-                        out_dict['verts'] = output['vertices'][out_ind].detach().cpu().numpy()
-                        out_dict['joints'] = output['joints2d'][out_ind][:24].detach().cpu().numpy()
-                        out_dict['allSmplJoints3d'] = output['joints3d'][out_ind].detach().cpu().numpy()
-                        if eval_dataset == 'agora':
-                            imgname = os.path.basename(img_fname).replace('.png', '')
-                            pickle.dump(out_dict, open(os.path.join(output_folder, imgname + '_personId_' + str(out_ind) + '.pkl'), 'wb'))
-                        elif eval_dataset == 'bedlam':
-                            imgname = img_fname.split('/')[-4] + '_frameID_' + img_fname.split('/')[-1]
-                            imgname = imgname.replace('.png','')
-                            pickle.dump(out_dict, open(os.path.join(output_folder, imgname + '_personId_' + str(out_ind) + '.pkl'), 'wb'))
-                        else:
-                            raise Exception('eval dataset can be either agora or bedlam')
-
-                if visualize_proj:
-                    img_h, img_w, _ = img.shape
-                    focal_length = (img_w * img_w + img_h * img_h) ** 0.5
-
-                    vertices = output['vertices'].detach().cpu().numpy()
-                    translation = output['pred_cam_t'].detach().cpu().numpy()
-
-                    pred_vertices_array = vertices + np.expand_dims(translation, 1)
-                    renderer = Renderer(focal_length=focal_length, img_w=img_w, img_h=img_h,
-                                        faces=self.smpl_cam_head.smplx.faces,
-                                        same_mesh_color=False)
-                    front_view = renderer.render_front_view(pred_vertices_array,
-                                                            bg_img_rgb=img.copy())
-
-                    # save rendering results
-                    basename = img_fname.split('/')[-1]
-                    filename = basename + "pred_%s.jpg" % 'bedlam'
-                    filename_orig = basename + "orig_%s.jpg" % 'bedlam'
-                    front_view_path = os.path.join(output_folder, filename)
-                    orig_path = os.path.join(output_folder, filename_orig)
-                    logger.info(f'Writing output files to {output_folder}')
-                    cv2.imwrite(front_view_path, front_view[:, :, ::-1])
-                    cv2.imwrite(orig_path, img[:, :, ::-1])
-
-                    renderer.delete()
\ No newline at end of file
+                items.append((img_fname, (img_fname, dets)))
+
+        def crop(item, img):
+            orig_height, orig_width = img.shape[:2]
+            return (*self.crop_detections(img, item[1]), orig_width, orig_height)
+
+        def write(img_fname, img, output):
+            self.save_output(img_fname, img, output, output_folder, visualize_proj, save_result, eval_dataset, pred_writer)
+
+        try:
+            self.make_pipeline().run(items, lambda item: read_image(item[0]), crop, write)
+        finally:
+            # Also stops the chunk writer thread when the run fails
+            if pred_writer is not None:
+                pred_writer.close()
+
+    @torch.no_grad()
+    def run_on_video(self, video, output_folder, visualize_proj=False):
+        """
+        Runs on the frames of a video file, stream url or camera index without writing them to disk.
+        Saves <name>_results.npz and with visualize_proj the rendered <name>_result.mp4.
+        """
+        reader = VideoReader(video, queue_size=getattr(self.args, 'queue_size', 16))
+        results = VideoResults(os.path.join(output_folder, reader.name + '_results.npz'))
+        video_writer = None
+        if visualize_proj:
+            video_writer = OrderedVideoWriter(os.path.join(output_folder, reader.name + '_result.mp4'),
+                                              reader.fps, reader.width, reader.height)
+        mot = self.build_tracker()
+
+        def frames():
+            # The frames are detected in batches of args.tracker_batch_size
+            for batch in reader.batches(self.args.tracker_batch_size):
+                detections = detect_frames(mot, [frame for _, frame in batch])
+                for (frame_idx, frame), dets in zip(batch, detections):
+                    yield (frame_idx, dets), (frame, dets)
+
+        def crop(item, frame):
+            orig_height, orig_width = frame.shape[:2]
+            return (*self.crop_detections(frame, item[1]), orig_width, orig_height)
+
+        def write(key, frame, output):
+            frame_idx, dets = key
+            if len(dets) > 0:
+                results.add(frame_idx, {
+                    'bbox_center': dets[:, :2].astype(np.float32),
+                    'bbox_scale': (dets[:, 2] / 200.).astype(np.float32),
+                    'pred_pose': output['pred_pose'].cpu().numpy(),
+                    'pred_lhand_pose': output['pred_lhand_pose'].cpu().numpy(),
+                    'pred_rhand_pose': output['pred_rhand_pose'].cpu().numpy(),
+                    'pred_shape': output['pred_shape'].cpu().numpy(),
+                    'pred_cam_t': output['pred_cam_t'].cpu().numpy(),
+                    'joints2d': output['joints2d'][:, :24].cpu().numpy(),
+                })
+            if video_writer is not None:
+                video_writer.write(frame_idx, self.render_overlay(frame, output) if len(dets) > 0 else frame)
+
+        try:
+            self.make_pipeline().run(frames(), lambda item: item[0], crop, write)
+        finally:
+            reader.close()
+            if video_writer is not None:
+                video_writer.close()
+        results.save()
@@ -4,14 +4,19 @@ import torch
 import pickle
 import numpy as np
 from loguru import logger
-import albumentations as A
 from torch.utils.data import Dataset
 from torchvision.transforms import Normalize
 from skimage.transform import resize
 from ..core import constants, config
 from ..core.constants import NUM_JOINTS_SMPLX
 from ..core.config import DATASET_FILES, DATASET_FOLDERS
-from ..utils.image_utils import crop, flip_img, flip_pose, flip_kp, transform, rot_aa, random_crop, read_img
+from ..utils.image_utils import crop, flip_img, flip_pose, flip_kp, transform_pts, rot_aa, random_crop, read_img, get_crop_fn
+from ..utils.crop_shards import CropShard, get_shard_paths
+from ..utils.label_store import load_labels, decode_str
+from ..utils.image_cache import get_image_cache
+from ..utils.augmentations import Augmentation
+from ..utils.gt_mesh_cache import has_gt_mesh, load_gt_mesh_cache
+from ..utils.gpu_augment import FRAME_KEY
 from smplx import SMPL, SMPLX
 
 class DatasetHMR(Dataset):
@@ -25,8 +30,14 @@ class DatasetHMR(Dataset):
         self.img_dir = DATASET_FOLDERS[dataset]
         self.normalize_img = Normalize(mean=constants.IMG_NORM_MEAN,
                                        std=constants.IMG_NORM_STD)
-        self.data = np.load(DATASET_FILES[is_train][dataset],
-                            allow_pickle=True)
+        self.crop_fn = get_crop_fn(self.options.CROP_ENGINE)
+        # Decoded images shared between workers, see utils/image_cache.py
+        self.image_cache = get_image_cache(self.options)
+        # Built once, see utils/augmentations.py
+        self.augmentation = Augmentation(self.options) if self.is_train and self.options.ALB else None
+        self.data = load_labels(DATASET_FILES[is_train][dataset],
+                                store_root=self.options.LABEL_STORE,
+                                dataset=dataset, is_train=is_train)
         self.imgname = self.data['imgname']
         # Bounding boxes are assumed to be in the center and scale format
         self.scale = self.data['scale']
@@ -35,13 +46,24 @@ class DatasetHMR(Dataset):
         # If False, do not do augmentation
         self.use_augmentation = use_augmentation
 
+        # Only decode in the workers, see utils/gpu_augment.py
+        self.gpu_crop = self.is_train and self.options.GPU_CROP
+
+        # Pre-cropped images written by make_crop_shards.py
+        self.crop_shard = None
+        if self.is_train and self.options.CROP_SHARDS:
+            if os.path.exists(get_shard_paths(self.options.CROP_SHARDS, self.dataset)[1]):
+                self.crop_shard = CropShard(self.options.CROP_SHARDS, self.dataset)
+            else:
+                logger.warning(f'No crop shard for {self.dataset} in {self.options.CROP_SHARDS}, decoding full images')
+
         if self.is_train:
             if '3dpw-train-smplx' in self.dataset:
-                self.pose_cam = self.data['smplx_pose'][:, :NUM_JOINTS_SMPLX*3].astype(np.float)
-                self.betas = self.data['smplx_shape'][:, :11].astype(np.float)
+                self.pose_cam = self.data['smplx_pose'][:, :NUM_JOINTS_SMPLX*3]
+                self.betas = self.data['smplx_shape'][:, :11]
             else:
-                self.pose_cam = self.data['pose_cam'][:, :NUM_JOINTS_SMPLX*3].astype(np.float)
-                self.betas = self.data['shape'].astype(np.float)
+                self.pose_cam = self.data['pose_cam'][:, :NUM_JOINTS_SMPLX*3]
+                self.betas = self.data['shape']
 
             # For AGORA and 3DPW num betas are 10
             if self.betas.shape[-1] == 10:
@@ -64,8 +86,8 @@ class DatasetHMR(Dataset):
                 self.pose_cam = np.zeros((self.imgname.shape[0], 66))
                 self.betas = np.zeros((self.imgname.shape[0], 11))
             else:
-                self.pose_cam = self.data['pose_cam'].astype(np.float)
-                self.betas = self.data['shape'].astype(np.float)
+                self.pose_cam = self.data['pose_cam']
+                self.betas = self.data['shape']
         
         if self.is_train:
             if '3dpw-train-smplx' in self.dataset: # Only for 3dpw training
@@ -86,8 +108,8 @@ class DatasetHMR(Dataset):
 
         try:
             gender = self.data['gender']
-            self.gender = np.array([0 if str(g) == 'm'
-                                    else 1 for g in gender]).astype(np.int32)
+            self.gender = np.array([0 if g == 'm'
+                                    else 1 for g in np.asarray(gender).astype(str)]).astype(np.int32)
         except KeyError:
             self.gender = -1*np.ones(len(self.imgname)).astype(np.int32)
 
@@ -99,19 +121,24 @@ class DatasetHMR(Dataset):
             self.joint_mapper_gt = constants.J24_TO_J14
             self.J_regressor = torch.from_numpy(np.load(
                                config.JOINT_REGRESSOR_H36M)).float()
-            self.smpl_male = SMPL(config.SMPL_MODEL_DIR,
-                                  gender='male',
-                                  create_transl=False)
-            self.smpl_female = SMPL(config.SMPL_MODEL_DIR,
-                                    gender='female',
-                                    create_transl=False)
-            self.smplx_male = SMPLX(config.SMPLX_MODEL_DIR,
-                                    gender='male')
-            self.smplx_female = SMPLX(config.SMPLX_MODEL_DIR,
-                                      gender='female')
-            self.smplx2smpl = pickle.load(open(config.SMPLX2SMPL, 'rb'))
-            self.smplx2smpl = torch.tensor(self.smplx2smpl['matrix'][None],
-                                           dtype=torch.float32)
+            # GT meshes precomputed by make_gt_mesh_cache.py, body models are only needed without it
+            self.gt_mesh = None
+            if self.options.GT_MESH_CACHE and has_gt_mesh(self.dataset):
+                self.gt_mesh = load_gt_mesh_cache(self.options.GT_MESH_CACHE, self.dataset, 'dataset')
+            if self.gt_mesh is None:
+                self.smpl_male = SMPL(config.SMPL_MODEL_DIR,
+                                      gender='male',
+                                      create_transl=False)
+                self.smpl_female = SMPL(config.SMPL_MODEL_DIR,
+                                        gender='female',
+                                        create_transl=False)
+                self.smplx_male = SMPLX(config.SMPLX_MODEL_DIR,
+                                        gender='male')
+                self.smplx_female = SMPLX(config.SMPLX_MODEL_DIR,
+                                          gender='female')
+                self.smplx2smpl = pickle.load(open(config.SMPLX2SMPL, 'rb'))
+                self.smplx2smpl = torch.tensor(self.smplx2smpl['matrix'][None],
+                                               dtype=torch.float32)
         if self.is_train and 'agora' not in self.dataset and '3dpw' not in self.dataset: # first 80% is training set 20% is validation
             self.length = int(self.scale.shape[0] * self.options.CROP_PERCENT)
         else:
@@ -130,40 +157,17 @@ class DatasetHMR(Dataset):
 
     def rgb_processing(self, rgb_img_full, center, scale, img_res, kp2d=None):
 
-        if self.is_train and self.options.ALB: 
-            aug_comp = [A.Downscale(0.5, 0.9, interpolation=0, p=0.1),
-                        A.ImageCompression(20, 100, p=0.1),
-                        A.RandomRain(blur_value=4, p=0.1),
-                        A.MotionBlur(blur_limit=(3, 15),  p=0.2),
-                        A.Blur(blur_limit=(3, 10), p=0.1),
-                        A.RandomSnow(brightness_coeff=1.5,
-                        snow_point_lower=0.2, snow_point_upper=0.4)]
-            aug_mod = [A.CLAHE((1, 11), (10, 10), p=0.2), A.ToGray(p=0.2),
-                       A.RandomBrightnessContrast(p=0.2),
-                       A.MultiplicativeNoise(multiplier=[0.5, 1.5],
-                       elementwise=True, per_channel=True, p=0.2),
-                       A.HueSaturationValue(hue_shift_limit=20,
-                       sat_shift_limit=30, val_shift_limit=20,
-                       always_apply=False, p=0.2),
-                       A.Posterize(p=0.1),
-                       A.RandomGamma(gamma_limit=(80, 200), p=0.1),
-                       A.Equalize(mode='cv', p=0.1)]
-            albumentation_aug = A.Compose([A.OneOf(aug_comp,
-                                           p=self.options.ALB_PROB),
-                                           A.OneOf(aug_mod,
-                                           p=self.options.ALB_PROB)])          
-            rgb_img_full = albumentation_aug(image=rgb_img_full)['image']
-
-        rgb_img = crop(rgb_img_full, center, scale, [img_res, img_res])
+        if self.augmentation is not None:
+            rgb_img_full = self.augmentation(rgb_img_full)
+
+        rgb_img = self.crop_fn(rgb_img_full, center, scale, [img_res, img_res])
 
         rgb_img = np.transpose(rgb_img.astype('float32'),
                                (2, 0, 1))/255.0
         return rgb_img
 
     def j2d_processing(self, kp, center, scale):
-        nparts = kp.shape[0]
-        for i in range(nparts):
-            kp[i, 0:2] = transform(kp[i, 0:2] + 1, center, scale,
+        kp[:, 0:2] = transform_pts(kp[:, 0:2] + 1, center, scale,
                                    [self.options.IMG_RES,
                                    self.options.IMG_RES])
         kp[:, :-1] = 2. * kp[:, :-1] / self.options.IMG_RES - 1.
@@ -171,7 +175,23 @@ class DatasetHMR(Dataset):
         return kp
 
 
+    def load_image(self, index):
+        imgname = os.path.join(self.img_dir, decode_str(self.imgname[index]))
+        try:
+            cv_img = read_img(imgname, cache=self.image_cache)
+        except Exception as E:
+            print(E)
+            logger.info(f'@{imgname}@ from {self.dataset}')
+        if self.is_train and 'closeup' in self.dataset:
+
+            cv_img = cv2.rotate(cv_img, cv2.ROTATE_90_CLOCKWISE)
+        return cv_img
+
     def __getitem__(self, index):
+        return self.get_sample(index)
+
+    def get_sample(self, index, cv_img=None):
+        """cv_img: already decoded frame of this row, see dataset/frame_dataset.py"""
         item = {}
         scale = self.scale[index].copy()
         center = self.center[index].copy()
@@ -191,17 +211,16 @@ class DatasetHMR(Dataset):
                                             crop_scale_factor=1-self.options.CROP_FACTOR,
                                             axis='y')
 
-        imgname = os.path.join(self.img_dir, self.imgname[index])
-        try:
-            cv_img = read_img(imgname)
-        except Exception as E:
-            print(E)
-            logger.info(f'@{imgname}@ from {self.dataset}')
-        if self.is_train and 'closeup' in self.dataset:
-
-            cv_img = cv2.rotate(cv_img, cv2.ROTATE_90_CLOCKWISE)
-
-        orig_shape = np.array(cv_img.shape)[:2]
+        imgname = os.path.join(self.img_dir, decode_str(self.imgname[index]))
+        if self.crop_shard is not None:
+            # Crop is taken from the stored context crop instead of the full frame
+            cv_img, crop_center, crop_scale = self.crop_shard.get(index, center, sc * scale)
+            orig_shape = self.crop_shard.orig_shape[index].copy()
+        else:
+            if cv_img is None:
+                cv_img = self.load_image(index)
+            orig_shape = np.array(cv_img.shape)[:2]
+            crop_center, crop_scale = center, sc * scale
         pose = self.pose_cam[index].copy()
         # Get 2D keypoints and apply augmentation transforms
         keypoints = self.j2d_processing(keypoints, center, sc * scale)
@@ -209,16 +228,22 @@ class DatasetHMR(Dataset):
             proj_verts = self.j2d_processing(proj_verts, center, sc * scale)
             item['proj_verts'] = torch.from_numpy(proj_verts).float()
        
-        # Process image
-        try:
-            img = self.rgb_processing(cv_img, center, sc*scale, kp2d=keypoints,
-                                      img_res=self.options.IMG_RES)
-        except Exception as E:
-            logger.info(f'@{imgname} from {self.dataset}')
-            print(E)
+        if self.gpu_crop:
+            # Crop, augmentation and normalization are done batched on the GPU
+            item[FRAME_KEY] = torch.from_numpy(np.array(cv_img, dtype=np.uint8))
+            item['crop_center'] = np.asarray(crop_center, dtype=np.float32)
+            item['crop_scale'] = float(crop_scale)
+        else:
+            # Process image
+            try:
+                img = self.rgb_processing(cv_img, crop_center, crop_scale, kp2d=keypoints,
+                                          img_res=self.options.IMG_RES)
+            except Exception as E:
+                logger.info(f'@{imgname} from {self.dataset}')
+                print(E)
 
-        img = torch.from_numpy(img).float()
-        item['img'] = self.normalize_img(img)
+            img = torch.from_numpy(img).float()
+            item['img'] = self.normalize_img(img)
         item['pose'] = torch.from_numpy(pose).float()
         item['betas'] = torch.from_numpy(self.betas[index]).float()
         item['imgname'] = imgname
@@ -229,7 +254,7 @@ class DatasetHMR(Dataset):
                 item['focal_length'] = torch.tensor([1961.1, 1969.2])
             # Will be 0 for 3dpw-train-smplx
             item['cam_ext'] = self.cam_ext[index]
-            item['translation'] = self.cam_ext[index][:, 3]
+            item['translation'] = self.cam_ext[index][:, 3].copy()
             if 'trans_cam' in self.data.files:
                 item['translation'][:3] += self.trans_cam[index]
 
@@ -242,7 +267,11 @@ class DatasetHMR(Dataset):
         item['sample_index'] = index
         item['dataset_name'] = self.dataset
         if not self.is_train:
-            if '3dpw' in self.dataset:
+            if self.gt_mesh is not None:
+                item['vertices'] = torch.from_numpy(np.array(self.gt_mesh.vertices[index]))
+                if 'rich' in self.dataset:
+                    item['joints'] = torch.from_numpy(np.array(self.gt_mesh.joints[index]))
+            elif '3dpw' in self.dataset:
                 if self.gender[index] == 1:
                     gt_smpl_out = self.smpl_female(
                                 global_orient=item['pose'].unsqueeze(0)[:, :3],
@@ -9,7 +9,7 @@ from skimage.transform import resize
 
 from ..core import constants, config
 from ..core.config import DATASET_FILES, DATASET_FOLDERS
-from ..utils.image_utils import crop, transform, random_crop, read_img
+from ..utils.image_utils import crop, transform_pts, random_crop, read_img, get_crop_fn
 from ..models.head.mano import MANO
 
 
@@ -25,6 +25,8 @@ class DatasetHand(Dataset):
         self.img_dir = DATASET_FOLDERS[dataset]
         self.mano = MANO(model_path=config.MANO_MODEL_DIR, use_pca=False, is_rhand=True)
         self.normalize_img = Normalize(mean=constants.IMG_NORM_MEAN, std=constants.IMG_NORM_STD)
+        self.crop_fn = get_crop_fn(self.options.CROP_ENGINE)
+        # Not read from DATASET.LABEL_STORE, the hand selection below copies every field anyway
         self.data = np.load(DATASET_FILES[is_train][dataset].replace('.npz', '-hands.npz').replace('all_npz_12_training','all_npz_12_hands'), allow_pickle=True)
 
         #Just taking right hand
@@ -49,7 +51,7 @@ class DatasetHand(Dataset):
 
     def rgb_processing(self, rgb_img_full, center, scale, img_res, kp2d=None):
 
-        rgb_img = crop(rgb_img_full, center, scale, [img_res, img_res])
+        rgb_img = self.crop_fn(rgb_img_full, center, scale, [img_res, img_res])
         rgb_img_full = resize(rgb_img_full, [img_res, img_res])
 
         rgb_img = np.transpose(rgb_img.astype('float32'), (2, 0, 1)) / 255.0
@@ -58,9 +60,7 @@ class DatasetHand(Dataset):
         return rgb_img, rgb_img_full
 
     def j2d_processing(self, kp, center, scale):
-        nparts = kp.shape[0]
-        for i in range(nparts):
-            kp[i, 0:2] = transform(kp[i, 0:2] + 1, center, scale, [self.options.IMG_RES, self.options.IMG_RES])
+        kp[:, 0:2] = transform_pts(kp[:, 0:2] + 1, center, scale, [self.options.IMG_RES, self.options.IMG_RES])
         kp[:, :] = 2. * kp[:, :] / self.options.IMG_RES - 1.
         kp = kp.astype('float32')
         return kp
@@ -83,7 +83,7 @@ class DatasetHand(Dataset):
         center = self.center[index]
         scale = self.scale[index]
         if 'cam_ext' in self.data.files:
-            item['translation'] = self.cam_ext[index][:, 3][:3]
+            item['translation'] = self.cam_ext[index][:, 3][:3].copy()
         if 'trans_cam' in self.data.files:
             item['translation'][:3] += self.trans_cam[index]
         output = self.mano(betas=item['betas'].unsqueeze(0),
@@ -4,14 +4,17 @@ import torch
 import pickle
 import numpy as np
 from loguru import logger
-import albumentations as A
 from torch.utils.data import Dataset
 from torchvision.transforms import Normalize
 from skimage.transform import resize
 from ..core import constants, config
 from ..core.constants import NUM_JOINTS_SMPL, NUM_JOINTS_SMPLX
 from ..core.config import DATASET_FILES, DATASET_FOLDERS
-from ..utils.image_utils import crop, flip_img, flip_pose, flip_kp, transform, rot_aa, random_crop, read_img
+from ..utils.image_utils import crop, flip_img, flip_pose, flip_kp, transform_pts, rot_aa, random_crop, read_img, get_crop_fn
+from ..utils.label_store import load_labels, decode_str
+from ..utils.image_cache import get_image_cache
+from ..utils.augmentations import Augmentation
+from ..utils.gt_mesh_cache import has_gt_mesh, load_gt_mesh_cache
 from smplx import SMPL, SMPLX
 
 class DatasetHMR(Dataset):
@@ -25,8 +28,14 @@ class DatasetHMR(Dataset):
         self.img_dir = DATASET_FOLDERS[dataset]
         self.normalize_img = Normalize(mean=constants.IMG_NORM_MEAN,
                                        std=constants.IMG_NORM_STD)
-        self.data = np.load(DATASET_FILES[is_train][dataset],
-                            allow_pickle=True)
+        self.crop_fn = get_crop_fn(self.options.CROP_ENGINE)
+        # Decoded images shared between workers, see utils/image_cache.py
+        self.image_cache = get_image_cache(self.options)
+        # Built once, see utils/augmentations.py
+        self.augmentation = Augmentation(self.options) if self.is_train and self.options.ALB else None
+        self.data = load_labels(DATASET_FILES[is_train][dataset],
+                                store_root=self.options.LABEL_STORE,
+                                dataset=dataset, is_train=is_train)
         self.imgname = self.data['imgname']
         # Bounding boxes are assumed to be in the center and scale format
         self.scale = self.data['scale']
@@ -34,14 +43,14 @@ class DatasetHMR(Dataset):
         if not self.is_train and 'h36m' in self.dataset:
             self.pose_3d = self.data['S']
         if 'betas' in self.data:
-            self.betas = self.data['shape'].astype(np.float)
+            self.betas = self.data['shape']
         else:
             self.betas = np.zeros((len(self.imgname), 10))
 
         if 'pose_cam' in self.data:
-            self.pose = self.data['pose_cam'].astype(np.float)
+            self.pose = self.data['pose_cam']
         elif 'pose' in self.data:
-            self.pose = self.data['pose'].astype(np.float)
+            self.pose = self.data['pose']
         else:
             self.pose = np.zeros((len(self.imgname), 24, 3))
         # If False, do not do augmentation
@@ -59,8 +68,8 @@ class DatasetHMR(Dataset):
 
         try:
             gender = self.data['gender']
-            self.gender = np.array([0 if str(g) == 'm'
-                                    else 1 for g in gender]).astype(np.int32)
+            self.gender = np.array([0 if g == 'm'
+                                    else 1 for g in np.asarray(gender).astype(str)]).astype(np.int32)
         except KeyError:
             self.gender = -1*np.ones(len(self.imgname)).astype(np.int32)
 
@@ -71,19 +80,24 @@ class DatasetHMR(Dataset):
             self.joint_mapper_gt = constants.J24_TO_J17 if dataset == 'mpi-inf-3dhp' \
                 else constants.J24_TO_J14
             self.J_regressor = torch.from_numpy(np.load(config.JOINT_REGRESSOR_H36M)).float()
-            self.smpl_male = SMPL(config.SMPL_MODEL_DIR,
-                                  gender='male',
-                                  create_transl=False)
-            self.smpl_female = SMPL(config.SMPL_MODEL_DIR,
-                                    gender='female',
-                                    create_transl=False)
-            self.smplx_male = SMPLX(config.SMPLX_MODEL_DIR,
-                                    gender='male')
-            self.smplx_female = SMPLX(config.SMPLX_MODEL_DIR,
-                                      gender='female')
-            self.smplx2smpl = pickle.load(open(config.SMPLX2SMPL, 'rb'))
-            self.smplx2smpl = torch.tensor(self.smplx2smpl['matrix'][None],
-                                           dtype=torch.float32)
+            # GT meshes precomputed by make_gt_mesh_cache.py, body models are only needed without it
+            self.gt_mesh = None
+            if self.options.GT_MESH_CACHE and has_gt_mesh(self.dataset):
+                self.gt_mesh = load_gt_mesh_cache(self.options.GT_MESH_CACHE, self.dataset, 'dataset_smpl')
+            if self.gt_mesh is None:
+                self.smpl_male = SMPL(config.SMPL_MODEL_DIR,
+                                      gender='male',
+                                      create_transl=False)
+                self.smpl_female = SMPL(config.SMPL_MODEL_DIR,
+                                        gender='female',
+                                        create_transl=False)
+                self.smplx_male = SMPLX(config.SMPLX_MODEL_DIR,
+                                        gender='male')
+                self.smplx_female = SMPLX(config.SMPLX_MODEL_DIR,
+                                          gender='female')
+                self.smplx2smpl = pickle.load(open(config.SMPLX2SMPL, 'rb'))
+                self.smplx2smpl = torch.tensor(self.smplx2smpl['matrix'][None],
+                                               dtype=torch.float32)
 
         if self.is_train:
             self.length = int(self.scale.shape[0] * self.options.CROP_PERCENT)
@@ -103,40 +117,17 @@ class DatasetHMR(Dataset):
 
     def rgb_processing(self, rgb_img_full, center, scale, img_res, kp2d=None):
 
-        if self.is_train and self.options.ALB: 
-            aug_comp = [A.Downscale(0.5, 0.9, interpolation=0, p=0.1),
-                        A.ImageCompression(20, 100, p=0.1),
-                        A.RandomRain(blur_value=4, p=0.1),
-                        A.MotionBlur(blur_limit=(3, 15),  p=0.2),
-                        A.Blur(blur_limit=(3, 10), p=0.1),
-                        A.RandomSnow(brightness_coeff=1.5,
-                        snow_point_lower=0.2, snow_point_upper=0.4)]
-            aug_mod = [A.CLAHE((1, 11), (10, 10), p=0.2), A.ToGray(p=0.2),
-                       A.RandomBrightnessContrast(p=0.2),
-                       A.MultiplicativeNoise(multiplier=[0.5, 1.5],
-                       elementwise=True, per_channel=True, p=0.2),
-                       A.HueSaturationValue(hue_shift_limit=20,
-                       sat_shift_limit=30, val_shift_limit=20,
-                       always_apply=False, p=0.2),
-                       A.Posterize(p=0.1),
-                       A.RandomGamma(gamma_limit=(80, 200), p=0.1),
-                       A.Equalize(mode='cv', p=0.1)]
-            albumentation_aug = A.Compose([A.OneOf(aug_comp,
-                                           p=self.options.ALB_PROB),
-                                           A.OneOf(aug_mod,
-                                           p=self.options.ALB_PROB)])          
-            rgb_img_full = albumentation_aug(image=rgb_img_full)['image']
+        if self.augmentation is not None:
+            rgb_img_full = self.augmentation(rgb_img_full)
 
-        rgb_img = crop(rgb_img_full, center, scale, [img_res, img_res])
+        rgb_img = self.crop_fn(rgb_img_full, center, scale, [img_res, img_res])
 
         rgb_img = np.transpose(rgb_img.astype('float32'),
                                (2, 0, 1))/255.0
         return rgb_img
 
     def j2d_processing(self, kp, center, scale):
-        nparts = kp.shape[0]
-        for i in range(nparts):
-            kp[i, 0:2] = transform(kp[i, 0:2] + 1, center, scale,
+        kp[:, 0:2] = transform_pts(kp[:, 0:2] + 1, center, scale,
                                    [self.options.IMG_RES,
                                    self.options.IMG_RES])
         kp[:, :-1] = 2. * kp[:, :-1] / self.options.IMG_RES - 1.
@@ -160,9 +151,9 @@ class DatasetHMR(Dataset):
                                             crop_scale_factor=1-self.options.CROP_FACTOR,
                                             axis='y')
 
-        imgname = os.path.join(self.img_dir, self.imgname[index])
+        imgname = os.path.join(self.img_dir, decode_str(self.imgname[index]))
         try:
-            cv_img = read_img(imgname)
+            cv_img = read_img(imgname, cache=self.image_cache)
         except Exception as E:
             print(E)
             logger.info(f'@{imgname} from {self.dataset}')
@@ -206,7 +197,11 @@ class DatasetHMR(Dataset):
                 item['focal_length'] = np.array([estimated_fl, estimated_fl])
         item['focal_length'] = np.array([estimated_fl, estimated_fl])
         if not self.is_train:
-            if '3dpw' in self.dataset:
+            if self.gt_mesh is not None:
+                item['vertices'] = torch.from_numpy(np.array(self.gt_mesh.vertices[index]))
+                if 'rich' in self.dataset:
+                    item['joints'] = torch.from_numpy(np.array(self.gt_mesh.joints[index]))
+            elif '3dpw' in self.dataset:
                 if self.gender[index] == 1:
                     gt_smpl_out = self.smpl_female(
                                 global_orient=item['pose'].unsqueeze(0)[:, :3],
@@ -8,7 +8,7 @@ from torchvision.transforms import Normalize
 from smplx import SMPL
 from ..core import constants, config
 from ..core.config import DATASET_FILES, DATASET_FOLDERS
-from ..utils.image_utils import crop, transform, random_crop, read_img
+from ..utils.image_utils import crop, transform_pts, random_crop, read_img, get_crop_fn
 
 
 class DatasetHMR(Dataset):
@@ -23,6 +23,8 @@ class DatasetHMR(Dataset):
         self.img_dir = DATASET_FOLDERS[dataset]
 
         self.normalize_img = Normalize(mean=constants.IMG_NORM_MEAN, std=constants.IMG_NORM_STD)
+        self.crop_fn = get_crop_fn(self.options.CROP_ENGINE)
+        # Not read from DATASET.LABEL_STORE, the hand selection below copies every field anyway
         self.data = np.load(DATASET_FILES[is_train][dataset].replace('.npz', '-hands.npz').replace('all_npz_12_training','all_npz_12_hands'), allow_pickle=True)
         self.right_hand_detect = np.asarray(self.data['right_hand']).astype(np.bool)
         self.left_hand_detect = np.asarray(self.data['left_hand']).astype(np.bool)
@@ -97,15 +99,13 @@ class DatasetHMR(Dataset):
 
     def rgb_processing(self, rgb_img_full, center, scale, img_res, kp2d=None):
 
-        rgb_img = crop(rgb_img_full, center, scale, [img_res, img_res])
+        rgb_img = self.crop_fn(rgb_img_full, center, scale, [img_res, img_res])
         rgb_img = np.transpose(rgb_img.astype('float32'),
                                (2, 0, 1)) / 255.0
         return rgb_img
 
     def j2d_processing(self, kp, center, scale):
-        nparts = kp.shape[0]
-        for i in range(nparts):
-            kp[i, 0:2] = transform(kp[i, 0:2] + 1, center, scale,
+        kp[:, 0:2] = transform_pts(kp[:, 0:2] + 1, center, scale,
                                    [self.options.IMG_RES,
                                    self.options.IMG_RES])
         kp[:, :-1] = 2. * kp[:, :-1] / self.options.IMG_RES - 1.
@@ -204,7 +204,7 @@ class DatasetHMR(Dataset):
         if 'cam_int' in self.data.files:
             item['focal_length'] = torch.tensor([self.cam_int[index][0, 0], self.cam_int[index][1, 1]])
         if 'cam_ext' in self.data.files:
-            item['translation'] = self.cam_ext[index][:, 3]
+            item['translation'] = self.cam_ext[index][:, 3].copy()
         if 'trans_cam' in self.data.files:
             item['translation'][:3] += self.trans_cam[index]
 
@@ -0,0 +1,136 @@
+"""
+Frame-grouped loading for multi-person scenes.
+
+Every person is a separate row of the scene npz, so with the per-row datasets
+a frame with N people is decoded N times. FrameGroupedDataset indexes the rows
+by imgname and returns all the people of a frame (or a chunk of them) from a
+single decode. FrameBatchSampler shuffles frames and packs their people into
+batches of exactly BATCH_SIZE samples, splitting a frame across two batches
+when it does not fit.
+"""
+import numpy as np
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+def group_rows_by_frame(imgname):
+    """
+    imgname: (N,) image name of every row
+    returns: rows sorted by frame, start offset of each frame in it and frame sizes
+    """
+    _, inverse = np.unique(np.asarray(imgname), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    sizes = np.bincount(inverse)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    return order, starts, sizes
+
+
+class FrameGroupedDataset(Dataset):
+    """
+    Concatenation of per-row datasets (DatasetHMR) indexed by frame.
+    An index is either a frame index or a (frame, start, stop) tuple selecting
+    people start:stop of that frame, the item is the list of their samples.
+    """
+    def __init__(self, datasets):
+        self.datasets = datasets
+        rows, frame_start, frame_size, frame_dataset = [], [], [], []
+        offset = 0
+        for ds_idx, ds in enumerate(datasets):
+            # Datasets may be shortened by CROP_PERCENT
+            order, starts, sizes = group_rows_by_frame(ds.imgname[:len(ds)])
+            rows.append(order)
+            frame_start.append(starts + offset)
+            frame_size.append(sizes)
+            frame_dataset.append(np.full(len(sizes), ds_idx))
+            offset += len(order)
+
+        self.rows = np.concatenate(rows)
+        self.frame_start = np.concatenate(frame_start)
+        self.frame_size = np.concatenate(frame_size)
+        self.frame_dataset = np.concatenate(frame_dataset)
+
+    def __len__(self):
+        return len(self.frame_size)
+
+    def __getitem__(self, index):
+        if isinstance(index, (tuple, list)):
+            frame, start, stop = index
+        else:
+            frame, start, stop = index, 0, self.frame_size[index]
+        ds = self.datasets[self.frame_dataset[frame]]
+        rows = self.rows[self.frame_start[frame] + start:self.frame_start[frame] + stop]
+        # Shard crops do not need the full frame
+        cv_img = ds.load_image(rows[0]) if ds.crop_shard is None else None
+        return [ds.get_sample(row, cv_img) for row in rows]
+
+
+def collate_frames(batch, collate_fn=default_collate):
+    """Flatten the per-frame sample lists and collate them as one batch."""
+    return collate_fn([item for frame in batch for item in frame])
+
+
+class FrameBatchSampler(Sampler):
+    """
+    Batches of (frame, start, stop) chunks holding exactly batch_size people.
+
+    frame_size: number of people of every frame
+    frame_dataset: dataset index of every frame
+    ratios: optional sampling ratio of each dataset. The number of frames drawn
+        from each dataset per epoch follows the ratios (datasets are cycled
+        through if needed), otherwise every frame is used once.
+    """
+    def __init__(self, frame_size, frame_dataset, batch_size, shuffle=True, ratios=None, drop_last=True):
+        self.frame_size = np.asarray(frame_size)
+        self.frame_dataset = np.asarray(frame_dataset)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.ratios = None
+        if ratios is not None:
+            assert len(ratios) == self.frame_dataset.max() + 1, 'Number of datasets and ratios should be equal'
+            self.ratios = np.asarray(ratios, dtype=np.float64) / np.sum(ratios)
+
+    def frames_per_dataset(self):
+        num_frames = len(self.frame_size)
+        return [int(round(r * num_frames)) for r in self.ratios]
+
+    def frame_order(self):
+        num_frames = len(self.frame_size)
+        if self.ratios is None:
+            return np.random.permutation(num_frames) if self.shuffle else np.arange(num_frames)
+
+        order = []
+        for ds_idx, num in enumerate(self.frames_per_dataset()):
+            frames = np.where(self.frame_dataset == ds_idx)[0]
+            if self.shuffle:
+                frames = np.random.permutation(frames)
+            order.append(np.resize(frames, num))
+        order = np.concatenate(order)
+        return np.random.permutation(order) if self.shuffle else order
+
+    def __iter__(self):
+        batch, filled = [], 0
+        for frame in self.frame_order():
+            start, size = 0, self.frame_size[frame]
+            while start < size:
+                stop = min(size, start + self.batch_size - filled)
+                batch.append((int(frame), int(start), int(stop)))
+                filled += stop - start
+                start = stop
+                if filled == self.batch_size:
+                    yield batch
+                    batch, filled = [], 0
+        if batch and not self.drop_last:
+            yield batch
+
+    def num_samples(self):
+        if self.ratios is None:
+            return int(self.frame_size.sum())
+        # Expected value, the exact count depends on which frames are drawn
+        return int(sum(num * self.frame_size[self.frame_dataset == ds_idx].mean()
+                       for ds_idx, num in enumerate(self.frames_per_dataset())))
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples() // self.batch_size
+        return (self.num_samples() + self.batch_size - 1) // self.batch_size
@@ -39,7 +39,15 @@ class MixedDataset(torch.utils.data.Dataset):
 
         self.partition = np.array(self.partition).cumsum()
 
+    @property
+    def dataset_sizes(self):
+        return [len(ds) for ds in self.datasets]
+
     def __getitem__(self, index):
+        # (dataset id, local index) pairs come from utils.dataloader.MixingSampler
+        if isinstance(index, (tuple, list)):
+            ds_id, local_idx = index
+            return self.datasets[ds_id][local_idx]
         p = np.random.rand()
         for i in range(len(self.datasets)):
             if p <= self.partition[i]:
@@ -0,0 +1,132 @@
+"""
+Albumentations pipeline used by the training datasets (DATASET.ALB).
+
+The pipeline is built once per worker instead of once per sample. Ops are
+grouped as before into a compression/blur/weather group and a colour group,
+one op of each group is picked with probability ALB_PROB. The ops of a preset
+(ALB_PRESET) can be re-weighted or disabled one by one through ALB_OPS, e.g.
+
+    DATASET:
+      ALB_PRESET: default
+      ALB_OPS:
+        SNOW: 0.        # disable
+        MOTION_BLUR: 0.4
+
+With ALB_TIMING, the time spent in every op is accumulated and logged
+periodically by each worker.
+"""
+import os
+import time
+import albumentations as A
+from loguru import logger
+
+COMPRESSION, COLOUR = 'compression', 'colour'
+
+# name: (group, default weight, constructor)
+AUGMENTATIONS = {
+    'DOWNSCALE': (COMPRESSION, 0.1, lambda p: A.Downscale(0.5, 0.9, interpolation=0, p=p)),
+    'IMAGE_COMPRESSION': (COMPRESSION, 0.1, lambda p: A.ImageCompression(20, 100, p=p)),
+    'RAIN': (COMPRESSION, 0.1, lambda p: A.RandomRain(blur_value=4, p=p)),
+    'MOTION_BLUR': (COMPRESSION, 0.2, lambda p: A.MotionBlur(blur_limit=(3, 15), p=p)),
+    'BLUR': (COMPRESSION, 0.1, lambda p: A.Blur(blur_limit=(3, 10), p=p)),
+    'SNOW': (COMPRESSION, 0.5, lambda p: A.RandomSnow(brightness_coeff=1.5, snow_point_lower=0.2,
+                                                       snow_point_upper=0.4, p=p)),
+    'CLAHE': (COLOUR, 0.2, lambda p: A.CLAHE((1, 11), (10, 10), p=p)),
+    'TO_GRAY': (COLOUR, 0.2, lambda p: A.ToGray(p=p)),
+    'BRIGHTNESS_CONTRAST': (COLOUR, 0.2, lambda p: A.RandomBrightnessContrast(p=p)),
+    'MULTIPLICATIVE_NOISE': (COLOUR, 0.2, lambda p: A.MultiplicativeNoise(multiplier=[0.5, 1.5], elementwise=True,
+                                                                          per_channel=True, p=p)),
+    'HUE_SATURATION_VALUE': (COLOUR, 0.2, lambda p: A.HueSaturationValue(hue_shift_limit=20, sat_shift_limit=30,
+                                                                         val_shift_limit=20, p=p)),
+    'POSTERIZE': (COLOUR, 0.1, lambda p: A.Posterize(p=p)),
+    'GAMMA': (COLOUR, 0.1, lambda p: A.RandomGamma(gamma_limit=(80, 200), p=p)),
+    'EQUALIZE': (COLOUR, 0.1, lambda p: A.Equalize(mode='cv', p=p)),
+}
+
+PRESETS = {
+    'default': list(AUGMENTATIONS.keys()),
+    # Ops that cost about as much as a crop, for throughput bound runs
+    'fast': ['DOWNSCALE', 'IMAGE_COMPRESSION', 'BLUR', 'TO_GRAY', 'BRIGHTNESS_CONTRAST', 'POSTERIZE', 'GAMMA'],
+}
+
+
+class OpTimer:
+    """Wraps the apply method of an op and accumulates its run time."""
+    def __init__(self, apply):
+        self.apply = apply
+        self.calls = 0
+        self.seconds = 0.
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        out = self.apply(*args, **kwargs)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        return out
+
+
+class Augmentation:
+    """
+    options: hparams.DATASET
+    The albumentations objects are created on the first call in every worker.
+    """
+    def __init__(self, options, log_every=10000):
+        self.prob = options.ALB_PROB
+        self.timing = options.ALB_TIMING
+        self.log_every = log_every
+        if options.ALB_PRESET not in PRESETS:
+            raise ValueError(f'Unknown augmentation preset {options.ALB_PRESET}, '
+                             f'available presets are {list(PRESETS.keys())}')
+
+        overrides = dict(options.ALB_OPS)
+        for name in overrides:
+            if name not in AUGMENTATIONS:
+                raise ValueError(f'Unknown augmentation {name}, available ones are {list(AUGMENTATIONS.keys())}')
+        # Ops with a weight of 0 are disabled
+        self.weights = {}
+        for name in PRESETS[options.ALB_PRESET]:
+            weight = overrides.get(name, AUGMENTATIONS[name][1])
+            if weight > 0:
+                self.weights[name] = weight
+        for name, weight in overrides.items():
+            if weight > 0:
+                self.weights[name] = weight
+
+        self.pipeline = None
+        self.timers = {}
+        self.num_calls = 0
+
+    def build(self):
+        groups = {COMPRESSION: [], COLOUR: []}
+        for name, weight in self.weights.items():
+            group, _, constructor = AUGMENTATIONS[name]
+            op = constructor(weight)
+            if self.timing:
+                # The instance attribute shadows the method of the transform class
+                self.timers[name] = OpTimer(op.apply)
+                op.apply = self.timers[name]
+            groups[group].append(op)
+        return A.Compose([A.OneOf(ops, p=self.prob) for ops in groups.values() if len(ops) > 0])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pipeline'] = None
+        state['timers'] = {}
+        return state
+
+    def __call__(self, image):
+        if self.pipeline is None:
+            self.pipeline = self.build()
+        image = self.pipeline(image=image)['image']
+        self.num_calls += 1
+        if self.timing and self.num_calls % self.log_every == 0:
+            self.log_timings()
+        return image
+
+    def timings(self):
+        """Number of calls and mean time in ms of every op of this worker."""
+        return {name: (t.calls, 1000. * t.seconds / max(t.calls, 1)) for name, t in self.timers.items()}
+
+    def log_timings(self):
+        summary = ', '.join(f'{name}: {calls} x {ms:.2f}ms' for name, (calls, ms) in self.timings().items())
+        logger.info(f'Augmentation timings of worker {os.getpid()} after {self.num_calls} images: {summary}')
@@ -0,0 +1,86 @@
+"""
+Cross-image batching of person crops for inference.
+
+The testers used to run one forward per image with the detections of that
+image as the batch, i.e. batch size 1 on single person folders. CropBatcher
+queues the crops of consecutive images and runs the model once batch_size
+crops are queued. Every crop carries its own bbox_center, bbox_scale, img_w
+and img_h. The outputs are scattered back to the images and returned in the
+order the images were added, as soon as all crops of an image are processed.
+"""
+import torch
+
+
+class CropBatcher:
+    '''
+    forward: function of a batch dict with the keys
+        img (B, 3, H, W), bbox_center (B, 2), bbox_scale (B,), img_w (B,), img_h (B,),
+        image_index (B,) index of the source image of every crop into
+        images, the list of the data of the images in the batch.
+        It returns a dict of outputs, tensors with the crops as first dimension.
+    batch_size: number of crops per forward
+    '''
+    def __init__(self, forward, batch_size=32, device='cuda'):
+        self.forward = forward
+        self.batch_size = batch_size
+        self.device = device
+        self.pending = []
+        self.queue = []
+
+    def add(self, key, crops, bbox_center, bbox_scale, img_w, img_h, data=None):
+        """
+        Queues the crops of one image, returns the list of (key, data, outputs) of the completed images.
+        crops: (N, 3, H, W) normalized crops of the image, N may be 0
+        bbox_center: (N, 2), bbox_scale: (N,)
+        img_w, img_h: size of the image
+        data: kept with the image, e.g. the image itself, and passed to forward
+        """
+        image = {'key': key, 'data': data, 'num_crops': len(crops), 'outputs': []}
+        self.pending.append(image)
+        for i in range(len(crops)):
+            self.queue.append((image, crops[i], bbox_center[i], bbox_scale[i], img_w, img_h))
+        while len(self.queue) >= self.batch_size:
+            self._run(self.queue[:self.batch_size])
+            self.queue = self.queue[self.batch_size:]
+        return self._pop_completed()
+
+    def flush(self):
+        """Runs the remaining crops, returns the (key, data, outputs) of all the remaining images."""
+        if len(self.queue) > 0:
+            self._run(self.queue)
+            self.queue = []
+        return self._pop_completed()
+
+    def _run(self, queue):
+        images, image_index = [], []
+        for image, *_ in queue:
+            if len(images) == 0 or images[-1] is not image:
+                images.append(image)
+            image_index.append(len(images) - 1)
+
+        def to_tensor(values):
+            return torch.tensor(values, dtype=torch.float32, device=self.device)
+
+        batch = {
+            'img': torch.stack([q[1] for q in queue]).to(self.device, non_blocking=True).float(),
+            'bbox_center': to_tensor([[float(c[0]), float(c[1])] for c in [q[2] for q in queue]]),
+            'bbox_scale': to_tensor([float(q[3]) for q in queue]),
+            'img_w': to_tensor([float(q[4]) for q in queue]),
+            'img_h': to_tensor([float(q[5]) for q in queue]),
+            'image_index': torch.tensor(image_index, device=self.device),
+            'images': [image['data'] for image in images],
+        }
+        output = self.forward(batch)
+        output = {k: v for k, v in output.items() if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == len(queue)}
+        for i, (image, *_) in enumerate(queue):
+            image['outputs'].append({k: v[i] for k, v in output.items()})
+
+    def _pop_completed(self):
+        completed = []
+        while len(self.pending) > 0 and len(self.pending[0]['outputs']) == self.pending[0]['num_crops']:
+            image = self.pending.pop(0)
+            outputs = {}
+            if image['num_crops'] > 0:
+                outputs = {k: torch.stack([o[k] for o in image['outputs']]) for k in image['outputs'][0]}
+            completed.append((image['key'], image['data'], outputs))
+        return completed
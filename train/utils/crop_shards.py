@@ -0,0 +1,108 @@
+"""
+Pre-cropped, memory-mapped image shards.
+
+Each scene is stored as a single uint8 array of shape (N, S, S, 3) written in
+.npy format (so it can be opened with np.load(..., mmap_mode='r')) plus a small
+index npz. Row i of the shard is the crop of row i of the label npz, taken
+around its bounding box with an extra context margin so that scale and crop
+augmentation can still be applied on top of it.
+"""
+import os
+import cv2
+import tqdm
+import numpy as np
+from loguru import logger
+
+from .image_utils import crop, read_img
+
+CROPS_SUFFIX = '.crops.npy'
+INDEX_SUFFIX = '.index.npz'
+
+
+def get_shard_paths(shard_dir, dataset):
+    return os.path.join(shard_dir, dataset + CROPS_SUFFIX), \
+           os.path.join(shard_dir, dataset + INDEX_SUFFIX)
+
+
+def write_crop_shard(label_file, img_dir, out_dir, dataset, margin=1.5, img_res=224, rotate=False):
+    '''
+    label_file: scene npz with imgname, center and scale
+    img_dir: folder that imgname is relative to
+    margin: ratio between the stored crop and the original bounding box
+    img_res: training resolution, the stored crop is img_res * margin pixels
+    rotate: rotate the full frame by 90 degrees before cropping (closeup scenes)
+    '''
+    data = np.load(label_file, allow_pickle=True)
+    imgname = data['imgname']
+    center = data['center'].astype(np.float32)
+    scale = data['scale'].astype(np.float32)
+    num_samples = len(imgname)
+    shard_res = int(round(img_res * margin))
+
+    os.makedirs(out_dir, exist_ok=True)
+    crops_file, index_file = get_shard_paths(out_dir, dataset)
+    crops = np.lib.format.open_memmap(crops_file, mode='w+', dtype=np.uint8,
+                                      shape=(num_samples, shard_res, shard_res, 3))
+    orig_shape = np.zeros((num_samples, 2), dtype=np.int32)
+
+    # Several people share a frame, decode each frame only once
+    frames, inverse = np.unique(imgname, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    boundaries = np.searchsorted(inverse[order], np.arange(len(frames) + 1))
+
+    for frame_idx in tqdm.tqdm(range(len(frames)), desc=dataset):
+        cv_img = read_img(os.path.join(img_dir, frames[frame_idx]))
+        if rotate:
+            cv_img = cv2.rotate(cv_img, cv2.ROTATE_90_CLOCKWISE)
+        for row in order[boundaries[frame_idx]:boundaries[frame_idx + 1]]:
+            crop_img = crop(cv_img, center[row], scale[row] * margin, [shard_res, shard_res])
+            crops[row] = np.clip(crop_img, 0, 255).astype(np.uint8)
+            orig_shape[row] = cv_img.shape[:2]
+
+    crops.flush()
+    del crops
+    np.savez(index_file, imgname=imgname, center=center, scale=scale,
+             orig_shape=orig_shape, margin=margin, res=shard_res)
+    logger.info(f'Saved {num_samples} crops of {dataset} to {crops_file}')
+    return crops_file, index_file
+
+
+class CropShard:
+    """
+    Read-only view of a crop shard. The memory map is opened lazily so that
+    every DataLoader worker maps the file itself instead of receiving a copy.
+    """
+    def __init__(self, shard_dir, dataset):
+        self.crops_file, index_file = get_shard_paths(shard_dir, dataset)
+        index = np.load(index_file)
+        self.center = index['center']
+        self.scale = index['scale']
+        self.orig_shape = index['orig_shape']
+        self.margin = float(index['margin'])
+        self.res = int(index['res'])
+        self._crops = None
+
+    @property
+    def crops(self):
+        if self._crops is None:
+            self._crops = np.load(self.crops_file, mmap_mode='r')
+        return self._crops
+
+    def __len__(self):
+        return len(self.center)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_crops'] = None
+        return state
+
+    def to_shard_coords(self, index, center, scale):
+        """Map a bbox given in full image coordinates to the stored crop."""
+        k = self.res / (200. * self.scale[index] * self.margin)
+        shard_center = (np.asarray(center) - self.center[index]) * k + self.res / 2.
+        return shard_center, scale * k
+
+    def get(self, index, center, scale):
+        """Return the stored crop (zero-copy view) and the bbox in its coordinates."""
+        shard_center, shard_scale = self.to_shard_coords(index, center, scale)
+        return self.crops[index], shard_center, shard_scale
@@ -1,19 +1,86 @@
 from __future__ import division
 import torch
-from torch.utils.data import DataLoader
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.utils.data.sampler import Sampler
 
 
+def get_dist_info(num_replicas=None, rank=None):
+    initialized = dist.is_available() and dist.is_initialized()
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if initialized else 1
+    if rank is None:
+        rank = dist.get_rank() if initialized else 0
+    return num_replicas, rank
+
+
+def get_distributed_sampler(dataset, shuffle=False, seed=0):
+    """
+    DistributedSampler of dataset when training on several ranks, None otherwise.
+    The trainers disable Lightning's sampler replacement (replace_sampler_ddp=False)
+    because of their own train samplers, the other loaders are sharded with this one.
+    """
+    num_replicas, rank = get_dist_info()
+    if num_replicas == 1:
+        return None
+    return DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+
+
+def to_list(perm):
+    # Permutations are stored as tensors in the checkpoints
+    return perm.tolist() if torch.is_tensor(perm) else list(perm)
+
+
+def get_checkpoint_epoch(checkpoint):
+    """
+    Epoch of a sampler checkpoint and its offset to the epoch counter of the trainer.
+    Lightning saves current_epoch + 1 also in a mid-epoch checkpoint and calls
+    set_epoch with it after the restore, while the sampler still has to finish
+    the saved epoch.
+    """
+    if checkpoint is None:
+        return 0, 0
+    epoch = checkpoint.get('epoch', 0)
+    return epoch, checkpoint.get('trainer_epoch', epoch) - epoch
+
+
 class RandomSampler(Sampler):
+    """
+    Random order of the epoch, sharded over the ranks. The permutation is seeded
+    with seed + epoch so that all ranks draw the same one and take disjoint parts.
+    checkpoint: dict written by CheckpointDataLoader.state_dict, resumes the
+    permutation (dataset_perm) after batch_idx batches.
+    """
 
-    def __init__(self, data_source, checkpoint):
+    def __init__(self, data_source, checkpoint, seed=0, num_replicas=1, rank=0):
         self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch, self.epoch_offset = get_checkpoint_epoch(checkpoint)
         if checkpoint is not None and checkpoint['dataset_perm'] is not None:
-            self.dataset_perm = checkpoint['dataset_perm']
+            self.dataset_perm = to_list(checkpoint['dataset_perm'])
             self.perm = self.dataset_perm[checkpoint['batch_size'] * checkpoint['batch_idx']:]
         else:
-            self.dataset_perm = torch.randperm(len(self.data_source)).tolist()
-            self.perm = torch.randperm(len(self.data_source)).tolist()
+            self.dataset_perm = self.get_perm()
+            self.perm = self.dataset_perm
+
+    def get_perm(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        # Same number of samples on every rank
+        total = len(self.data_source) // self.num_replicas * self.num_replicas
+        perm = torch.randperm(len(self.data_source), generator=generator)[:total]
+        return perm[self.rank::self.num_replicas].tolist()
+
+    def set_epoch(self, epoch):
+        # Lightning's epoch counter, see get_checkpoint_epoch
+        epoch = epoch - self.epoch_offset
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.dataset_perm = self.get_perm()
+            self.perm = self.dataset_perm
 
     def __iter__(self):
         return iter(self.perm)
@@ -24,13 +91,24 @@ class RandomSampler(Sampler):
 
 class SequentialSampler(Sampler):
 
-    def __init__(self, data_source, checkpoint):
+    def __init__(self, data_source, checkpoint, num_replicas=1, rank=0):
         self.data_source = data_source
+        self.epoch, self.epoch_offset = get_checkpoint_epoch(checkpoint)
+        total = len(self.data_source) // num_replicas * num_replicas
+        self.full_perm = list(range(total))[rank::num_replicas]
         if checkpoint is not None and checkpoint['dataset_perm'] is not None:
-            self.dataset_perm = checkpoint['dataset_perm']
+            self.dataset_perm = to_list(checkpoint['dataset_perm'])
             self.perm = self.dataset_perm[checkpoint['batch_size'] * checkpoint['batch_idx']:]
         else:
-            self.dataset_perm = list(range(len(self.data_source)))
+            self.dataset_perm = self.full_perm
+            self.perm = self.dataset_perm
+
+    def set_epoch(self, epoch):
+        # Lightning's epoch counter, see get_checkpoint_epoch
+        epoch = epoch - self.epoch_offset
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.dataset_perm = self.full_perm
             self.perm = self.dataset_perm
 
     def __iter__(self):
@@ -40,6 +118,99 @@ class SequentialSampler(Sampler):
         return len(self.perm)
 
 
+def get_mixing_counts(ratios, num_samples):
+    """Number of samples of each dataset, exact up to rounding (largest remainder)."""
+    ratios = np.asarray(ratios, dtype=np.float64)
+    quotas = ratios / ratios.sum() * num_samples
+    counts = np.floor(quotas).astype(np.int64)
+    remainder = num_samples - counts.sum()
+    counts[np.argsort(counts - quotas)[:remainder]] += 1
+    return counts
+
+
+def get_mixing_plan(dataset_sizes, ratios, num_samples, seed=0, epoch=0):
+    """
+    Index plan of one epoch of a MixedDataset.
+    Every dataset is read as an endless stream of permutations (a new one per pass,
+    seeded by seed/dataset/pass), so a sample is never drawn twice before all the
+    others of its dataset have been drawn once, also across epochs.
+    returns: dataset id and local index of every sample, (num_samples,) each
+    """
+    counts = get_mixing_counts(ratios, num_samples)
+    ds_ids = np.repeat(np.arange(len(counts)), counts)
+    local_idx = np.empty(num_samples, dtype=np.int64)
+    for ds_id, (size, count) in enumerate(zip(dataset_sizes, counts)):
+        pos = np.arange(epoch * count, (epoch + 1) * count)
+        passes = pos // size
+        local = np.empty(count, dtype=np.int64)
+        for p in np.unique(passes):
+            perm = np.random.RandomState([seed, ds_id, p]).permutation(size)
+            mask = passes == p
+            local[mask] = perm[pos[mask] % size]
+        local_idx[ds_ids == ds_id] = local
+    shuffle = np.random.RandomState([seed, epoch]).permutation(num_samples)
+    return ds_ids[shuffle], local_idx[shuffle]
+
+
+class MixingSampler(Sampler):
+    """
+    Deterministic sampler for MixedDataset, yields (dataset id, local index) pairs.
+    The plan only depends on seed and epoch, so the samples do not depend on the
+    number of workers. Each rank gets every num_replicas-th sample of the plan and
+    the sampler can start from an offset within the rank's share (mid-epoch resume).
+    """
+    def __init__(self, dataset_sizes, ratios, num_samples, seed=0, num_replicas=None, rank=None):
+        num_replicas, rank = get_dist_info(num_replicas, rank)
+        self.dataset_sizes = list(dataset_sizes)
+        self.ratios = list(ratios)
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # Same number of samples on every rank
+        self.num_samples = num_samples // num_replicas
+        self.epoch = 0
+        self.epoch_offset = 0
+        self.start_offset = 0
+
+    def set_epoch(self, epoch):
+        # Lightning's epoch counter, see get_checkpoint_epoch
+        epoch = epoch - self.epoch_offset
+        if epoch != self.epoch:
+            self.start_offset = 0
+        self.epoch = epoch
+
+    def state_dict(self, consumed=0, batch_size=1, trainer_epoch=None):
+        """
+        consumed: samples of the current epoch used since the sampler started
+        batch_size: the epoch is complete once less than a batch is left (drop_last)
+        trainer_epoch: epoch stored in the same Lightning checkpoint, set_epoch is
+            called with it after the restore
+        """
+        offset = self.start_offset + consumed
+        if self.num_samples - offset < batch_size:
+            # Epoch is complete, continue with the next one
+            state = {'seed': self.seed, 'epoch': self.epoch + 1, 'offset': 0}
+        else:
+            state = {'seed': self.seed, 'epoch': self.epoch, 'offset': offset}
+        state['trainer_epoch'] = state['epoch'] if trainer_epoch is None else trainer_epoch
+        return state
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch, self.epoch_offset = get_checkpoint_epoch(state)
+        self.start_offset = state['offset']
+
+    def __iter__(self):
+        ds_ids, local_idx = get_mixing_plan(self.dataset_sizes, self.ratios,
+                                            self.num_samples * self.num_replicas, self.seed, self.epoch)
+        ds_ids = ds_ids[self.rank::self.num_replicas][self.start_offset:]
+        local_idx = local_idx[self.rank::self.num_replicas][self.start_offset:]
+        return iter(zip(ds_ids.tolist(), local_idx.tolist()))
+
+    def __len__(self):
+        return self.num_samples - self.start_offset
+
+
 class CheckpointDataLoader(DataLoader):
     """
     Extends torch.utils.data.DataLoader to handle resuming training from an arbitrary point within an epoch.
@@ -47,18 +218,40 @@ class CheckpointDataLoader(DataLoader):
 
     def __init__(self, dataset, checkpoint=None, batch_size=1,
                  shuffle=False, num_workers=0, pin_memory=False, drop_last=True,
-                 timeout=0, worker_init_fn=None):
+                 timeout=0, worker_init_fn=None, collate_fn=None, seed=0, num_replicas=None, rank=None):
 
+        num_replicas, rank = get_dist_info(num_replicas, rank)
         if shuffle:
-            sampler = RandomSampler(dataset, checkpoint)
+            sampler = RandomSampler(dataset, checkpoint, seed=seed, num_replicas=num_replicas, rank=rank)
         else:
-            sampler = SequentialSampler(dataset, checkpoint)
-        if checkpoint is not None:
+            sampler = SequentialSampler(dataset, checkpoint, num_replicas=num_replicas, rank=rank)
+        if checkpoint is not None and checkpoint['dataset_perm'] is not None:
             self.checkpoint_batch_idx = checkpoint['batch_idx']
         else:
             self.checkpoint_batch_idx = 0
 
         super(CheckpointDataLoader, self).__init__(dataset, sampler=sampler, shuffle=False, batch_size=batch_size,
-                                                   num_workers=num_workers,
+                                                   num_workers=num_workers, collate_fn=collate_fn,
                                                    drop_last=drop_last, pin_memory=pin_memory, timeout=timeout,
-                                                   worker_init_fn=None)
\ No newline at end of file
+                                                   worker_init_fn=worker_init_fn)
+
+    def state_dict(self, batch_idx, trainer_epoch=None):
+        """
+        batch_idx: batches of the current epoch trained by this loader
+        trainer_epoch: epoch stored in the same Lightning checkpoint, set_epoch is
+            called with it after the restore
+        returns: checkpoint to resume from, stores the permutation of this rank
+        """
+        sampler = self.sampler
+        # Offset of the resumed part, 0 once the sampler moved to a new epoch
+        start_idx = (len(sampler.dataset_perm) - len(sampler.perm)) // self.batch_size
+        batch_idx = start_idx + batch_idx
+        if (batch_idx + 1) * self.batch_size > len(sampler.dataset_perm):
+            # Epoch is complete, continue with a new permutation
+            state = {'dataset_perm': None, 'batch_size': self.batch_size,
+                     'batch_idx': 0, 'epoch': sampler.epoch + 1}
+        else:
+            state = {'dataset_perm': torch.tensor(sampler.dataset_perm), 'batch_size': self.batch_size,
+                     'batch_idx': batch_idx, 'epoch': sampler.epoch}
+        state['trainer_epoch'] = state['epoch'] if trainer_epoch is None else trainer_epoch
+        return state
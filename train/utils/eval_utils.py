@@ -4,43 +4,72 @@ Parts of the code are adapted from https://github.com/akanazawa/hmr
 import os
 import json
 import yaml
-import cv2
 import torch
 import numpy as np
 from loguru import logger
 from .geometry import euler_angles_from_rotmat
+from ..core.constants import NUM_JOINTS_SMPLX, SMPLX_BODY_JOINT_NAMES
 SMPL_OR_JOINTS = np.array([0, 1, 2, 4, 5, 16, 17, 18, 19])
 
 
-def joint_angle_error(pred_mat, gt_mat):
+def geodesic_angle(r1, r2):
+    """
+    Angle of the relative rotation r1 * r2.T, from its trace.
+    :param r1, r2: rotation matrices. Shape: (..., 3, 3)
+    :return: angles in radians, in [0, pi]. Shape: (...)
+    """
+    r = np.matmul(r1.astype(np.float64), np.swapaxes(r2.astype(np.float64), -1, -2))
+    cos = (np.trace(r, axis1=-2, axis2=-1) - 1.) / 2.
+    # Rounding can push the cosine slightly outside [-1, 1]
+    return np.arccos(np.clip(cos, -1., 1.))
+
+
+def geodesic_angle_torch(r1, r2, eps=0.):
+    """
+    Torch version of geodesic_angle, eps > 0 keeps the gradient of acos finite.
+    """
+    r = torch.matmul(r1, r2.transpose(-1, -2))
+    cos = (r.diagonal(dim1=-2, dim2=-1).sum(-1) - 1.) / 2.
+    return torch.acos(torch.clamp(cos, -1. + eps, 1. - eps))
+
+
+def joint_angle_error(pred_mat, gt_mat, joints=SMPL_OR_JOINTS):
     """
     Compute the geodesic distance between the two input matrices.
     :param pred_mat: predicted rotation matrices. Shape: ( Seq, 24, 3, 3)
     :param gt_mat: ground truth rotation matrices. Shape: ( Seq, 24, 3, 3)
+    :param joints: joints to evaluate, the SMPL orientation joints by default
     :return: Mean geodesic distance between input matrices.
     """
+    return joint_angle_error_per_joint(pred_mat, gt_mat, joints).mean()
 
-    gt_mat = gt_mat[:, SMPL_OR_JOINTS, :, :]
-    pred_mat = pred_mat[:, SMPL_OR_JOINTS, :, :]
-
-    # Reshape the matrices into B x 3 x 3 arrays
-    r1 = np.reshape(pred_mat, [-1, 3, 3])
-    r2 = np.reshape(gt_mat, [-1, 3, 3])
 
-    # Transpose gt matrices
-    r2t = np.transpose(r2, [0, 2, 1])
-
-    # compute R1 * R2.T, if prediction and target match, this will be the identity matrix
-    r = np.matmul(r1, r2t)
-
-    angles = []
-    # Convert rotation matrix to axis angle representation and find the angle
-    for i in range(r1.shape[0]):
-        aa, _ = cv2.Rodrigues(r[i])
-        angles.append(np.linalg.norm(aa))
+def joint_angle_error_per_joint(pred_mat, gt_mat, joints=np.arange(NUM_JOINTS_SMPLX)):
+    """
+    Geodesic distance of every joint, the SMPL-X body joints by default.
+    Works with numpy arrays and torch tensors.
+    :param pred_mat: predicted rotation matrices. Shape: ( Seq, >=22, 3, 3)
+    :param gt_mat: ground truth rotation matrices. Shape: ( Seq, >=22, 3, 3)
+    :param joints: joints to evaluate, None for all of them
+    :return: angles in radians. Shape: ( Seq, J)
+    """
+    if joints is not None:
+        pred_mat = pred_mat[:, joints]
+        gt_mat = gt_mat[:, joints]
+    if torch.is_tensor(pred_mat):
+        return geodesic_angle_torch(pred_mat, gt_mat)
+    return geodesic_angle(pred_mat, gt_mat)
 
-    return np.mean(np.array(angles))
 
+def joint_angle_error_summary(pred_mat, gt_mat):
+    """
+    Mean angular error in degrees of every SMPL-X body joint, {joint name: error}.
+    """
+    errors = joint_angle_error_per_joint(pred_mat, gt_mat)
+    if torch.is_tensor(errors):
+        errors = errors.detach().cpu().numpy()
+    errors = np.degrees(errors.mean(0))
+    return dict(zip(SMPLX_BODY_JOINT_NAMES, errors.tolist()))
 
 
 def compute_similarity_transform_pitchyawroll(S1, S2):
@@ -243,6 +272,58 @@ def compute_similarity_transform_batch_pitchyawroll(S1, S2):
         S1_hat[i], S1_pitch[i], S1_yaw[i], S1_roll[i] = compute_similarity_transform_pitchyawroll(S1[i], S2[i])
     return S1_hat, S1_pitch, S1_yaw, S1_roll
 
+def compute_similarity_transform_torch(S1, S2):
+    """
+    Batched torch version of compute_similarity_transform, runs on the device of the inputs.
+    S1, S2: (B, N, 3)
+    """
+    # 1. Remove mean.
+    mu1 = S1.mean(dim=1, keepdim=True)
+    mu2 = S2.mean(dim=1, keepdim=True)
+    X1 = S1 - mu1
+    X2 = S2 - mu2
+
+    # 2. Compute variance of X1 used for scale.
+    var1 = (X1 ** 2).sum(dim=(1, 2))
+
+    # 3. The outer product of X1 and X2, (B, 3, 3). The SVD is done in double precision.
+    K = torch.matmul(X1.transpose(1, 2), X2).double()
+
+    # 4. Solution that Maximizes trace(R'K) is R=U*V', where U, V are
+    # singular vectors of K.
+    U, s, Vh = torch.linalg.svd(K)
+    V = Vh.transpose(1, 2)
+    # Construct Z that fixes the orientation of R to get det(R)=1.
+    Z = torch.eye(3, dtype=K.dtype, device=K.device).repeat(K.shape[0], 1, 1)
+    Z[:, -1, -1] *= torch.sign(torch.det(torch.matmul(U, V.transpose(1, 2))))
+    # Construct R.
+    R = torch.matmul(V, torch.matmul(Z, U.transpose(1, 2)))
+
+    # 5. Recover scale.
+    scale = torch.diagonal(torch.matmul(R, K), dim1=1, dim2=2).sum(-1) / var1.double()
+    R = R.to(S1.dtype)
+    scale = scale.to(S1.dtype)[:, None, None]
+
+    # 6. Recover translation.
+    t = mu2 - scale * torch.matmul(mu1, R.transpose(1, 2))
+
+    # 7. Error:
+    return scale * torch.matmul(S1, R.transpose(1, 2)) + t
+
+
+def reconstruction_error_torch(S1, S2, reduction='mean'):
+    """Same as reconstruction_error for (B, N, 3) tensors, without leaving their device."""
+    S1_hat = compute_similarity_transform_torch(S1, S2)
+
+    re_per_joint = torch.sqrt(((S1_hat - S2) ** 2).sum(dim=-1))
+    re = re_per_joint
+    if reduction == 'mean':
+        re = re.mean()
+    elif reduction == 'sum':
+        re = re.sum()
+    return re, re_per_joint
+
+
 def reconstruction_error(S1, S2, reduction='mean'):
     """Do Procrustes alignment and compute reconstruction error."""
     S1_hat = compute_similarity_transform_batch(S1, S2)
@@ -467,38 +467,71 @@ def estimate_translation_np(S, joints_2d, joints_conf, focal_length=5000., img_s
     return trans
 
 
-def estimate_translation(S, joints_2d, focal_length=5000., img_size=224., use_all_joints=False, rotation=None):
-    """Find camera translation that brings 3D joints S closest to 2D the corresponding joints_2d.
+def estimate_translation_batch(S, joints_2d, joints_conf, focal_length, img_size):
+    """Batched weighted least squares version of estimate_translation_np, on the device of S.
+    The normal equations A t = b (3x3 per sample) are accumulated over the joints
+    directly, without the dense (2J, 2J) weight matrix.
     Input:
-        S: (B, 49, 3) 3D joint locations
-        joints: (B, 49, 3) 2D joint locations and confidence
+        S: (B, J, 3) 3D joint locations
+        joints_2d: (B, J, 2) 2D joint locations
+        joints_conf: (B, J) joint confidences, used as weights
+        focal_length: scalar or (fx, fy) pair shared by the batch, (B, 1) or (B, 2) per sample.
+            A (B,) vector is rejected, it would be taken for a pair when B is 2
+        img_size: same for the image size (w, h), the optical center is in the middle
     Returns:
         (B, 3) camera translation vectors
     """
-
-    device = S.device
-
+    B = S.shape[0]
+    S = S.double()
+    joints_2d = joints_2d.double()
+    w = joints_conf.double()
+
+    def per_sample_xy(x):
+        x = torch.as_tensor(x, dtype=torch.float64, device=S.device)
+        if x.dim() == 0:
+            x = x.reshape(1, 1)
+        elif x.dim() == 1:
+            if x.shape[0] != 2:
+                raise ValueError(f'Expected a (2,) pair or (B, 1) / (B, 2) values per sample, got {tuple(x.shape)}')
+            x = x.reshape(1, 2)
+        return x.expand(B, 2)
+
+    f = per_sample_xy(focal_length)[:, None]
+    center = per_sample_xy(img_size)[:, None] / 2.
+
+    # Two rows per joint: [f_x, 0, o_x - x] and [0, f_y, o_y - y]
+    Q = torch.zeros(B, S.shape[1], 2, 3, dtype=torch.float64, device=S.device)
+    Q[..., 0, 0] = f[..., 0]
+    Q[..., 1, 1] = f[..., 1]
+    Q[..., 2] = center - joints_2d
+    c = (joints_2d - center) * S[..., 2:] - f * S[..., :2]
+
+    A = torch.einsum('bj,bjki,bjkl->bil', w, Q, Q)
+    b = torch.einsum('bj,bjki,bjk->bi', w, Q, c)
+    return torch.linalg.solve(A, b)
+
+
+def _select_joints(S, joints_2d, use_all_joints, rotation):
     if rotation is not None:
         S = torch.einsum('bij,bkj->bki', rotation, S)
 
     # Use only joints 25:49 (GT joints)
-    if use_all_joints:
-        S = S.cpu().numpy()
-        joints_2d = joints_2d.cpu().numpy()
-    else:
-        S = S[:, 25:, :].cpu().numpy()
-        joints_2d = joints_2d[:, 25:, :].cpu().numpy()
+    if not use_all_joints:
+        S = S[:, 25:, :]
+        joints_2d = joints_2d[:, 25:, :]
+    return S, joints_2d[:, :, :-1].to(S.device), joints_2d[:, :, -1].to(S.device)
+
 
-    joints_conf = joints_2d[:, :, -1]
-    joints_2d = joints_2d[:, :, :-1]
-    trans = np.zeros((S.shape[0], 3), dtype=np.float32)
-    # Find the translation for each example in the batch
-    for i in range(S.shape[0]):
-        S_i = S[i]
-        joints_i = joints_2d[i]
-        conf_i = joints_conf[i]
-        trans[i] = estimate_translation_np(S_i, joints_i, conf_i, focal_length=focal_length, img_size=img_size)
-    return torch.from_numpy(trans).to(device)
+def estimate_translation(S, joints_2d, focal_length=5000., img_size=224., use_all_joints=False, rotation=None):
+    """Find camera translation that brings 3D joints S closest to 2D the corresponding joints_2d.
+    Input:
+        S: (B, 49, 3) 3D joint locations
+        joints: (B, 49, 3) 2D joint locations and confidence
+    Returns:
+        (B, 3) camera translation vectors
+    """
+    S, joints_2d, joints_conf = _select_joints(S, joints_2d, use_all_joints, rotation)
+    return estimate_translation_batch(S, joints_2d, joints_conf, focal_length, img_size).float()
 
 
 def estimate_translation_cam(S, joints_2d, focal_length=(5000., 5000.), img_size=(224., 224.),
@@ -507,74 +540,13 @@ def estimate_translation_cam(S, joints_2d, focal_length=(5000., 5000.), img_size
     Input:
         S: (B, 49, 3) 3D joint locations
         joints: (B, 49, 3) 2D joint locations and confidence
+        focal_length: (fx, fy) shared by the batch
+        img_size: (w, h) shared by the batch
     Returns:
         (B, 3) camera translation vectors
     """
-
-    def estimate_translation_np(S, joints_2d, joints_conf, focal_length=(5000., 5000.), img_size=(224., 224.)):
-        """Find camera translation that brings 3D joints S closest to 2D the corresponding joints_2d.
-        Input:
-            S: (25, 3) 3D joint locations
-            joints: (25, 3) 2D joint locations and confidence
-        Returns:
-            (3,) camera translation vector
-        """
-
-        num_joints = S.shape[0]
-        # focal length
-        f = np.array([focal_length[0], focal_length[1]])
-        # optical center
-        center = np.array([img_size[0] / 2., img_size[1] / 2.])
-
-        # transformations
-        Z = np.reshape(np.tile(S[:, 2], (2, 1)).T, -1)
-        XY = np.reshape(S[:, 0:2], -1)
-        O = np.tile(center, num_joints)
-        F = np.tile(f, num_joints)
-        weight2 = np.reshape(np.tile(np.sqrt(joints_conf), (2, 1)).T, -1)
-
-        # least squares
-        Q = np.array([F * np.tile(np.array([1, 0]), num_joints), F * np.tile(np.array([0, 1]), num_joints),
-                      O - np.reshape(joints_2d, -1)]).T
-        c = (np.reshape(joints_2d, -1) - O) * Z - F * XY
-
-        # weighted least squares
-        W = np.diagflat(weight2)
-        Q = np.dot(W, Q)
-        c = np.dot(W, c)
-
-        # square matrix
-        A = np.dot(Q.T, Q)
-        b = np.dot(Q.T, c)
-
-        # solution
-        trans = np.linalg.solve(A, b)
-
-        return trans
-
-    device = S.device
-
-    if rotation is not None:
-        S = torch.einsum('bij,bkj->bki', rotation, S)
-
-    # Use only joints 25:49 (GT joints)
-    if use_all_joints:
-        S = S.cpu().numpy()
-        joints_2d = joints_2d.cpu().numpy()
-    else:
-        S = S[:, 25:, :].cpu().numpy()
-        joints_2d = joints_2d[:, 25:, :].cpu().numpy()
-
-    joints_conf = joints_2d[:, :, -1]
-    joints_2d = joints_2d[:, :, :-1]
-    trans = np.zeros((S.shape[0], 3), dtype=np.float32)
-    # Find the translation for each example in the batch
-    for i in range(S.shape[0]):
-        S_i = S[i]
-        joints_i = joints_2d[i]
-        conf_i = joints_conf[i]
-        trans[i] = estimate_translation_np(S_i, joints_i, conf_i, focal_length=focal_length, img_size=img_size)
-    return torch.from_numpy(trans).to(device)
+    S, joints_2d, joints_conf = _select_joints(S, joints_2d, use_all_joints, rotation)
+    return estimate_translation_batch(S, joints_2d, joints_conf, focal_length, img_size).float()
 
 
 def estimate_translation_fullimg(S, joints_2d, focal_length, img_size,
@@ -583,76 +555,13 @@ def estimate_translation_fullimg(S, joints_2d, focal_length, img_size,
     Input:
         S: (B, 49, 3) 3D joint locations
         joints: (B, 49, 3) 2D joint locations and confidence
+        focal_length: (B, 2) focal length of every sample
+        img_size: (B, 2) image size of every sample
     Returns:
         (B, 3) camera translation vectors
     """
-
-    def estimate_translation_np(S, joints_2d, joints_conf, focal_length, img_size):
-        """Find camera translation that brings 3D joints S closest to 2D the corresponding joints_2d.
-        Input:
-            S: (25, 3) 3D joint locations
-            joints: (25, 3) 2D joint locations and confidence
-        Returns:
-            (3,) camera translation vector
-        """
-
-        num_joints = S.shape[0]
-        # focal length
-        f = np.array([focal_length[0], focal_length[1]])
-        # optical center
-        center = np.array([img_size[0] / 2., img_size[1] / 2.])
-
-        # transformations
-        Z = np.reshape(np.tile(S[:, 2], (2, 1)).T, -1)
-        XY = np.reshape(S[:, 0:2], -1)
-        O = np.tile(center, num_joints)
-        F = np.tile(f, num_joints)
-        weight2 = np.reshape(np.tile(np.sqrt(joints_conf), (2, 1)).T, -1)
-
-        # least squares
-        Q = np.array([F * np.tile(np.array([1, 0]), num_joints), F * np.tile(np.array([0, 1]), num_joints),
-                      O - np.reshape(joints_2d, -1)]).T
-        c = (np.reshape(joints_2d, -1) - O) * Z - F * XY
-
-        # weighted least squares
-        W = np.diagflat(weight2)
-        Q = np.dot(W, Q)
-        c = np.dot(W, c)
-
-        # square matrix
-        A = np.dot(Q.T, Q).astype(float)
-        b = np.dot(Q.T, c).astype(float)
-        # solution
-
-        trans = np.linalg.solve(A, b)
-
-        return trans
-
-    device = S.device
-    
-    if rotation is not None:
-        S = torch.einsum('bij,bkj->bki', rotation, S)
-
-    # Use only joints 25:49 (GT joints)
-    if use_all_joints:
-        S = S.cpu().numpy()
-        joints_2d = joints_2d.cpu().numpy()
-    else:
-        S = S[:, 25:, :].cpu().numpy()
-        joints_2d = joints_2d[:, 25:, :].cpu().numpy()
-
-    joints_conf = joints_2d[:, :, -1]
-    joints_2d = joints_2d[:, :, :-1]
-    trans = np.zeros((S.shape[0], 3), dtype=np.float32)
-    # Find the translation for each example in the batch
-    for i in range(S.shape[0]):
-        S_i = S[i]
-        joints_i = joints_2d[i]
-        conf_i = joints_conf[i]
-        fl_i = focal_length[i]
-        img_size_i = img_size[i]
-        trans[i] = estimate_translation_np(S_i, joints_i, conf_i, focal_length=fl_i, img_size=img_size_i)
-    return torch.from_numpy(trans).to(device)
+    S, joints_2d, joints_conf = _select_joints(S, joints_2d, use_all_joints, rotation)
+    return estimate_translation_batch(S, joints_2d, joints_conf, focal_length, img_size).float()
 
 
 def get_coord_maps(size=56):
@@ -0,0 +1,110 @@
+"""
+Batched cropping and photometric augmentation on the GPU.
+
+Used when DATASET.GPU_CROP is enabled: dataset workers only decode the frame
+and return it as uint8 together with the crop center/scale, the crop,
+augmentation and normalization are then done for the whole batch at once.
+"""
+import torch
+from torch.utils.data.dataloader import default_collate
+from kornia.geometry.transform import warp_affine
+
+from ..core import constants
+
+FRAME_KEY = 'img_uint8'
+
+
+def collate_full_frames(batch):
+    """Default collate, except that the decoded frames are kept as a list
+    since frames of different scenes do not share the same size."""
+    frames = [item.pop(FRAME_KEY) for item in batch]
+    batch = default_collate(batch)
+    batch[FRAME_KEY] = frames
+    return batch
+
+
+def get_crop_matrices(center, scale, res):
+    """Batched version of image_utils.get_transform (without rotation),
+    including the half pixel shift used by image_utils.crop_affine.
+    center: (B, 2), scale: (B,) -> (B, 2, 3)"""
+    h = 200. * scale
+    s = res / h
+    mat = torch.zeros((center.shape[0], 2, 3), dtype=center.dtype, device=center.device)
+    mat[:, 0, 0] = s
+    mat[:, 1, 1] = s
+    mat[:, 0, 2] = res * (-center[:, 0] / h + .5) + 0.5 * s - 0.5
+    mat[:, 1, 2] = res * (-center[:, 1] / h + .5) + 0.5 * s - 0.5
+    return mat
+
+
+def crop_frames(frames, center, scale, res):
+    """
+    frames: list of (H, W, 3) uint8 tensors, already on the target device
+    center, scale: crop box in frame coordinates
+    returns: (B, 3, res, res) float images in [0, 1]
+    """
+    crops = torch.zeros((len(frames), 3, res, res), dtype=torch.float32, device=center.device)
+    mats = get_crop_matrices(center.float(), scale.float(), res)
+    shapes = [tuple(f.shape[:2]) for f in frames]
+    # Warp all frames of the same size together
+    for shape in set(shapes):
+        idxs = [i for i, s in enumerate(shapes) if s == shape]
+        imgs = torch.stack([frames[i] for i in idxs]).permute(0, 3, 1, 2).float() / 255.
+        crops[idxs] = warp_affine(imgs, mats[idxs], (res, res), mode='bilinear',
+                                  padding_mode='zeros', align_corners=True)
+    return crops
+
+
+def photometric_augment(images, prob=0.3):
+    """Cheap batched colour augmentation, each op is applied per sample with probability prob.
+    images: (B, 3, H, W) in [0, 1]"""
+    batch_size = images.shape[0]
+    device = images.device
+
+    def mask():
+        return (torch.rand(batch_size, 1, 1, 1, device=device) < prob).float()
+
+    # Brightness and contrast
+    brightness = (torch.rand(batch_size, 1, 1, 1, device=device) - 0.5) * 0.4
+    contrast = 1. + (torch.rand(batch_size, 1, 1, 1, device=device) - 0.5) * 0.4
+    mean = images.mean(dim=(1, 2, 3), keepdim=True)
+    m = mask()
+    images = m * ((images - mean) * contrast + mean + brightness) + (1 - m) * images
+    # Saturation
+    gray = (0.299 * images[:, 0:1] + 0.587 * images[:, 1:2] + 0.114 * images[:, 2:3])
+    saturation = 1. + (torch.rand(batch_size, 1, 1, 1, device=device) - 0.5) * 0.6
+    m = mask()
+    images = m * (gray + (images - gray) * saturation) + (1 - m) * images
+    # Gray scale
+    gray = (0.299 * images[:, 0:1] + 0.587 * images[:, 1:2] + 0.114 * images[:, 2:3])
+    m = mask()
+    images = m * gray.expand(-1, 3, -1, -1) + (1 - m) * images
+    # Gamma
+    gamma = 0.8 + torch.rand(batch_size, 1, 1, 1, device=device) * 1.2
+    m = mask()
+    images = images.clamp(0, 1)
+    images = m * images ** gamma + (1 - m) * images
+    # Multiplicative noise
+    noise = 1. + (torch.rand_like(images) - 0.5) * 0.2
+    m = mask()
+    images = m * images * noise + (1 - m) * images
+    return images.clamp(0, 1)
+
+
+class GPUCropAugment:
+
+    def __init__(self, options):
+        self.img_res = options.IMG_RES
+        self.augment = options.ALB
+        self.prob = options.ALB_PROB
+        self.mean = torch.tensor(constants.IMG_NORM_MEAN).reshape(1, 3, 1, 1)
+        self.std = torch.tensor(constants.IMG_NORM_STD).reshape(1, 3, 1, 1)
+
+    def __call__(self, batch, is_train=True):
+        frames = batch.pop(FRAME_KEY)
+        images = crop_frames(frames, batch['crop_center'], batch['crop_scale'], self.img_res)
+        if is_train and self.augment:
+            images = photometric_augment(images, self.prob)
+        images = (images - self.mean.to(images.device)) / self.std.to(images.device)
+        batch['img'] = images
+        return batch
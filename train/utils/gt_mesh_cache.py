@@ -0,0 +1,175 @@
+"""
+Precomputed ground truth meshes of the evaluation datasets.
+
+For 3DPW (SMPL) and RICH (SMPL-X, converted to SMPL topology) the GT vertices
+and SMPL joints of every sample are computed once and stored as .npy files
+that the evaluation datasets open with mmap_mode='r', instead of running the
+body models in the workers at every validation epoch. train/dataset/dataset.py
+and train/dataset/dataset_smpl.py read the GT shape differently, so every
+consumer has its own cache. The file names contain the consumer, the body
+model and a hash of the body model files, smplx2smpl and the label file, so a
+cache written for another dataset class, models or labels is not used.
+"""
+import os
+import hashlib
+import functools
+import torch
+import pickle
+import numpy as np
+from loguru import logger
+from smplx import SMPL, SMPLX
+
+from ..core import config
+from ..core.constants import NUM_JOINTS_SMPLX
+from ..core.config import DATASET_FILES
+
+GT_MESH_DATASETS = ['3dpw', 'rich']
+# Evaluation datasets reading the cache, the modules of train/dataset
+CONSUMERS = ['dataset', 'dataset_smpl']
+
+
+def has_gt_mesh(dataset):
+    return any(name in dataset for name in GT_MESH_DATASETS)
+
+
+def get_body_model_files():
+    files = []
+    for gender in ['MALE', 'FEMALE']:
+        files.append(os.path.join(config.SMPL_MODEL_DIR, f'SMPL_{gender}.pkl'))
+        files.append(os.path.join(config.SMPLX_MODEL_DIR, f'SMPLX_{gender}.npz'))
+    files.append(config.SMPLX2SMPL)
+    return files
+
+
+@functools.lru_cache()
+def hash_files(files):
+    h = hashlib.sha1()
+    for fn in files:
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def get_body_model_name(dataset):
+    # RICH is SMPL-X converted to the SMPL topology
+    return 'smplx2smpl' if 'rich' in dataset else 'smpl'
+
+
+def get_cache_paths(cache_dir, dataset, consumer):
+    assert consumer in CONSUMERS, f'Unknown GT mesh cache consumer {consumer}'
+    key = hash_files(tuple(get_body_model_files() + [DATASET_FILES[0][dataset]]))
+    prefix = os.path.join(cache_dir, f'{dataset}_{consumer}_{get_body_model_name(dataset)}_{key}')
+    return prefix + '.vertices.npy', prefix + '.joints.npy'
+
+
+def get_gt_params(data, consumer):
+    """GT pose and betas of the evaluation labels, the same as the evaluation dataset of consumer."""
+    if consumer == 'dataset':
+        return data['pose_cam'], data['shape']
+    pose = data['pose_cam'] if 'pose_cam' in data else data['pose']
+    # dataset_smpl.py uses the shape only if the labels have a 'betas' field and the mean shape otherwise
+    if 'betas' in data:
+        betas = data['shape']
+    else:
+        betas = np.zeros((len(pose), 10))
+    return pose, betas
+
+
+def get_gender(data):
+    # Same convention as the datasets: 1 is female, everything else uses the male model
+    if 'gender' not in data:
+        return -1 * np.ones(len(data['imgname']), dtype=np.int32)
+    return np.array([0 if g == 'm' else 1 for g in np.asarray(data['gender']).astype(str)], dtype=np.int32)
+
+
+@torch.no_grad()
+def write_gt_mesh_cache(cache_dir, dataset, consumer, batch_size=512, device='cpu'):
+    data = np.load(DATASET_FILES[0][dataset], allow_pickle=True)
+    pose, betas = get_gt_params(data, consumer)
+    gender = get_gender(data)
+    num_samples = len(pose)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    vertices_file, joints_file = get_cache_paths(cache_dir, dataset, consumer)
+    vertices = np.lib.format.open_memmap(vertices_file + '.tmp', mode='w+', dtype=np.float32,
+                                         shape=(num_samples, 6890, 3))
+    joints = np.lib.format.open_memmap(joints_file + '.tmp', mode='w+', dtype=np.float32,
+                                       shape=(num_samples, 24, 3))
+
+    smplx2smpl = None
+    if 'rich' in dataset:
+        smplx2smpl = pickle.load(open(config.SMPLX2SMPL, 'rb'))
+        smplx2smpl = torch.tensor(smplx2smpl['matrix'][None], dtype=torch.float32, device=device)
+
+    for gender_name, rows in [('male', np.flatnonzero(gender != 1)), ('female', np.flatnonzero(gender == 1))]:
+        if len(rows) == 0:
+            continue
+        smpl = SMPL(config.SMPL_MODEL_DIR, gender=gender_name, create_transl=False).to(device)
+        if 'rich' in dataset:
+            smplx = SMPLX(config.SMPLX_MODEL_DIR, gender=gender_name).to(device)
+        for start in range(0, len(rows), batch_size):
+            idx = rows[start:start + batch_size]
+            p = torch.from_numpy(pose[idx]).float().to(device)
+            b = torch.from_numpy(betas[idx]).float().to(device)
+            if 'rich' in dataset:
+                # The remaining parameters are the (zero) defaults of the model
+                defaults = {name: getattr(smplx, name).expand(len(idx), -1) for name in
+                            ['jaw_pose', 'leye_pose', 'reye_pose', 'left_hand_pose', 'right_hand_pose', 'expression']}
+                out = smplx(global_orient=p[:, :3], body_pose=p[:, 3:NUM_JOINTS_SMPLX * 3], betas=b, **defaults)
+                verts = torch.matmul(smplx2smpl, out.vertices)
+            else:
+                out = smpl(global_orient=p[:, :3], body_pose=p[:, 3:], betas=b)
+                verts = out.vertices
+            vertices[idx] = verts.cpu().numpy()
+            joints[idx] = torch.matmul(smpl.J_regressor, verts).cpu().numpy()
+
+    vertices.flush()
+    joints.flush()
+    del vertices, joints
+    # Only visible to the datasets once complete
+    os.replace(vertices_file + '.tmp', vertices_file)
+    os.replace(joints_file + '.tmp', joints_file)
+    logger.info(f'Saved GT meshes of {num_samples} samples of {dataset} for {consumer} to {vertices_file}')
+    return vertices_file, joints_file
+
+
+class GTMeshCache:
+    """Lazily memory-mapped GT vertices (N, 6890, 3) and joints (N, 24, 3) of a dataset."""
+    def __init__(self, cache_dir, dataset, consumer):
+        self.vertices_file, self.joints_file = get_cache_paths(cache_dir, dataset, consumer)
+        self._arrays = {}
+
+    def exists(self):
+        return os.path.exists(self.vertices_file) and os.path.exists(self.joints_file)
+
+    def _load(self, key, fn):
+        if key not in self._arrays:
+            self._arrays[key] = np.load(fn, mmap_mode='r')
+        return self._arrays[key]
+
+    @property
+    def vertices(self):
+        return self._load('vertices', self.vertices_file)
+
+    @property
+    def joints(self):
+        return self._load('joints', self.joints_file)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+
+def load_gt_mesh_cache(cache_dir, dataset, consumer):
+    """GTMeshCache of the dataset for consumer, None if it was not precomputed for the current files."""
+    try:
+        cache = GTMeshCache(cache_dir, dataset, consumer)
+    except FileNotFoundError as E:
+        logger.warning(f'Can not look up the GT mesh cache of {dataset}: {E}')
+        return None
+    if not cache.exists():
+        logger.warning(f'No GT mesh cache for {dataset} and {consumer} in {cache_dir}, run make_gt_mesh_cache.py')
+        return None
+    return cache
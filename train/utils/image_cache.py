@@ -0,0 +1,243 @@
+"""
+Decoded image cache shared by all DataLoader workers.
+
+Images are stored in fixed-size slots of a single shared memory block, the
+slot table (key, LRU tick, version, shape), a hash index from key to slot and
+the hit/miss/eviction counters live in a second one. Both are created by the
+main process and attached by the workers, so a frame decoded by one worker is
+served from memory to all of them, also across epochs and validation runs.
+Least recently used slots are evicted once the byte budget is full. Keys are
+the image paths.
+
+The lock only guards the slot table and the index, the pixels are copied
+outside of it. Every slot has a version which is odd while the slot is being
+written (a seqlock), a reader keeps its copy only if the version did not change
+while it was copying.
+"""
+import os
+import atexit
+import hashlib
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+from loguru import logger
+
+# Counter indices
+HITS, MISSES, EVICTIONS, INSERTS, CLOCK, FILLED = range(6)
+COUNTERS = ['hits', 'misses', 'evictions', 'inserts']
+NUM_COUNTERS = 6
+
+_image_cache = None
+
+
+def _key(img_fn):
+    # Stable across processes, unlike hash(); 0 marks an empty slot
+    key = int.from_bytes(hashlib.blake2b(img_fn.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+    return max(key, 1)
+
+
+class SharedImageCache:
+    '''
+    budget_bytes: total size of the image slots
+    slot_bytes: size of one slot, larger images are not cached
+    '''
+    def __init__(self, budget_bytes, slot_bytes=1920 * 1080 * 3):
+        self.slot_bytes = int(slot_bytes)
+        self.num_slots = int(budget_bytes // slot_bytes)
+        assert self.num_slots > 0, 'Image cache budget is smaller than one slot'
+        # Open addressing index of at most half load, a power of two
+        self.index_size = 1 << int(np.ceil(np.log2(2 * self.num_slots)))
+        self.owner = True
+        self.pid = os.getpid()
+        self.lock = mp.Lock()
+        self.data_shm = shared_memory.SharedMemory(create=True, size=self.num_slots * self.slot_bytes)
+        self.meta_shm = shared_memory.SharedMemory(create=True, size=self._meta_size())
+        self._map()
+        self.keys[:] = 0
+        self.ticks[:] = 0
+        self.versions[:] = 0
+        self.index_keys[:] = 0
+        self.counters[:] = 0
+        atexit.register(self.close)
+        logger.info(f'Created shared image cache with {self.num_slots} slots '
+                    f'of {self.slot_bytes / 2 ** 20:.2f} MB')
+
+    def _meta_size(self):
+        # keys, ticks, versions, shapes (3 x int64), index keys and slots, counters
+        return 8 * (6 * self.num_slots + 2 * self.index_size + NUM_COUNTERS)
+
+    def _map(self):
+        meta = np.ndarray((self._meta_size() // 8,), dtype=np.int64, buffer=self.meta_shm.buf)
+        n, m = self.num_slots, self.index_size
+        self.keys = meta[:n]
+        self.ticks = meta[n:2 * n]
+        self.versions = meta[2 * n:3 * n]
+        self.shapes = meta[3 * n:6 * n].reshape(n, 3)
+        self.index_keys = meta[6 * n:6 * n + m]
+        self.index_slots = meta[6 * n + m:6 * n + 2 * m]
+        self.counters = meta[6 * n + 2 * m:]
+        self.data = np.ndarray((self.num_slots, self.slot_bytes), dtype=np.uint8, buffer=self.data_shm.buf)
+
+    def __getstate__(self):
+        # Workers started with spawn attach to the existing blocks by name
+        state = self.__dict__.copy()
+        for k in ['data_shm', 'meta_shm', 'keys', 'ticks', 'versions', 'shapes', 'index_keys', 'index_slots',
+                  'counters', 'data']:
+            state.pop(k)
+        state['owner'] = False
+        state['data_name'] = self.data_shm.name
+        state['meta_name'] = self.meta_shm.name
+        return state
+
+    def __setstate__(self, state):
+        data_name = state.pop('data_name')
+        meta_name = state.pop('meta_name')
+        self.__dict__.update(state)
+        self.data_shm = shared_memory.SharedMemory(name=data_name)
+        self.meta_shm = shared_memory.SharedMemory(name=meta_name)
+        # Only the main process may unlink the blocks
+        resource_tracker.unregister(self.data_shm._name, 'shared_memory')
+        resource_tracker.unregister(self.meta_shm._name, 'shared_memory')
+        self._map()
+
+    def _tick(self):
+        self.counters[CLOCK] += 1
+        return self.counters[CLOCK]
+
+    # Index from key to slot, linear probing. Only called with the lock held.
+
+    def _find(self, key):
+        """Position of key in the index, -1 if it is not cached."""
+        mask = self.index_size - 1
+        pos = key & mask
+        while self.index_keys[pos] != 0:
+            if self.index_keys[pos] == key:
+                return pos
+            pos = (pos + 1) & mask
+        return -1
+
+    def _insert(self, key, slot):
+        mask = self.index_size - 1
+        pos = key & mask
+        while self.index_keys[pos] != 0:
+            pos = (pos + 1) & mask
+        self.index_keys[pos] = key
+        self.index_slots[pos] = slot
+
+    def _remove(self, pos):
+        # Backward shift deletion, keeps every remaining key reachable from its home position
+        mask = self.index_size - 1
+        nxt = pos
+        while True:
+            nxt = (nxt + 1) & mask
+            key = self.index_keys[nxt]
+            if key == 0:
+                break
+            home = key & mask
+            # The entry at nxt may move to pos unless its home lies cyclically in (pos, nxt]
+            if (pos < nxt and pos < home <= nxt) or (pos > nxt and (home > pos or home <= nxt)):
+                continue
+            self.index_keys[pos] = key
+            self.index_slots[pos] = self.index_slots[nxt]
+            pos = nxt
+        self.index_keys[pos] = 0
+
+    def get(self, img_fn):
+        """Copy of the cached image, None on a miss."""
+        key = _key(img_fn)
+        with self.lock:
+            pos = self._find(key)
+            if pos < 0:
+                self.counters[MISSES] += 1
+                return None
+            slot = self.index_slots[pos]
+            self.ticks[slot] = self._tick()
+            self.counters[HITS] += 1
+            version = self.versions[slot]
+            shape = tuple(self.shapes[slot])
+        img = self.data[slot, :int(np.prod(shape))].reshape(shape).copy()
+        if self.versions[slot] != version:
+            # Evicted and overwritten while copying
+            with self.lock:
+                self.counters[HITS] -= 1
+                self.counters[MISSES] += 1
+            return None
+        return img
+
+    def put(self, img_fn, img):
+        if img.dtype != np.uint8 or img.ndim != 3 or img.nbytes > self.slot_bytes:
+            return
+        key = _key(img_fn)
+        with self.lock:
+            if self._find(key) >= 0:
+                # Inserted by another worker in the meantime
+                return
+            if self.counters[FILLED] < self.num_slots:
+                slot = self.counters[FILLED]
+                self.counters[FILLED] += 1
+            else:
+                # Least recently used slot which is not being written
+                slot = np.argmin(np.where(self.versions % 2 == 1, np.iinfo(np.int64).max, self.ticks))
+                if self.versions[slot] % 2 == 1:
+                    return
+                if self.keys[slot] != 0:
+                    self._remove(self._find(self.keys[slot]))
+                    self.counters[EVICTIONS] += 1
+            self.keys[slot] = 0
+            self.versions[slot] += 1
+            self.ticks[slot] = self._tick()
+        self.data[slot, :img.nbytes] = img.reshape(-1)
+        with self.lock:
+            # Slots being written are not taken by other writers, the version is still odd
+            self.versions[slot] += 1
+            if self._find(key) >= 0:
+                # Another worker wrote the same image meanwhile, the slot is the next one to reuse
+                self.ticks[slot] = 0
+                return
+            self.shapes[slot] = img.shape
+            self.keys[slot] = key
+            self._insert(key, slot)
+            self.counters[INSERTS] += 1
+
+    def stats(self):
+        stats = {k: int(self.counters[i]) for i, k in enumerate(COUNTERS)}
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.
+        stats['used_bytes'] = int(self.shapes[self.keys != 0].prod(axis=-1).sum())
+        return stats
+
+    def close(self):
+        if self.data is None:
+            return
+        # Views have to be released before the blocks can be closed
+        self.keys = self.ticks = self.versions = self.shapes = None
+        self.index_keys = self.index_slots = self.counters = self.data = None
+        self.data_shm.close()
+        self.meta_shm.close()
+        if self.owner and os.getpid() == self.pid:
+            self.data_shm.unlink()
+            self.meta_shm.unlink()
+            self.owner = False
+
+
+def get_slot_bytes(options):
+    """Slot size of IMAGE_CACHE_SLOT_MB, or of an RGB frame of IMAGE_CACHE_RES (width, height) if it is 0."""
+    if options.IMAGE_CACHE_SLOT_MB > 0:
+        return int(options.IMAGE_CACHE_SLOT_MB * 2 ** 20)
+    width, height = options.IMAGE_CACHE_RES
+    return int(width * height * 3)
+
+
+def get_image_cache(options):
+    """
+    Cache shared by all datasets of the process, None if DATASET.IMAGE_CACHE_GB is 0.
+    Has to be called first in the main process, before the workers are started.
+    """
+    global _image_cache
+    if options.IMAGE_CACHE_GB <= 0:
+        return None
+    if _image_cache is None:
+        _image_cache = SharedImageCache(budget_bytes=options.IMAGE_CACHE_GB * 2 ** 30,
+                                        slot_bytes=get_slot_bytes(options))
+    return _image_cache
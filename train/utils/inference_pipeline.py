@@ -0,0 +1,252 @@
+"""
+Staged inference for the demo testers.
+
+    reader threads -> crop workers -> model (calling thread) -> writer threads
+
+Image decoding, cropping and the writing/rendering of the results run in
+thread pools while the calling thread runs the forward passes through a
+CropBatcher. The stages are connected by bounded queues, a full queue blocks
+the stage feeding it so at most queue_size images are decoded ahead of the
+model and at most queue_size images wait for their writer. The results are
+handed to the writers in the order of the inputs.
+
+The time spent in every stage and the depth of the queues are logged at the
+end of run() and returned by summary(). A read queue which is always empty
+and a long model wait mean more readers or crop workers are needed, a full
+write queue means more writers are needed.
+"""
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import tqdm
+import numpy as np
+import torch
+from loguru import logger
+
+STAGES = ['read', 'crop', 'model_wait', 'model', 'write']
+QUEUES = ['read', 'crop', 'write']
+
+# Marks the end of the inputs in the queues
+_DONE = object()
+
+
+class PipelineStats:
+    """Run time of every stage and depth of every queue, updated from several threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {k: [] for k in STAGES}
+        self.depths = {k: [] for k in QUEUES}
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage].append(seconds)
+
+    def add_depth(self, name, depth):
+        with self.lock:
+            self.depths[name].append(depth)
+
+    def summary(self):
+        out = {}
+        with self.lock:
+            for stage, seconds in self.seconds.items():
+                seconds = np.array(seconds)
+                out[stage] = {
+                    'calls': len(seconds),
+                    'total_s': float(seconds.sum()),
+                    'mean_ms': 1000 * float(seconds.mean()) if len(seconds) else 0.,
+                    'max_ms': 1000 * float(seconds.max()) if len(seconds) else 0.,
+                }
+            for name, depths in self.depths.items():
+                out[f'{name}_queue'] = {
+                    'mean_depth': float(np.mean(depths)) if len(depths) else 0.,
+                    'max_depth': int(np.max(depths)) if len(depths) else 0,
+                }
+        return out
+
+
+class InferencePipeline:
+    '''
+    batcher: CropBatcher running the model
+    num_readers: threads decoding the images
+    num_crop_workers: threads cropping and normalizing the detections
+    num_writers: threads writing the results, e.g. rendering and cv2.imwrite
+    queue_size: capacity of every queue, in images
+    writer_cleanup: called once in every writer thread before the writers stop, e.g.
+        renderer_pyrd.delete_renderers to free the GL contexts of the thread
+    '''
+    def __init__(self, batcher, num_readers=4, num_crop_workers=2, num_writers=2, queue_size=16,
+                 writer_cleanup=None):
+        self.batcher = batcher
+        self.num_readers = num_readers
+        self.num_crop_workers = num_crop_workers
+        self.num_writers = num_writers
+        self.queue_size = queue_size
+        self.writer_cleanup = writer_cleanup
+        self.stats = PipelineStats()
+
+    def _timed(self, stage, grad_enabled, fn, *args):
+        # Grad mode is thread local, the workers use the one of the caller of run()
+        start = time.perf_counter()
+        with torch.set_grad_enabled(grad_enabled):
+            out = fn(*args)
+        self.stats.add_time(stage, time.perf_counter() - start)
+        return out
+
+    def _crop_task(self, grad_enabled, crop, item, read_future):
+        data = read_future.result()
+        return data, self._timed('crop', grad_enabled, crop, item, data)
+
+    @staticmethod
+    def _put(q, value, stop):
+        # Blocks while the queue is full, gives up when the pipeline is stopped
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _cancel_queued(read_queue, crop_queue, write_queue):
+        # Drops the work left in the queues after an error, running tasks finish.
+        # ThreadPoolExecutor.shutdown(cancel_futures=True) needs python 3.9
+        for q in [read_queue, crop_queue]:
+            while True:
+                try:
+                    entry = q.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is not _DONE:
+                    entry[-1].cancel()
+        while len(write_queue) > 0:
+            write_queue.popleft().cancel()
+
+    @staticmethod
+    def _run_on_every_thread(pool, num_threads, fn):
+        # One task per thread of the pool: the tasks only start once all of them hold a thread
+        barrier = threading.Barrier(num_threads)
+
+        def task():
+            barrier.wait()
+            fn()
+
+        for future in [pool.submit(task) for _ in range(num_threads)]:
+            try:
+                future.result()
+            except Exception as E:
+                logger.warning(f'pipeline writer cleanup failed: {E!r}')
+
+    def run(self, items, read, crop, write):
+        """
+        items: list or iterable of (key, item), the key is passed to write. An iterable,
+            e.g. the frames of a video, is consumed in a feeder thread under the grad mode of the caller
+        read(item): returns the data of the item, e.g. the decoded image, in a reader thread
+        crop(item, data): returns (crops, bbox_center, bbox_scale, img_w, img_h) of the item, in a crop worker
+        write(key, data, outputs): in a writer thread, outputs are the model outputs of the crops of the item
+        Returns the return values of write in the order of items.
+        """
+        self.stats = PipelineStats()
+        grad_enabled = torch.is_grad_enabled()
+        stop = threading.Event()
+        read_queue = queue.Queue(self.queue_size)
+        crop_queue = queue.Queue(self.queue_size)
+        write_queue = deque()
+        results = []
+
+        read_pool = ThreadPoolExecutor(self.num_readers, thread_name_prefix='pipeline-read')
+        crop_pool = ThreadPoolExecutor(self.num_crop_workers, thread_name_prefix='pipeline-crop')
+        write_pool = ThreadPoolExecutor(self.num_writers, thread_name_prefix='pipeline-write')
+
+        def feed_reads():
+            try:
+                # Grad mode of the caller for the iterable, e.g. a detector
+                torch.set_grad_enabled(grad_enabled)
+                for key, item in items:
+                    future = read_pool.submit(self._timed, 'read', grad_enabled, read, item)
+                    if not self._put(read_queue, (key, item, future), stop):
+                        return
+            except Exception as E:
+                # Errors of a generator of items are raised by the model stage
+                future = Future()
+                future.set_exception(E)
+                self._put(read_queue, (None, None, future), stop)
+            self._put(read_queue, _DONE, stop)
+
+        def feed_crops():
+            while not stop.is_set():
+                try:
+                    entry = read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if entry is _DONE:
+                    self._put(crop_queue, _DONE, stop)
+                    return
+                key, item, read_future = entry
+                # The crop worker waits for the image, the images stay in input order
+                future = crop_pool.submit(self._crop_task, grad_enabled, crop, item, read_future)
+                if not self._put(crop_queue, (key, future), stop):
+                    return
+
+        def submit_writes(completed):
+            for key, data, outputs in completed:
+                write_queue.append(write_pool.submit(self._timed, 'write', grad_enabled, write, key, data, outputs))
+                self.stats.add_depth('write', len(write_queue))
+                while len(write_queue) > self.queue_size:
+                    results.append(write_queue.popleft().result())
+
+        feeders = [threading.Thread(target=feed_reads, daemon=True), threading.Thread(target=feed_crops, daemon=True)]
+        for feeder in feeders:
+            feeder.start()
+        progress = tqdm.tqdm(total=len(items) if hasattr(items, '__len__') else None)
+        try:
+            while True:
+                start = time.perf_counter()
+                entry = crop_queue.get()
+                if entry is _DONE:
+                    break
+                key, future = entry
+                data, (crops, bbox_center, bbox_scale, img_w, img_h) = future.result()
+                self.stats.add_time('model_wait', time.perf_counter() - start)
+                self.stats.add_depth('read', read_queue.qsize())
+                self.stats.add_depth('crop', crop_queue.qsize())
+
+                start = time.perf_counter()
+                completed = self.batcher.add(key, crops, bbox_center, bbox_scale, img_w, img_h, data=data)
+                self.stats.add_time('model', time.perf_counter() - start)
+                submit_writes(completed)
+                progress.update(1)
+
+            start = time.perf_counter()
+            completed = self.batcher.flush()
+            self.stats.add_time('model', time.perf_counter() - start)
+            submit_writes(completed)
+            while len(write_queue) > 0:
+                results.append(write_queue.popleft().result())
+        finally:
+            progress.close()
+            stop.set()
+            self._cancel_queued(read_queue, crop_queue, write_queue)
+            if self.writer_cleanup is not None:
+                self._run_on_every_thread(write_pool, self.num_writers, self.writer_cleanup)
+            for pool in [read_pool, crop_pool, write_pool]:
+                pool.shutdown(wait=True)
+        self.log_summary()
+        return results
+
+    def summary(self):
+        return self.stats.summary()
+
+    def log_summary(self):
+        summary = self.summary()
+        for stage in STAGES:
+            s = summary[stage]
+            logger.info(f'pipeline {stage}: {s["calls"]} calls, {s["total_s"]:.2f}s total, '
+                        f'{s["mean_ms"]:.1f}ms mean, {s["max_ms"]:.1f}ms max')
+        for name in QUEUES:
+            s = summary[f'{name}_queue']
+            logger.info(f'pipeline {name} queue: {s["mean_depth"]:.1f} mean depth, '
+                        f'{s["max_depth"]} max depth of {self.queue_size}')
@@ -0,0 +1,112 @@
+"""
+Columnar label store.
+
+A scene npz is converted into a folder with one uncompressed .npy per field
+and a manifest.json. Fields are opened with mmap_mode='r', so every DataLoader
+worker shares the same page cache instead of holding its own unpickled copy.
+String fields (imgname, gender, ...) are stored as fixed-width utf-8 bytes.
+"""
+import os
+import json
+import numpy as np
+from loguru import logger
+
+MANIFEST = 'manifest.json'
+
+
+def _to_columnar(arr):
+    """Convert a field to a plain (non-object) array, None if not possible."""
+    if arr.dtype.kind == 'U':
+        return np.char.encode(arr, 'utf-8'), 'utf-8'
+    if arr.dtype.kind == 'O':
+        # Only object arrays of strings, ragged or nested fields would be stored as their repr
+        flat = arr.ravel()
+        if not all(isinstance(x, (str, bytes)) for x in flat):
+            return None, None
+        encoded = [x.encode('utf-8') if isinstance(x, str) else x for x in flat]
+        return np.array(encoded, dtype=bytes).reshape(arr.shape), 'utf-8'
+    return arr, None
+
+
+def convert_npz_to_label_store(npz_file, out_dir, fields=None):
+    '''
+    npz_file: scene npz, as written by data_processing/df_full_body.py
+    out_dir: folder for the label store of this scene
+    fields: subset of fields to convert, all fields by default
+    '''
+    data = np.load(npz_file, allow_pickle=True)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {'source': os.path.abspath(npz_file), 'fields': {}}
+
+    for key in data.files:
+        if fields is not None and key not in fields:
+            continue
+        arr, encoding = _to_columnar(data[key])
+        if arr is None:
+            logger.warning(f'Field {key} of {npz_file} can not be stored as a fixed-width array, skipping')
+            continue
+        np.save(os.path.join(out_dir, key + '.npy'), np.ascontiguousarray(arr))
+        manifest['fields'][key] = {
+            'dtype': arr.dtype.str,
+            'shape': list(arr.shape),
+            'encoding': encoding,
+        }
+
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logger.info(f'Saved label store of {npz_file} to {out_dir}')
+    return out_dir
+
+
+class LabelStore:
+    """
+    Read-only, npz-like access to a label store: supports `key in store`,
+    `store[key]` and `store.files`. Arrays are memory-mapped on first access.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        self.files = list(self.manifest['fields'].keys())
+        self._arrays = {}
+
+    def __contains__(self, key):
+        return key in self.manifest['fields']
+
+    def __getitem__(self, key):
+        if key not in self.manifest['fields']:
+            raise KeyError(f'{key} is not a field of {self.store_dir}')
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.store_dir, key + '.npy'), mmap_mode='r')
+        return self._arrays[key]
+
+    def __getstate__(self):
+        # Workers map the files themselves instead of receiving copies
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+
+def get_label_store_dir(store_root, dataset, is_train):
+    split = 'train' if is_train else 'val'
+    return os.path.join(store_root, split, dataset)
+
+
+def load_labels(label_file, store_root='', dataset=None, is_train=True):
+    """
+    Open the label store of a dataset if one exists under store_root,
+    otherwise fall back to loading the npz.
+    """
+    if store_root:
+        store_dir = get_label_store_dir(store_root, dataset, is_train)
+        if os.path.exists(os.path.join(store_dir, MANIFEST)):
+            return LabelStore(store_dir)
+        logger.warning(f'No label store for {dataset} in {store_root}, loading {label_file}')
+    return np.load(label_file, allow_pickle=True)
+
+
+def decode_str(value):
+    """imgname/gender entries of a label store are bytes."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
@@ -0,0 +1,63 @@
+"""
+Streaming validation metrics.
+
+MetricAccumulator keeps, per validation dataset, the running sum of every
+metric and the number of samples on the device of the model. validation_step
+only adds the errors of its batch, validation_epoch_end all-reduces the sums
+and counts over the ranks and reports the means.
+"""
+import torch
+import torch.distributed as dist
+
+
+class MetricAccumulator:
+    '''
+    datasets: names of the validation datasets, in the order of batch['dataset_index']
+    metrics: names of the per-sample metrics
+    keep_samples: also keep the per-sample values (on the CPU, not synced over the ranks)
+    device: device of the sums, the one of the model so that they can be all-reduced
+    '''
+    def __init__(self, datasets, metrics, keep_samples=False, device='cpu'):
+        self.datasets = list(datasets)
+        self.metrics = list(metrics)
+        self.keep_samples = keep_samples
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        # Allocated upfront, a rank without validation samples still takes part in the all-reduce
+        self.sums = torch.zeros((len(self.datasets), len(self.metrics)), dtype=torch.float64, device=self.device)
+        self.counts = torch.zeros(len(self.datasets), dtype=torch.float64, device=self.device)
+        self.samples = []
+
+    def update(self, dataset_index, **values):
+        """
+        dataset_index: (B,) index into datasets of every sample
+        values: metric name -> (B,) per-sample value
+        """
+        values = torch.stack([values[m].detach().reshape(-1) for m in self.metrics], dim=-1)
+        values = values.to(self.sums.device, torch.float64)
+        dataset_index = dataset_index.to(self.sums.device).long()
+        self.sums.index_add_(0, dataset_index, values)
+        self.counts.index_add_(0, dataset_index, torch.ones_like(dataset_index, dtype=torch.float64))
+        if self.keep_samples:
+            self.samples.append((dataset_index.cpu(), values.cpu()))
+
+    def compute(self, sync=True):
+        """Mean of every metric per dataset, {dataset: {metric: value}}. NaN for datasets without samples."""
+        sums, counts = self.sums.clone(), self.counts.clone()
+        if sync and dist.is_available() and dist.is_initialized():
+            dist.all_reduce(sums, op=dist.ReduceOp.SUM)
+            dist.all_reduce(counts, op=dist.ReduceOp.SUM)
+        # 0 / 0 is NaN for the datasets without samples
+        means = (sums / counts[:, None]).cpu().tolist()
+        return {ds: dict(zip(self.metrics, means[i])) for i, ds in enumerate(self.datasets)}
+
+    def get_samples(self, dataset):
+        """Per-sample values of one dataset seen by this rank, {metric: (N,) tensor}."""
+        ds_idx = self.datasets.index(dataset)
+        if len(self.samples) == 0:
+            return {m: torch.zeros(0, dtype=torch.float64) for m in self.metrics}
+        dataset_index = torch.cat([s[0] for s in self.samples])
+        values = torch.cat([s[1] for s in self.samples])[dataset_index == ds_idx]
+        return {m: values[:, i] for i, m in enumerate(self.metrics)}
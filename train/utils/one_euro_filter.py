@@ -44,3 +44,58 @@ class OneEuroFilter:
         self.t_prev = t
 
         return x_hat
+
+
+class MultiOneEuroFilter:
+    """
+    One euro filter of many tracks, e.g. the rotation matrices of all joints
+    of all people in a video. The state of every track is kept in arrays and
+    every frame is filtered for all tracks and joints at once. A call takes
+    a whole sequence or the next chunk of a stream.
+    """
+    def __init__(self, num_tracks, signal_shape, min_cutoff=1.0, beta=0.0,
+                 d_cutoff=1.0, dtype=np.float32):
+        self.min_cutoff = float(min_cutoff)
+        self.beta = float(beta)
+        self.d_cutoff = float(d_cutoff)
+        self.x_prev = np.zeros((num_tracks, *signal_shape), dtype=dtype)
+        self.dx_prev = np.zeros_like(self.x_prev)
+        self.t_prev = np.zeros(num_tracks, dtype=dtype)
+        # A track starts at its first valid frame
+        self.started = np.zeros(num_tracks, dtype=bool)
+
+    def __call__(self, t, x, valid=None):
+        """
+        t: (T,) time of the frames
+        x: (T, num_tracks, *signal_shape) signal
+        valid: (T, num_tracks) tracks present in every frame, the other ones keep their state
+        Returns the filtered signal, the first frame of a track and the missing frames are returned unchanged.
+        """
+        x = np.asarray(x, dtype=self.x_prev.dtype)
+        t = np.asarray(t, dtype=self.t_prev.dtype)
+        if valid is None:
+            valid = np.ones(x.shape[:2], dtype=bool)
+        x_hat = x.copy()
+        signal_dims = (1,) * (x.ndim - 2)
+        for i in range(len(x)):
+            new = valid[i] & ~self.started
+            idx = np.nonzero(valid[i] & self.started)[0]
+            if len(idx) > 0:
+                t_e = (t[i] - self.t_prev[idx]).reshape(-1, *signal_dims)
+
+                # The filtered derivative of the signal.
+                a_d = smoothing_factor(t_e, self.d_cutoff)
+                dx = (x[i, idx] - self.x_prev[idx]) / t_e
+                dx_hat = exponential_smoothing(a_d, dx, self.dx_prev[idx])
+
+                # The filtered signal.
+                cutoff = self.min_cutoff + self.beta * np.abs(dx_hat)
+                a = smoothing_factor(t_e, cutoff)
+                x_hat[i, idx] = exponential_smoothing(a, x[i, idx], self.x_prev[idx])
+
+                self.dx_prev[idx] = dx_hat
+            self.dx_prev[new] = 0.
+            self.started |= new
+            self.x_prev[valid[i]] = x_hat[i, valid[i]]
+            self.t_prev[valid[i]] = t[i]
+        return x_hat
@@ -0,0 +1,136 @@
+"""
+Compact prediction files for the AGORA/BEDLAM leaderboards.
+
+Instead of one pickle per detected person, PredictionWriter appends the
+predictions into preallocated chunks of chunk_size people which are saved as
+.npz files by a background thread while inference continues. Every chunk has
+the arrays imgname, personId, verts, allSmplJoints3d and joints, the compact
+format accepted by check_pred_file_format.py --predFile, and index.npz maps
+every (imgname, personId) to its chunk and row. export_legacy_zip writes the
+per-person pickle layout of the submission zip from the chunks.
+"""
+import os
+import pickle
+import zipfile
+import threading
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from loguru import logger
+
+
+class PredictionWriter:
+    '''
+    output_folder: folder of the chunk files
+    chunk_size: number of people per chunk, about 125 KB each in float32
+    dtype: float32 or float16, dtype of the stored vertices and joints. float16 has a
+        resolution of 4 mm at 4-8 m and 8 mm at 8-16 m, the camera distances of AGORA
+    max_pending: chunks which may wait for the writer thread, add() blocks beyond
+    '''
+    def __init__(self, output_folder, chunk_size=512, dtype='float32', max_pending=1):
+        assert dtype in ['float32', 'float16'], f'Unsupported prediction dtype {dtype}'
+        assert max_pending >= 1, f'max_pending must be at least 1, not {max_pending}'
+        self.output_folder = output_folder
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+        self.max_pending = max_pending
+        os.makedirs(output_folder, exist_ok=True)
+
+        # add() may be called from several writer threads of the inference pipeline
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+        self.chunk = None
+        self.filled = 0
+        self.index = {'imgname': [], 'personId': [], 'chunk': [], 'row': []}
+
+    def _new_chunk(self, num_joints3d, num_joints2d):
+        n = self.chunk_size
+        return {
+            'imgname': np.empty(n, dtype=object),
+            'personId': np.zeros(n, dtype=np.int32),
+            'verts': np.zeros((n, 10475, 3), dtype=self.dtype),
+            'allSmplJoints3d': np.zeros((n, num_joints3d, 3), dtype=self.dtype),
+            'joints': np.zeros((n, num_joints2d, 2), dtype=self.dtype),
+        }
+
+    def add(self, imgname, verts, joints3d, joints2d):
+        """
+        Predictions of all the people of one image, their personId is their index.
+        :param verts: (P, 10475, 3) vertices
+        :param joints3d: (P, J, 3) 3d joints
+        :param joints2d: (P, 24, 2) projected joints
+        """
+        with self.lock:
+            for person_id in range(len(verts)):
+                if self.chunk is None:
+                    self.chunk = self._new_chunk(joints3d.shape[1], joints2d.shape[1])
+                row = self.filled
+                self.chunk['imgname'][row] = imgname
+                self.chunk['personId'][row] = person_id
+                self.chunk['verts'][row] = verts[person_id]
+                self.chunk['allSmplJoints3d'][row] = joints3d[person_id]
+                self.chunk['joints'][row] = joints2d[person_id]
+                for k, v in zip(['imgname', 'personId', 'chunk', 'row'], [imgname, person_id, len(self.futures), row]):
+                    self.index[k].append(v)
+                self.filled += 1
+                if self.filled == self.chunk_size:
+                    self.flush()
+
+    def flush(self):
+        if self.chunk is None or self.filled == 0:
+            return
+        chunk = {k: v[:self.filled] for k, v in self.chunk.items()}
+        chunk['imgname'] = chunk['imgname'].astype(str)
+        chunk_file = os.path.join(self.output_folder, f'predictions_{len(self.futures):05d}.npz')
+        if len(self.futures) >= self.max_pending:
+            # At most max_pending chunks in memory besides the one being filled
+            self.futures[-self.max_pending].result()
+        # The writer thread owns the arrays from now on
+        self.futures.append(self.executor.submit(np.savez, chunk_file, **chunk))
+        self.chunk = None
+        self.filled = 0
+
+    def close(self):
+        self.flush()
+        for future in self.futures:
+            # Raises the errors of the writer thread
+            future.result()
+        self.executor.shutdown()
+        index = {k: np.array(v) for k, v in self.index.items()}
+        index['imgname'] = index['imgname'].astype(str)
+        np.savez(os.path.join(self.output_folder, 'index.npz'), **index)
+        logger.info(f'Saved {len(index["row"])} predictions in {len(self.futures)} chunks to {self.output_folder}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_chunk_files(pred_folder):
+    return sorted(glob(os.path.join(pred_folder, 'predictions_*.npz')))
+
+
+def export_legacy_zip(pred_folder, zip_path, compression=zipfile.ZIP_STORED):
+    """
+    Writes the chunks of pred_folder as predictions/<imgname>_personId_<id>.pkl
+    files into zip_path, the layout expected by the leaderboards.
+    """
+    num_files = 0
+    with zipfile.ZipFile(zip_path, 'w', compression=compression) as zf:
+        for chunk_file in get_chunk_files(pred_folder):
+            with np.load(chunk_file) as chunk:
+                chunk = {k: chunk[k] for k in chunk.files}
+            for row, (imgname, person_id) in enumerate(zip(chunk['imgname'], chunk['personId'])):
+                out_dict = {
+                    'verts': chunk['verts'][row].astype(np.float32),
+                    'joints': chunk['joints'][row].astype(np.float32),
+                    'allSmplJoints3d': chunk['allSmplJoints3d'][row].astype(np.float32),
+                }
+                zf.writestr(f'predictions/{imgname}_personId_{person_id}.pkl', pickle.dumps(out_dict))
+                num_files += 1
+    logger.info(f'Exported {num_files} predictions from {pred_folder} to {zip_path}')
+    return num_files
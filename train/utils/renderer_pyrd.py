@@ -4,11 +4,16 @@ import trimesh
 import pyrender
 import numpy as np
 import colorsys
+import threading
+from collections import OrderedDict
 import cv2
 
 
 class Renderer(object):
-
+    """
+    The scene, camera and lights are created once, render_front_view only
+    replaces the meshes. Use get_renderer to reuse renderers across images.
+    """
     def __init__(self, focal_length=600, img_w=512, img_h=512, faces=None,
                  same_mesh_color=False):
         os.environ['PYOPENGL_PLATFORM'] = 'egl'
@@ -19,14 +24,16 @@ class Renderer(object):
         self.focal_length = focal_length
         self.faces = faces
         self.same_mesh_color = same_mesh_color
+        self.scene = None
+        self.mesh_nodes = []
+        self.materials = {}
 
-    def render_front_view(self, verts, bg_img_rgb=None, bg_color=(0, 0, 0, 0)):
-        # Create a scene for each image and render all meshes
-        scene = pyrender.Scene(bg_color=bg_color, ambient_light=np.ones(3) * 0)
+    def _build_scene(self):
+        scene = pyrender.Scene(ambient_light=np.ones(3) * 0)
         # Create camera. Camera will always be at [0,0,0]
-        camera = pyrender.camera.IntrinsicsCamera(fx=self.focal_length, fy=self.focal_length,
-                                                  cx=self.camera_center[0], cy=self.camera_center[1])
-        scene.add(camera, pose=np.eye(4))
+        self.camera = pyrender.camera.IntrinsicsCamera(fx=self.focal_length, fy=self.focal_length,
+                                                       cx=self.camera_center[0], cy=self.camera_center[1])
+        scene.add(self.camera, pose=np.eye(4))
 
         # Create light source
         light = pyrender.DirectionalLight(color=[1.0, 1.0, 1.0], intensity=3.0)
@@ -35,6 +42,28 @@ class Renderer(object):
         scene.add(light, pose=light_pose)
         light_pose = trimesh.transformations.rotation_matrix(np.radians(45), [0, 1, 0])
         scene.add(light, pose=light_pose)
+        return scene
+
+    def _get_material(self, mesh_color):
+        if mesh_color not in self.materials:
+            self.materials[mesh_color] = pyrender.MetallicRoughnessMaterial(
+                metallicFactor=0.2,
+                alphaMode='OPAQUE',
+                baseColorFactor=mesh_color)
+        return self.materials[mesh_color]
+
+    def render_front_view(self, verts, bg_img_rgb=None, bg_color=(0, 0, 0, 0)):
+        if self.scene is None:
+            self.scene = self._build_scene()
+        scene = self.scene
+        scene.bg_color = bg_color
+        self.camera.fx = self.camera.fy = self.focal_length
+        self.camera.cx, self.camera.cy = self.camera_center
+
+        # Remove the meshes of the previous image, their buffers are released by the next render
+        for node in self.mesh_nodes:
+            scene.remove_node(node)
+        self.mesh_nodes = []
 
         # Need to flip x-axis
         rot = trimesh.transformations.rotation_matrix(np.radians(180), [1, 0, 0])
@@ -48,12 +77,8 @@ class Renderer(object):
                 mesh_color = colorsys.hsv_to_rgb(0.6, 0.5, 1.0)
             else:
                 mesh_color = colorsys.hsv_to_rgb(float(n) / num_people, 0.5, 1.0)
-            material = pyrender.MetallicRoughnessMaterial(
-                metallicFactor=0.2,
-                alphaMode='OPAQUE',
-                baseColorFactor=mesh_color)
-            mesh = pyrender.Mesh.from_trimesh(mesh, material=material, wireframe=False)
-            scene.add(mesh, 'mesh')
+            mesh = pyrender.Mesh.from_trimesh(mesh, material=self._get_material(mesh_color), wireframe=False)
+            self.mesh_nodes.append(scene.add(mesh, 'mesh'))
 
         # Alpha channel was not working previously, need to check again
         # Until this is fixed use hack with depth image to get the opacity
@@ -80,3 +105,55 @@ class Renderer(object):
         Need to delete before creating the renderer next time
         """
         self.renderer.delete()
+
+
+class RendererPool:
+    """
+    Renderers keyed by viewport size. Creating the GL context dominates the
+    rendering time of a single image, the pool keeps up to max_size renderers
+    and only updates the camera and faces of the one of the requested size.
+    GL contexts belong to the thread which created them, so every thread
+    needs its own pool, see get_renderer.
+    """
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.renderers = OrderedDict()
+
+    def get(self, focal_length, img_w, img_h, faces, same_mesh_color=False):
+        key = (int(img_w), int(img_h))
+        renderer = self.renderers.pop(key, None)
+        if renderer is None:
+            if len(self.renderers) >= self.max_size:
+                _, oldest = self.renderers.popitem(last=False)
+                oldest.delete()
+            renderer = Renderer(img_w=key[0], img_h=key[1])
+        # Most recently used last
+        self.renderers[key] = renderer
+        renderer.focal_length = float(focal_length)
+        renderer.faces = faces
+        renderer.same_mesh_color = same_mesh_color
+        return renderer
+
+    def delete(self):
+        for renderer in self.renderers.values():
+            renderer.delete()
+        self.renderers.clear()
+
+
+_local = threading.local()
+
+
+def get_renderer(focal_length, img_w, img_h, faces, same_mesh_color=False):
+    """
+    Renderer from the pool of the calling thread. It is reused by the next
+    call with the same image size, do not delete it.
+    """
+    if not hasattr(_local, 'pool'):
+        _local.pool = RendererPool()
+    return _local.pool.get(focal_length, img_w, img_h, faces, same_mesh_color)
+
+
+def delete_renderers():
+    """Deletes the pooled renderers of the calling thread."""
+    if hasattr(_local, 'pool'):
+        _local.pool.delete()
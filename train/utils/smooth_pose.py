@@ -2,54 +2,98 @@ import torch
 import numpy as np
 
 from ..models.head.smpl_head import SMPL
-from ..core.config import SMPL_MODEL_DIR
-from .one_euro_filter import OneEuroFilter
+from ..models.head.smplx_local import SMPLX
+from ..core.config import SMPL_MODEL_DIR, SMPLX_MODEL_DIR
+from .one_euro_filter import MultiOneEuroFilter
 
 
-def smooth_pose(pred_pose, pred_betas, min_cutoff=0.004, beta=0.7):
-    # min_cutoff: Decreasing the minimum cutoff frequency decreases slow speed jitter
-    # beta: Increasing the speed coefficient(beta) decreases speed lag.
-
-    one_euro_filter = OneEuroFilter(
-        np.zeros_like(pred_pose[0]),
-        pred_pose[0],
-        min_cutoff=min_cutoff,
-        beta=beta,
-    )
-
-    smpl = SMPL(model_path=SMPL_MODEL_DIR)
-
-    pred_pose_hat = np.zeros_like(pred_pose)
-
-    # initialize
-    pred_pose_hat[0] = pred_pose[0]
+@torch.no_grad()
+def body_model_forward(body_model, pred_pose, pred_betas, lhand_pose=None, rhand_pose=None, batch_size=1024):
+    """
+    Vertices and joints of (B, J, 3, 3) rotation matrices, evaluated in batches of batch_size.
+    lhand_pose, rhand_pose: (B, 15, 3, 3) hand poses for SMPL-X
+    """
+    device = next(body_model.buffers()).device
+    verts, joints3d = [], []
+    for start in range(0, len(pred_pose), batch_size):
+        rotmat = torch.from_numpy(pred_pose[start:start + batch_size]).float().to(device)
+        kwargs = {}
+        if lhand_pose is not None:
+            kwargs['left_hand_pose'] = torch.from_numpy(lhand_pose[start:start + batch_size]).float().to(device)
+            kwargs['right_hand_pose'] = torch.from_numpy(rhand_pose[start:start + batch_size]).float().to(device)
+        output = body_model(
+            betas=torch.from_numpy(pred_betas[start:start + batch_size]).float().to(device),
+            body_pose=rotmat[:, 1:].contiguous(),
+            global_orient=rotmat[:, 0:1].contiguous(),
+            pose2rot=False,
+            **kwargs,
+        )
+        verts.append(output.vertices.cpu().numpy())
+        joints3d.append(output.joints.cpu().numpy())
+    return np.concatenate(verts), np.concatenate(joints3d)
 
-    pred_verts_hat = []
-    pred_joints3d_hat = []
 
-    smpl_output = smpl(
-        betas=torch.from_numpy(pred_betas[0]).unsqueeze(0),
-        body_pose=torch.from_numpy(pred_pose[0, 1:]).unsqueeze(0),
-        global_orient=torch.from_numpy(pred_pose[0, 0:1]).unsqueeze(0),
-        pose2rot=False,
-    )
-    pred_verts_hat.append(smpl_output.vertices.detach().cpu().numpy())
-    pred_joints3d_hat.append(smpl_output.joints.detach().cpu().numpy())
+class PoseSmoother:
+    '''
+    Temporal smoothing of the poses of num_tracks people with a one euro filter
+    followed by one batched body model evaluation of the smoothed poses.
+    model_type: smpl, or smplx for the (22, 3, 3) pred_pose of HMR with SMPL-X
+    hands: also smooth the (15, 3, 3) hand poses of CLIFF-X
+    min_cutoff: Decreasing the minimum cutoff frequency decreases slow speed jitter
+    beta: Increasing the speed coefficient(beta) decreases speed lag.
+    '''
+    def __init__(self, num_tracks, model_type='smplx', hands=False, min_cutoff=0.004, beta=0.7,
+                 device='cpu', batch_size=1024):
+        self.num_tracks = num_tracks
+        self.hands = hands
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.batch_size = batch_size
+        self.filter = None
+        if model_type == 'smpl':
+            self.body_model = SMPL(model_path=SMPL_MODEL_DIR)
+        else:
+            # Same body models as the heads of HMR and HMRX
+            self.body_model = SMPLX(SMPLX_MODEL_DIR, num_betas=11, flat_hand_mean=hands)
+        self.body_model = self.body_model.to(device)
 
-    for idx, pose in enumerate(pred_pose[1:]):
-        idx += 1
+    def __call__(self, t, pred_pose, pred_betas, valid=None, lhand_pose=None, rhand_pose=None):
+        """
+        Smooths a sequence or the next chunk of a stream.
+        t: (T,) time of the frames, e.g. the frame indices
+        pred_pose: (T, N, J, 3, 3) rotation matrices of the N tracks
+        pred_betas: (T, N, num_betas)
+        valid: (T, N) tracks present in every frame, all by default
+        lhand_pose, rhand_pose: (T, N, 15, 3, 3) with hands=True
+        Returns a dict of the valid (frame, track) pairs, arrays with one row per pair:
+        frame, track, pred_pose (smoothed), lhand_pose and rhand_pose (smoothed, with hands), vertices, joints3d
+        """
+        num_joints = pred_pose.shape[2]
+        pose = pred_pose
+        if self.hands:
+            pose = np.concatenate([pred_pose, lhand_pose, rhand_pose], axis=2)
+        if self.filter is None:
+            self.filter = MultiOneEuroFilter(self.num_tracks, pose.shape[2:], min_cutoff=self.min_cutoff,
+                                             beta=self.beta)
+        if valid is None:
+            valid = np.ones(pose.shape[:2], dtype=bool)
+        pose_hat = self.filter(t, pose, valid)
 
-        t = np.ones_like(pose) * idx
-        pose = one_euro_filter(t, pose)
-        pred_pose_hat[idx] = pose
+        frame, track = np.nonzero(valid)
+        pose_hat = pose_hat[frame, track]
+        output = {'frame': np.asarray(t)[frame], 'track': track, 'pred_pose': pose_hat[:, :num_joints]}
+        if self.hands:
+            output['lhand_pose'] = pose_hat[:, num_joints:num_joints + 15]
+            output['rhand_pose'] = pose_hat[:, num_joints + 15:]
+        output['vertices'], output['joints3d'] = body_model_forward(
+            self.body_model, output['pred_pose'], pred_betas[frame, track],
+            output.get('lhand_pose'), output.get('rhand_pose'), batch_size=self.batch_size)
+        return output
 
-        smpl_output = smpl(
-            betas=torch.from_numpy(pred_betas[idx]).unsqueeze(0),
-            body_pose=torch.from_numpy(pred_pose_hat[idx, 1:]).unsqueeze(0),
-            global_orient=torch.from_numpy(pred_pose_hat[idx, 0:1]).unsqueeze(0),
-            pose2rot=False,
-        )
-        pred_verts_hat.append(smpl_output.vertices.detach().cpu().numpy())
-        pred_joints3d_hat.append(smpl_output.joints.detach().cpu().numpy())
 
-    return np.vstack(pred_verts_hat), pred_pose_hat, np.vstack(pred_joints3d_hat)
\ No newline at end of file
+def smooth_pose(pred_pose, pred_betas, min_cutoff=0.004, beta=0.7):
+    # min_cutoff: Decreasing the minimum cutoff frequency decreases slow speed jitter
+    # beta: Increasing the speed coefficient(beta) decreases speed lag.
+    smoother = PoseSmoother(1, model_type='smpl', min_cutoff=min_cutoff, beta=beta)
+    output = smoother(np.arange(len(pred_pose)), pred_pose[:, None], pred_betas[:, None])
+    return output['vertices'], output['pred_pose'], output['joints3d']
@@ -116,6 +116,21 @@ def parse_datasets_ratios(datasets_and_ratios):
     return d + r
 
 
+def split_datasets_and_ratios(datasets_and_ratios):
+    """
+    'agora_bedlam' -> (['agora', 'bedlam'], None)
+    'agora_bedlam_0.3_0.7' -> (['agora', 'bedlam'], [0.3, 0.7])
+    """
+    s_ = datasets_and_ratios.split('_')
+    if len(s_) % 2 == 0:
+        try:
+            r = [float(x) for x in s_[len(s_) // 2:]]
+            return s_[:len(s_) // 2], r
+        except ValueError:
+            pass
+    return s_, None
+
+
 class CheckBatchGradient(pl.Callback):
 
     def on_train_start(self, trainer, model):
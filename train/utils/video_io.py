@@ -0,0 +1,178 @@
+"""
+Video input and output of the demos, the frames never go to disk.
+
+VideoReader decodes a video file, a stream url or a camera index in a
+background thread into a bounded queue. detect_frames runs the person
+detector of the multi person tracker on a batch of frames. OrderedVideoWriter
+writes the frames in frame order when they arrive from several writer threads
+and VideoResults collects the per-person predictions of all frames into a
+single .npz file.
+"""
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+import torch
+from loguru import logger
+
+# Marks the end of the video in the decode queue
+_END = object()
+
+
+def open_capture(video):
+    """cv2.VideoCapture of a file, a stream url or a camera index given as a string of digits."""
+    source = int(video) if str(video).isdigit() else video
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise IOError(f'Could not open video {video}')
+    return cap
+
+
+class VideoReader:
+    '''
+    video: video file, stream url or camera index
+    queue_size: number of decoded frames buffered ahead of the detector
+    Iterating yields (frame index, RGB frame).
+    '''
+    def __init__(self, video, queue_size=16):
+        self.video = video
+        self.cap = open_capture(video)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        if not self.fps or self.fps <= 0 or np.isnan(self.fps):
+            # Streams and cameras often do not report their frame rate
+            self.fps = 30.
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        # Unknown for streams
+        self.num_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+        self.name = os.path.splitext(os.path.basename(str(video).rstrip('/')))[0] or 'video'
+        self.queue = queue.Queue(queue_size)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._decode, daemon=True)
+        self.thread.start()
+
+    def _decode(self):
+        frame_idx = 0
+        try:
+            while not self.stop.is_set():
+                ret, frame = self.cap.read()
+                if not ret:
+                    break
+                self._put((frame_idx, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+                frame_idx += 1
+        except Exception as E:
+            self._put(E)
+        finally:
+            self.cap.release()
+            self._put(_END)
+
+    def _put(self, value):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        while True:
+            entry = self.queue.get()
+            if entry is _END:
+                return
+            if isinstance(entry, Exception):
+                raise entry
+            yield entry
+
+    def batches(self, batch_size):
+        """Yields lists of (frame index, frame) of batch_size frames, the last one may be shorter."""
+        batch = []
+        for entry in self:
+            batch.append(entry)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+@torch.no_grad()
+def detect_frames(mot, frames):
+    """
+    Runs the detector of a multi_person_tracker.MPT on a list of RGB frames of the same size.
+    Returns the (N, 4) boxes [cx, cy, size, size] of every frame, the format of MPT.detect.
+    """
+    batch = torch.stack([torch.from_numpy(frame).permute(2, 0, 1) for frame in frames])
+    batch = batch.to(mot.device).float() / 255.
+    detections = []
+    for pred in mot.detector(batch):
+        bb = pred['boxes'].cpu().numpy()
+        sc = pred['scores'].cpu().numpy()
+        bb = bb[sc > mot.detection_threshold]
+        w, h = bb[:, 2] - bb[:, 0], bb[:, 3] - bb[:, 1]
+        size = np.maximum(w, h)
+        detections.append(np.stack([bb[:, 0] + w / 2., bb[:, 1] + h / 2., size, size], axis=1))
+    return detections
+
+
+class OrderedVideoWriter:
+    """
+    cv2.VideoWriter taking the frames from several threads, a frame is
+    written once all the frames before it arrived.
+    """
+    def __init__(self, path, fps, width, height):
+        self.path = path
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_frame = 0
+
+    def write(self, frame_idx, frame_rgb):
+        with self.lock:
+            self.pending[frame_idx] = frame_rgb
+            while self.next_frame in self.pending:
+                self.writer.write(np.ascontiguousarray(self.pending.pop(self.next_frame)[:, :, ::-1]))
+                self.next_frame += 1
+
+    def close(self):
+        with self.lock:
+            if len(self.pending) > 0:
+                logger.warning(f'{len(self.pending)} frames after frame {self.next_frame} were not written')
+            self.writer.release()
+        logger.info(f'Wrote {self.next_frame} frames to {self.path}')
+
+
+class VideoResults:
+    """
+    Per-person predictions of a video, saved as one .npz with the arrays
+    frame and person_id and one array per predicted quantity, one row per person.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rows = {}
+
+    def add(self, frame_idx, arrays):
+        """arrays: dict of (P, ...) arrays of the P people of the frame."""
+        num_people = len(next(iter(arrays.values())))
+        arrays = dict(arrays)
+        arrays['frame'] = np.full(num_people, frame_idx, dtype=np.int32)
+        arrays['person_id'] = np.arange(num_people, dtype=np.int32)
+        with self.lock:
+            for k, v in arrays.items():
+                self.rows.setdefault(k, []).append(v)
+
+    def save(self):
+        with self.lock:
+            results = {k: np.concatenate(v) for k, v in self.rows.items()}
+        if len(results) > 0:
+            # The rows of the writer threads are not in frame order
+            order = np.lexsort((results['person_id'], results['frame']))
+            results = {k: v[order] for k, v in results.items()}
+        np.savez(self.path, **results)
+        logger.info(f'Saved {len(results.get("frame", []))} predictions to {self.path}')
@@ -5,7 +5,7 @@ import smplx
 import torch
 import numpy as np
 from train.core.config import DATASET_FOLDERS, DATASET_FILES
-from train.utils.renderer_pyrd import Renderer
+from train.utils.renderer_pyrd import get_renderer, delete_renderers
 MODEL_FOLDER = 'data/body_models/smplx/models/'
 SCENES = ['agora-bfh', 'agora-body', 'zoom-suburbd', 'closeup-suburba', 'closeup-suburbb', 'closeup-suburbc', 'closeup-suburbd',
         'closeup-gym', 'zoom-gym', 'static-gym', 'static-office', 'orbit-office', 'orbit-archviz-15', 'orbit-archviz-19', 'orbit-archviz-12',
@@ -149,8 +149,9 @@ def visualize_crop(image_path, center, scale, verts, focal_length,
 
     h, w, c = img.shape
 
-    renderer = Renderer(focal_length=focal_length, img_w=w, img_h=h,
-                        faces=smplx_model_neutral.faces)
+    # The renderers are reused across images of the same size
+    renderer = get_renderer(focal_length=focal_length, img_w=w, img_h=h,
+                            faces=smplx_model_neutral.faces)
     front_view = renderer.render_front_view(verts.unsqueeze(0).detach().cpu().numpy(),
                                             bg_img_rgb=img[:, :, ::-1].copy())
 
@@ -166,8 +167,9 @@ def visualize(image_path, verts, focal_length, output_dir, rotate_flag=False):
         img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
     h, w, c = img.shape
 
-    renderer = Renderer(focal_length=focal_length, img_w=w, img_h=h,
-                        faces=smplx_model_neutral.faces)
+    # The renderers are reused across images of the same size
+    renderer = get_renderer(focal_length=focal_length, img_w=w, img_h=h,
+                            faces=smplx_model_neutral.faces)
     front_view = renderer.render_front_view(verts.unsqueeze(0).detach().cpu().numpy(),
                                             bg_img_rgb=img[:, :, ::-1].copy())
 
@@ -211,3 +213,4 @@ if __name__ == '__main__':
         vertices3d = np.matmul(cam_ext[:3, :3], vertices3d_world.T).T
         verts_cam = vertices3d + cam_trans
         visualize(os.path.join(base_img_path, imgname), torch.tensor(verts_cam), focal_length, output_dir, rotate_flag)
+    delete_renderers()